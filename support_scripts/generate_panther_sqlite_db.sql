@@ -46,6 +46,44 @@ UPDATE panther SET col_10=NULL WHERE TRIM(col_10)="";
 UPDATE panther SET col_11=NULL WHERE TRIM(col_11)="";
 
 CREATE INDEX pantherid_idx ON panther (PantherID);
-CREATE INDEX gene_idx ON panther (Gene);
+-- covers the gene -> family lookup
+CREATE INDEX gene_pantherid_idx ON panther (Gene, PantherID);
+
+-- precomputed family tables for the prottree, see worker/app/app/panther.py
+-- (python3 -m app.panther adds them to an existing db)
+CREATE TABLE panther_families (
+    PantherID TEXT PRIMARY KEY,
+    Family TEXT
+) WITHOUT ROWID;
+-- family name of the first gene of the family
+INSERT INTO panther_families
+SELECT PantherID, Family
+FROM panther
+WHERE rowid IN (SELECT MIN(rowid) FROM panther GROUP BY PantherID);
+
+CREATE TABLE panther_subfamilies (
+    PantherID TEXT NOT NULL,
+    Subfamily TEXT NOT NULL,
+    genes INTEGER NOT NULL,
+    PRIMARY KEY (PantherID, Subfamily)
+) WITHOUT ROWID;
+INSERT INTO panther_subfamilies
+SELECT PantherID, Subfamily, COUNT(*)
+FROM panther
+WHERE Subfamily IS NOT NULL
+GROUP BY PantherID, Subfamily;
+
+CREATE TABLE panther_presence (
+    PantherID TEXT NOT NULL,
+    Subfamily TEXT NOT NULL,
+    Genome TEXT NOT NULL,
+    PRIMARY KEY (PantherID, Subfamily, Genome)
+) WITHOUT ROWID;
+INSERT INTO panther_presence
+SELECT DISTINCT PantherID, Subfamily, Genome
+FROM panther
+WHERE Subfamily IS NOT NULL;
+
+ANALYZE;
 
 VACUUM;
@@ -0,0 +1,75 @@
+-- Tab-separated, one OG per line, empty columns for unknown values:
+-- OG id, description, evolRate, totalGenesCount, multiCopyGenesCount, singleCopyGenesCount,
+-- inSpeciesCount, medianProteinLength, stddevProteinLength
+.echo on
+.output
+DROP TABLE IF EXISTS og_stats_import;
+
+CREATE TABLE og_stats_import (
+    cluster_id INTEGER NOT NULL,
+    clade INTEGER NOT NULL,
+    description TEXT NOT NULL,
+    evol_rate TEXT,
+    total_genes_count TEXT,
+    multi_copy_genes_count TEXT,
+    single_copy_genes_count TEXT,
+    in_species_count TEXT,
+    median_protein_length TEXT,
+    stddev_protein_length TEXT
+);
+
+.mode csv
+.separator "\t"
+.import /tmp/import_data.tab og_stats_import
+
+DROP TABLE IF EXISTS og_stats;
+
+-- keyed by OG id ("{cluster_id}at{clade}"), orthodb_to_og uses the same split
+CREATE TABLE og_stats (
+    cluster_id INTEGER NOT NULL,
+    clade INTEGER NOT NULL,
+    description TEXT NOT NULL,
+    evol_rate REAL,
+    total_genes_count INTEGER,
+    multi_copy_genes_count INTEGER,
+    single_copy_genes_count INTEGER,
+    in_species_count INTEGER,
+    median_protein_length INTEGER,
+    stddev_protein_length REAL,
+    PRIMARY KEY (cluster_id, clade)
+) WITHOUT ROWID;
+
+INSERT OR REPLACE INTO og_stats
+SELECT
+    cluster_id,
+    clade,
+    description,
+    NULLIF(TRIM(evol_rate), ''),
+    NULLIF(TRIM(total_genes_count), ''),
+    NULLIF(TRIM(multi_copy_genes_count), ''),
+    NULLIF(TRIM(single_copy_genes_count), ''),
+    NULLIF(TRIM(in_species_count), ''),
+    NULLIF(TRIM(median_protein_length), ''),
+    NULLIF(TRIM(stddev_protein_length), '')
+FROM og_stats_import;
+
+DROP TABLE og_stats_import;
+
+VACUUM;
+
+-- Docker commands
+-- docker run -it --rm --user "$(id -u):$(id -g)" --entrypoint bash -v $PWD:/wd --workdir /wd nouchka/sqlite3
+-- ./scripts/tabprocessor OG_stats odb10v1_OG_stats.tab
+
+-- Test Request
+-- .mode box
+-- .headers on
+-- .timer on
+
+-- SELECT
+--     cluster_id || 'at' || clade AS label,
+--     levels.scientific_name AS clade,
+--     og_stats.*
+-- FROM og_stats
+-- JOIN levels ON levels.level_id = og_stats.clade
+-- WHERE cluster_id = 1 AND clade = 2759;
@@ -135,9 +135,7 @@ func do() error {
 			}
 			clusterID, clade := parts[0], parts[1]
 
-			switch string(clade) {
-			case "2759", "4751", "7742", "7898", "8782", "33090", "33208", "199999999":
-			default:
+			if !isImportedClade(clade) {
 				continue loop
 			}
 
@@ -156,6 +154,46 @@ func do() error {
 				return fmt.Errorf("Write error \"%s\": %w", line, err)
 			}
 		}
+	case "OG_stats":
+	statsLoop:
+		for {
+			line, err := r.ReadBytes('\n')
+			switch err {
+			case nil:
+				// continue processing
+			case io.EOF:
+				return nil
+			default:
+				return fmt.Errorf("Read error: %w", err)
+			}
+
+			// stats columns are copied as-is, trailing empty columns must be kept
+			idx := bytes.IndexByte(line, '\t')
+			if idx == -1 {
+				return fmt.Errorf(`Error processing line "%s": no columns after OG id`, line)
+			}
+			stats := bytes.TrimRight(line[idx+1:], "\r\n")
+
+			parts, err := splitter(line[:idx], "at")
+			if err != nil {
+				return fmt.Errorf("Error processing line \"%s\": %w", line, err)
+			}
+			clusterID, clade := parts[0], parts[1]
+
+			if !isImportedClade(clade) {
+				continue statsLoop
+			}
+
+			w.Write(clusterID) //nolint:errcheck
+			w.WriteByte('\t')  //nolint:errcheck
+			w.Write(clade)     //nolint:errcheck
+			w.WriteByte('\t')  //nolint:errcheck
+			w.Write(stats)     //nolint:errcheck
+			err = w.WriteByte('\n')
+			if err != nil {
+				return fmt.Errorf("Write error \"%s\": %w", line, err)
+			}
+		}
 
 	default:
 		return fmt.Errorf("Unknown file kind: %s", fileKind)
@@ -163,6 +201,15 @@ func do() error {
 
 }
 
+// levels we have phylogenetic trees for (see levels table in 3_OG.sql)
+func isImportedClade(clade []byte) bool {
+	switch string(clade) {
+	case "2759", "4751", "7742", "7898", "8782", "33090", "33208", "199999999":
+		return true
+	}
+	return false
+}
+
 // orthodb_id = orthodb_id.strip()
 // a, c = orthodb_id.split(":", maxsplit=1)
 // a, b = a.split("_", maxsplit=1)
@@ -1,20 +1,18 @@
 import asyncio
 from time import time
 from datetime import timedelta
-import aioredis
 from . import tasks as _
+from .tasks import blast_gateway
 
 from .async_executor import async_pool
 from .task_manager import queue_manager
-from .redis import redis, GROUP, init_db
-from .utils import decode_int
+from .redis import redis, raw_redis, cache, CACHE_REDIS_URL, GROUP, init_db
 
 
 @queue_manager.add_handler("/queues/flush_cache")
 async def flush_cache(queue_name, q_id, **queue_params):
+    await cache.flush()
     async with redis.pipeline(transaction=False) as pipe:
-        async for item in redis.scan_iter(match="/cache/*"):
-            pipe.delete(item)
         pipe.xack(queue_name, GROUP, q_id)
         pipe.xdel(queue_name, q_id)
         await pipe.execute()
@@ -26,65 +24,42 @@ MAX_CACHE_LIFE_WITHOUT_ACCESS = timedelta(days=30*3).total_seconds()
 # Delete cache key after 6 months regardless of access date (to refresh data)
 MAX_CACHE_LIFE = timedelta(days=30*6).total_seconds()
 
-async def delete_if_needed(accessed_key:str):
-    common_path = accessed_key.rsplit("/", maxsplit=1)[0]
-    try:
-        async with redis.pipeline(transaction=True) as pipe:
-            await pipe.watch(accessed_key)
-            last_accessed, created = await pipe.mget(
-                accessed_key,
-                f"{common_path}/created",
-            )
-            if not last_accessed or not created:
-                return
-
-            last_accessed = decode_int(last_accessed)
-            created = decode_int(created)
-            cur_time = int(time())
-
-            if (cur_time - last_accessed < MAX_CACHE_LIFE_WITHOUT_ACCESS) and (
-                cur_time - created < MAX_CACHE_LIFE
-            ):
-                return
-
-            keys_to_delete = []
-
-            async for items in pipe.scan_iter(match=f"{common_path}/*"):
-                keys_to_delete.append(items)
-
-            pipe.multi()
-            pipe.delete(*keys_to_delete)
-            await pipe.execute()
-
-    except aioredis.WatchError:
-        # update to accessed_key means we should skip this key
-        return
-    return True
+async def migrate_cache():
+    # before the tasks start, they would write to the keys being moved
+    if CACHE_REDIS_URL:
+        count = await cache.move_from(raw_redis)
+        if count:
+            print(f"Moved {count} cache keys to the cache redis")
+    count = await cache.index_legacy_entries()
+    if count:
+        print(f"Indexed {count} cache records")
+    count = await cache.set_entry_ttls()
+    if count:
+        print(f"Set the ttl of {count} cache records")
 
 
 async def clean_cache():
     while True:
-        count = 0
-        async for item in redis.scan_iter(match="/cache/*/accessed"):
-            if await delete_if_needed(item):
-                count += 1
-        if count:
-            print(f"Deleted {count} old cache records")
-        # compact the DB every so often
-        await redis.bgrewriteaof()
-        await asyncio.sleep(timedelta(hours=2).total_seconds()) # run every 2 hours
-
+        stats = await cache.expire(MAX_CACHE_LIFE_WITHOUT_ACCESS, MAX_CACHE_LIFE)
+        print(
+            f"Cache expiry: {stats['entries']} records, {stats['expired']} deleted "
+            f"in {stats['batches']} batches, {stats['duration']}s"
+        )
+        await asyncio.sleep(timedelta(minutes=10).total_seconds())
 
 
 async def main():
     await init_db()
+    await cache.wait()
     await redis.rpush("/worker_initialied", int(time()))
+    await migrate_cache()
     cache_cleaner = asyncio.create_task(clean_cache())
     try:
         async with async_pool, queue_manager:
             await queue_manager()
     finally:
         cache_cleaner.cancel()
+        await blast_gateway.gateway.aclose()
         await redis.delete("/worker_initialied")
 
 
@@ -0,0 +1,264 @@
+"""Precomputed OG x organism ortholog counts for every phylogeny level
+
+Replaces per-OG sparql requests made by vis_sync.get_corr_data with a lookup
+in memory-mapped arrays built from the local OrthoDB copy (ORTHODB_SQLITE).
+
+Build or update (levels with unchanged db and phyloxml file are skipped):
+    python3 -m app.corr_matrix
+
+Layout of CORR_MATRIX_PATH:
+    {level_id} -> {level_id}.{fingerprint}  symlink to the current build
+    {level_id}.{fingerprint}/
+        meta.json                 clade and source fingerprint
+        taxids.npy                organisms (columns) in phyloxml order
+        og_ids.npy                sorted OG cluster ids (rows)
+        indptr.npy                CSR row pointers into indices/counts
+        indices.npy               column of every non-zero count
+        counts.npy                ortholog counts (int16)
+        gene_names_offsets.npy    row pointers into gene_names.bin
+        gene_names.bin            utf-8 json {taxid: "name1;name2"} per row
+"""
+from array import array
+from contextlib import closing
+import hashlib
+import json
+import os
+from pathlib import Path
+import shutil
+import sqlite3
+import threading
+from typing import Optional
+
+import numpy as np
+from lxml import etree as ET
+
+from .utils import ORTHODB_SQLITE, CORR_MATRIX_PATH, list_level_files
+
+# bump to rebuild all matrices after changing the layout
+FORMAT_VERSION = 2
+
+NS = {
+    "xsi": "http://www.w3.org/2001/XMLSchema-instance",
+    "": "http://www.phyloxml.org"
+}
+
+
+def level_organisms(phyloxml_file:str) -> list[int]:
+    parser = ET.XMLParser(remove_blank_text=True)
+    root = ET.parse(phyloxml_file, parser).getroot()
+    orgs = []
+    for org_xml in root.xpath("//pxml:id/..", namespaces={'pxml':"http://www.phyloxml.org"}):
+        try:
+            orgs.append(int(org_xml.find("id", NS).text))
+        except Exception:
+            # org_id contains letters, this could happen for missing organism
+            pass
+    return orgs
+
+
+class CorrMatrix():
+    def __init__(self, path:Path):
+        with open(path / "meta.json") as f:
+            self.meta = json.load(f)
+        self.clade: int = self.meta["clade"]
+        self.taxids = np.load(path / "taxids.npy")
+        self.og_ids = np.load(path / "og_ids.npy", mmap_mode='r')
+        self.indptr = np.load(path / "indptr.npy", mmap_mode='r')
+        self.indices = np.load(path / "indices.npy", mmap_mode='r')
+        self.counts = np.load(path / "counts.npy", mmap_mode='r')
+        self.gene_names_offsets = np.load(path / "gene_names_offsets.npy", mmap_mode='r')
+        if self.gene_names_offsets[-1]:
+            self.gene_names = np.memmap(path / "gene_names.bin", dtype=np.uint8, mode='r')
+        else:
+            # empty file can't be mapped
+            self.gene_names = np.zeros(0, dtype=np.uint8)
+
+    def rows(self, labels:dict[str, str], organisms:list[int]) -> dict[str, tuple[np.ndarray, dict[str, str]]]:
+        """Takes "Name" -> OG label, returns "Name" -> (counts aligned to organisms, gene names)
+
+        OGs missing from the matrix are missing from the result
+        """
+        if np.array_equal(self.taxids, organisms):
+            columns = None
+        else:
+            # phyloxml changed after the build: map the matrix columns onto the current organisms
+            org_pos = {taxid: i for i, taxid in enumerate(organisms)}
+            columns = np.fromiter(
+                (org_pos.get(taxid, -1) for taxid in self.taxids.tolist()),
+                count=len(self.taxids), dtype=np.int64,
+            )
+
+        res = {}
+        for name, label in labels.items():
+            try:
+                cluster_id, clade = label.split("at", maxsplit=1)
+                cluster_id = int(cluster_id)
+                if int(clade) != self.clade:
+                    continue
+            except ValueError:
+                continue
+            pos = int(np.searchsorted(self.og_ids, cluster_id))
+            if pos == len(self.og_ids) or self.og_ids[pos] != cluster_id:
+                continue
+            start, end = self.indptr[pos], self.indptr[pos+1]
+            cols = self.indices[start:end]
+            counts = self.counts[start:end]
+            if columns is not None:
+                cols = columns[cols]
+                counts = counts[cols != -1]
+                cols = cols[cols != -1]
+
+            row = np.zeros(len(organisms), dtype=np.int16)
+            row[cols] = counts
+            gene_names = json.loads(
+                self.gene_names[self.gene_names_offsets[pos]:self.gene_names_offsets[pos+1]].tobytes()
+            )
+            res[name] = (row, gene_names)
+        return res
+
+
+_loaded: dict[int, tuple[str, CorrMatrix]] = {}
+_load_lock = threading.Lock()
+
+def load(level_id:int) -> Optional[CorrMatrix]:
+    """Returns the current matrix for the level or None if it wasn't built"""
+    if CORR_MATRIX_PATH is None:
+        return None
+    try:
+        path = os.readlink(CORR_MATRIX_PATH / str(level_id))
+    except OSError:
+        return None
+    with _load_lock:
+        cached_path, matrix = _loaded.get(level_id, (None, None))
+        if cached_path != path:
+            matrix = CorrMatrix(CORR_MATRIX_PATH / path)
+            _loaded[level_id] = (path, matrix)
+    return matrix
+
+
+def _fingerprint(clade:int, phyloxml_file:str) -> str:
+    h = hashlib.sha256()
+    db_stat = os.stat(ORTHODB_SQLITE)
+    h.update(json.dumps([FORMAT_VERSION, clade, db_stat.st_size, db_stat.st_mtime_ns]).encode())
+    with open(phyloxml_file, "rb") as f:
+        h.update(f.read())
+    return h.hexdigest()[:16]
+
+
+def _build(conn:sqlite3.Connection, clade:int, organisms:list[int], out_dir:Path):
+    org_pos = {taxid: i for i, taxid in enumerate(organisms)}
+
+    conn.execute("DROP TABLE IF EXISTS temp.level_organisms")
+    conn.execute("CREATE TEMP TABLE level_organisms (taxid INTEGER PRIMARY KEY)")
+    conn.executemany("INSERT OR IGNORE INTO level_organisms VALUES (?)", ((taxid,) for taxid in organisms))
+    # same as the sparql request: count distinct gene names per organism
+    rows = conn.execute("""
+        SELECT cluster_id, taxid, COUNT(*), GROUP_CONCAT(gene_name, ';')
+        FROM (
+            SELECT DISTINCT
+                orthodb_to_og.cluster_id AS cluster_id,
+                genes.orthodb_id >> 32 AS taxid,
+                genes.gene_name AS gene_name
+            FROM orthodb_to_og
+            JOIN genes USING (orthodb_id)
+            JOIN level_organisms ON level_organisms.taxid = genes.orthodb_id >> 32
+            WHERE orthodb_to_og.clade = ? AND genes.gene_name IS NOT NULL
+            ORDER BY cluster_id, taxid, gene_name
+        )
+        GROUP BY cluster_id, taxid
+        ORDER BY cluster_id, taxid
+    """, (clade,))
+    # OGs without named genes in the level get empty rows, they are known to have no orthologs here
+    clusters = (
+        cluster_id
+        for cluster_id, in conn.execute(
+            "SELECT DISTINCT cluster_id FROM orthodb_to_og WHERE clade = ? ORDER BY cluster_id",
+            (clade,),
+        )
+    )
+
+    og_ids = array('q')
+    indptr = array('q', [0])
+    indices = array('l')
+    counts = array('h')
+    gene_names_offsets = array('q', [0])
+
+    with open(out_dir / "gene_names.bin", "wb") as names_f:
+        def finish_row(names):
+            names = json.dumps(names, separators=(',', ':')).encode()
+            names_f.write(names)
+            gene_names_offsets.append(gene_names_offsets[-1] + len(names))
+            indptr.append(len(indices))
+
+        row_names = {}
+        for cluster_id, taxid, count, names in rows:
+            if not og_ids or og_ids[-1] != cluster_id:
+                if og_ids:
+                    finish_row(row_names)
+                    row_names = {}
+                for empty_id in clusters:
+                    if empty_id == cluster_id:
+                        break
+                    og_ids.append(empty_id)
+                    finish_row({})
+                og_ids.append(cluster_id)
+            indices.append(org_pos[taxid])
+            counts.append(min(count, np.iinfo(np.int16).max))
+            row_names[str(taxid)] = names
+        if og_ids:
+            finish_row(row_names)
+        for empty_id in clusters:
+            og_ids.append(empty_id)
+            finish_row({})
+
+    np.save(out_dir / "taxids.npy", np.array(organisms, dtype=np.int64))
+    np.save(out_dir / "og_ids.npy", np.frombuffer(og_ids, dtype=np.int64))
+    np.save(out_dir / "indptr.npy", np.frombuffer(indptr, dtype=np.int64))
+    np.save(out_dir / "indices.npy", np.array(indices, dtype=np.int32))
+    np.save(out_dir / "counts.npy", np.frombuffer(counts, dtype=np.int16))
+    np.save(out_dir / "gene_names_offsets.npy", np.frombuffer(gene_names_offsets, dtype=np.int64))
+    return len(og_ids)
+
+
+def build_all():
+    if not ORTHODB_SQLITE:
+        raise RuntimeError("ORTHODB_SQLITE is not set")
+    CORR_MATRIX_PATH.mkdir(exist_ok=True)
+
+    with closing(sqlite3.connect(f"file:{ORTHODB_SQLITE}?mode=ro", uri=True)) as conn:
+        clades = {
+            name: level_id
+            for level_id, name in conn.execute("SELECT level_id, scientific_name FROM levels")
+        }
+        for level_id, level, _, phyloxml_file in list_level_files():
+            if level not in clades:
+                print(f"{level_id}: level {level} is missing from the db, skipped")
+                continue
+            clade = clades[level]
+            link = CORR_MATRIX_PATH / str(level_id)
+            target = f"{level_id}.{_fingerprint(clade, phyloxml_file)}"
+            old_target = os.readlink(link) if link.is_symlink() else None
+            if old_target == target:
+                print(f"{level_id}: up to date")
+                continue
+
+            out_dir = CORR_MATRIX_PATH / target
+            shutil.rmtree(out_dir, ignore_errors=True)
+            out_dir.mkdir()
+            organisms = level_organisms(phyloxml_file)
+            og_count = _build(conn, clade, organisms, out_dir)
+            with open(out_dir / "meta.json", "w") as f:
+                json.dump({"clade": clade, "level": level, "fingerprint": target}, f)
+
+            # atomic switch, running workers keep using the old files until they reload
+            tmp_link = CORR_MATRIX_PATH / f"{level_id}.new"
+            tmp_link.unlink(missing_ok=True)
+            tmp_link.symlink_to(target)
+            os.replace(tmp_link, link)
+            if old_target and old_target != target:
+                shutil.rmtree(CORR_MATRIX_PATH / old_target, ignore_errors=True)
+            print(f"{level_id}: {og_count} OGs x {len(organisms)} organisms")
+
+
+if __name__ == "__main__":
+    build_all()
@@ -0,0 +1,142 @@
+"""Registry of the phylogeny levels, built from the phyloxml files at worker startup
+
+Every level file is parsed once (build), tasks in any worker process read the
+results from LEVELS_PATH without touching the XML:
+
+    index.json              {level_id: {"level", "name", "phyloxml_file", "fingerprint"}}
+    {level_id}/
+        organisms.npy       taxids of the tree leaves in the leaf order (memory-mapped)
+        names.json          organism names, aligned to organisms.npy
+        skeleton.xml        the tree serialized without graphs, see phyloxml.TreeTemplate
+
+Leaves with non-numeric ids (missing organisms) are not a part of organisms.
+"""
+import hashlib
+import json
+import mmap
+import os
+from pathlib import Path
+import threading
+from typing import Optional
+
+import numpy as np
+from lxml import etree as ET
+
+from . import phyloxml
+from .utils import LEVELS_PATH, PHYLOXML_PATH, list_level_files, atomic_file
+
+
+class Level():
+    def __init__(self, level_id:int, info:dict):
+        self.id = level_id
+        self.level: str = info["level"]
+        self.name: str = info["name"]
+        self.phyloxml_file: str = info["phyloxml_file"]
+        self.fingerprint: str = info["fingerprint"]
+
+        path = LEVELS_PATH / str(level_id)
+        self.organisms: np.ndarray = np.load(path / "organisms.npy", mmap_mode='r')
+        with open(path / "names.json") as f:
+            self.names: list[Optional[str]] = json.load(f)
+        with open(path / "skeleton.xml", "rb") as f:
+            self._skeleton = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._template: Optional[phyloxml.TreeTemplate] = None
+
+    def organism_list(self) -> list[int]:
+        return self.organisms.tolist()
+
+    def template(self) -> phyloxml.TreeTemplate:
+        if self._template is None:
+            root_end = self._skeleton.rfind(b"</")
+            self._template = phyloxml.TreeTemplate(
+                self._skeleton[:root_end], None, self._skeleton[root_end:],
+            )
+        return self._template
+
+
+def _fingerprint(phyloxml_file:str) -> str:
+    with open(phyloxml_file, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()[:16]
+
+
+def _build_level(level_id:int, phyloxml_file:str):
+    parser = ET.XMLParser(remove_blank_text=True)
+    tree = ET.parse(phyloxml_file, parser)
+    root = tree.getroot()
+
+    organisms = []
+    names = []
+    # Assuming only children have IDs
+    for org_xml in root.xpath("//pxml:id/..", namespaces={'pxml':"http://www.phyloxml.org"}):
+        try:
+            organisms.append(int(org_xml.find("id", phyloxml.NS).text))
+        except Exception:
+            # org_id contains letters, this could happen for missing organism
+            continue
+        names.append(org_xml.findtext("name", None, phyloxml.NS))
+
+    path = LEVELS_PATH / str(level_id)
+    path.mkdir(parents=True, exist_ok=True)
+    with atomic_file(path / "organisms.npy") as tmp_file:
+        with open(tmp_file, "wb") as f:
+            np.save(f, np.array(organisms, dtype=np.int64))
+    with atomic_file(path / "names.json") as tmp_file:
+        with open(tmp_file, "w") as f:
+            json.dump(names, f)
+    template = phyloxml.make_template(tree)
+    with atomic_file(path / "skeleton.xml") as tmp_file:
+        with open(tmp_file, "wb") as f:
+            f.write(template.head)
+            f.write(template.tail)
+
+
+def build(phyloxml_dir:Path=PHYLOXML_PATH) -> dict[int, Level]:
+    """Parses the level files that changed since the last build, returns all levels"""
+    LEVELS_PATH.mkdir(parents=True, exist_ok=True)
+    try:
+        with open(LEVELS_PATH / "index.json") as f:
+            old_index = json.load(f)
+    except (OSError, ValueError):
+        old_index = {}
+
+    index = {}
+    for level_id, level, name, phyloxml_file in list_level_files(phyloxml_dir):
+        fingerprint = _fingerprint(phyloxml_file)
+        old_info = old_index.get(str(level_id), {})
+        if old_info.get("fingerprint") != fingerprint or old_info.get("phyloxml_file") != phyloxml_file:
+            _build_level(level_id, phyloxml_file)
+        index[str(level_id)] = {
+            "level": level,
+            "name": name,
+            "phyloxml_file": phyloxml_file,
+            "fingerprint": fingerprint,
+        }
+
+    with atomic_file(LEVELS_PATH / "index.json") as tmp_file:
+        with open(tmp_file, "w") as f:
+            json.dump(index, f)
+    return {
+        level_id: get(level_id)
+        for level_id in map(int, index)
+    }
+
+
+_loaded: dict[int, Level] = {}
+_index_mtime = None
+_load_lock = threading.Lock()
+
+def get(level_id:int) -> Level:
+    """Level from the registry, raises KeyError for unknown levels"""
+    global _index_mtime
+    with _load_lock:
+        # reload everything after a rebuild
+        mtime = os.stat(LEVELS_PATH / "index.json").st_mtime_ns
+        if mtime != _index_mtime:
+            _loaded.clear()
+            _index_mtime = mtime
+        level = _loaded.get(level_id)
+        if level is None:
+            with open(LEVELS_PATH / "index.json") as f:
+                info = json.load(f)[str(level_id)]
+            level = _loaded[level_id] = Level(level_id, info)
+    return level
@@ -0,0 +1,152 @@
+"""Lookups in the PANTHER db built by support_scripts/generate_panther_sqlite_db.sql
+
+Family tables (precomputed per PANTHER family, same statements as in the import script):
+    panther_families        PantherID -> Family name
+    panther_subfamilies     (PantherID, Subfamily) -> number of genes
+    panther_presence        (PantherID, Subfamily, Genome) for every genome with the subfamily
+
+Add them to a db built by an older version of the script:
+    python3 -m app.panther [path/to/panther.sqlite]
+
+Without the family tables the lookup falls back to the panther table.
+"""
+from contextlib import closing
+import sqlite3
+import sys
+from typing import NamedTuple, Optional
+
+PANTHERDB = "/PANTHERDB/panther.sqlite"
+# subfamilies with fewer genes aren't shown
+MIN_SUBFAMILY_GENES = 9
+
+# keep in sync with support_scripts/generate_panther_sqlite_db.sql
+FAMILY_TABLES_SQL = """
+DROP INDEX IF EXISTS gene_idx;
+CREATE INDEX IF NOT EXISTS gene_pantherid_idx ON panther (Gene, PantherID);
+
+DROP TABLE IF EXISTS panther_families;
+CREATE TABLE panther_families (
+    PantherID TEXT PRIMARY KEY,
+    Family TEXT
+) WITHOUT ROWID;
+-- family name of the first gene of the family
+INSERT INTO panther_families
+SELECT PantherID, Family
+FROM panther
+WHERE rowid IN (SELECT MIN(rowid) FROM panther GROUP BY PantherID);
+
+DROP TABLE IF EXISTS panther_subfamilies;
+CREATE TABLE panther_subfamilies (
+    PantherID TEXT NOT NULL,
+    Subfamily TEXT NOT NULL,
+    genes INTEGER NOT NULL,
+    PRIMARY KEY (PantherID, Subfamily)
+) WITHOUT ROWID;
+INSERT INTO panther_subfamilies
+SELECT PantherID, Subfamily, COUNT(*)
+FROM panther
+WHERE Subfamily IS NOT NULL
+GROUP BY PantherID, Subfamily;
+
+DROP TABLE IF EXISTS panther_presence;
+CREATE TABLE panther_presence (
+    PantherID TEXT NOT NULL,
+    Subfamily TEXT NOT NULL,
+    Genome TEXT NOT NULL,
+    PRIMARY KEY (PantherID, Subfamily, Genome)
+) WITHOUT ROWID;
+INSERT INTO panther_presence
+SELECT DISTINCT PantherID, Subfamily, Genome
+FROM panther
+WHERE Subfamily IS NOT NULL;
+"""
+
+
+class Family(NamedTuple):
+    name: Optional[str]
+    # subfamilies with at least MIN_SUBFAMILY_GENES genes, sorted
+    subfamilies: list[str]
+    # (Genome, Subfamily) for the listed subfamilies
+    presence: list[tuple[str, str]]
+
+
+def connect(path:str=PANTHERDB) -> sqlite3.Connection:
+    return sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+
+
+def has_family_tables(conn:sqlite3.Connection) -> bool:
+    return conn.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='panther_presence'"
+    ).fetchone()[0] > 0
+
+
+def _family_from_panther(conn:sqlite3.Connection, panther_id:str) -> Family:
+    rows = conn.execute("""
+        SELECT Genome, Family, Subfamily
+        FROM panther
+        WHERE PantherID = ?
+    """, (panther_id,)).fetchall()
+    genes = {}
+    presence = set()
+    for genome, _, subfamily in rows:
+        if subfamily is not None:
+            genes[subfamily] = genes.get(subfamily, 0) + 1
+            presence.add((genome, subfamily))
+    subfamilies = sorted(name for name, count in genes.items() if count >= MIN_SUBFAMILY_GENES)
+    selected = set(subfamilies)
+    return Family(
+        rows[0][1],
+        subfamilies,
+        sorted((genome, subfamily) for genome, subfamily in presence if subfamily in selected),
+    )
+
+
+def family_id(conn:sqlite3.Connection, gene:str) -> Optional[str]:
+    """PantherID of the gene, None if the gene is unknown"""
+    row = conn.execute("SELECT PantherID FROM panther WHERE Gene = ? LIMIT 1", (gene,)).fetchone()
+    return None if row is None else row[0]
+
+
+def get_family(conn:sqlite3.Connection, panther_id:str, family_tables:bool=True) -> Family:
+    if not family_tables:
+        return _family_from_panther(conn, panther_id)
+
+    name = conn.execute(
+        "SELECT Family FROM panther_families WHERE PantherID = ?", (panther_id,)
+    ).fetchone()[0]
+    subfamilies = [
+        subfamily
+        for subfamily, in conn.execute("""
+            SELECT Subfamily
+            FROM panther_subfamilies
+            WHERE PantherID = ? AND genes >= ?
+            ORDER BY Subfamily
+        """, (panther_id, MIN_SUBFAMILY_GENES))
+    ]
+    presence = conn.execute("""
+        SELECT panther_presence.Genome, panther_presence.Subfamily
+        FROM panther_subfamilies
+        JOIN panther_presence USING (PantherID, Subfamily)
+        WHERE PantherID = ? AND genes >= ?
+        ORDER BY panther_presence.Genome, panther_presence.Subfamily
+    """, (panther_id, MIN_SUBFAMILY_GENES)).fetchall()
+    return Family(name, subfamilies, presence)
+
+
+def find_family(conn:sqlite3.Connection, gene:str, family_tables:bool=True) -> Optional[Family]:
+    """Family of the gene, None if the gene is unknown"""
+    panther_id = family_id(conn, gene)
+    if panther_id is None:
+        return None
+    return get_family(conn, panther_id, family_tables)
+
+
+def build_family_tables(path:str=PANTHERDB):
+    with closing(sqlite3.connect(path)) as conn:
+        conn.executescript(FAMILY_TABLES_SQL)
+        conn.commit()
+        conn.execute("ANALYZE")
+
+
+if __name__ == "__main__":
+    build_family_tables(*sys.argv[1:2])
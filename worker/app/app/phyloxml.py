@@ -0,0 +1,159 @@
+"""Streaming writer for phyloxml trees with a heatmap
+
+The tree part of the document is static (level tree, PANTHER tree, or the tree.xml
+of the task), so it is serialized once into a TreeTemplate and copied through
+as bytes. Only the <graphs> section is generated per write, from pre-serialized
+<value> elements.
+
+Output is the same as of appending the graph to the parsed tree with
+SubElement and writing it with tree.write(f, xml_declaration=True).
+"""
+import os
+import re
+import threading
+from typing import IO, Iterable, NamedTuple, Optional
+
+from lxml import etree as ET
+
+NS = {
+    "xsi": "http://www.w3.org/2001/XMLSchema-instance",
+    "": "http://www.phyloxml.org"
+}
+
+# attribute values that lxml writes as is with the ASCII encoding
+_SAFE_ATTR = re.compile(r'[ !#-%\'-;=?-~]*\Z')
+# stands in for the phylogeny description while serializing the template
+_DESCRIPTION_MARK = "@@phyloxml-description@@"
+
+
+class TreeTemplate(NamedTuple):
+    """Serialized tree: head + description + middle + <graphs> + tail
+
+    middle is None if the description isn't replaceable, it's a part of head then
+    """
+    head: bytes
+    middle: Optional[bytes]
+    tail: bytes
+
+
+def make_template(tree:ET._ElementTree, description:bool=False) -> TreeTemplate:
+    """Serializes the tree without its <graphs> (they are removed from the tree)"""
+    root = tree.getroot()
+    for graphs in root.findall("./graphs", NS):
+        root.remove(graphs)
+    if description:
+        description_el = root.find("./phylogeny/description", NS)
+        old_description = description_el.text
+        description_el.text = _DESCRIPTION_MARK
+    doc = ET.tostring(tree, xml_declaration=True)
+    if description:
+        description_el.text = old_description
+
+    # graphs go right before the closing tag of the root element
+    root_end = doc.rindex(b"</")
+    head, tail = doc[:root_end], doc[root_end:]
+    middle = None
+    if description:
+        head, middle = head.split(_DESCRIPTION_MARK.encode())
+    return TreeTemplate(head, middle, tail)
+
+
+_templates: dict[tuple[str, bool], tuple[int, TreeTemplate]] = {}
+_templates_lock = threading.Lock()
+
+def load_template(phyloxml_file:str, description:bool=False) -> TreeTemplate:
+    """make_template of the file, cached in the process until the file changes"""
+    key = (str(phyloxml_file), description)
+    mtime = os.stat(phyloxml_file).st_mtime_ns
+    with _templates_lock:
+        cached_mtime, template = _templates.get(key, (None, None))
+        if cached_mtime != mtime:
+            parser = ET.XMLParser(remove_blank_text=True)
+            template = make_template(ET.parse(str(phyloxml_file), parser), description)
+            _templates[key] = (mtime, template)
+    return template
+
+
+def value_element(label:Optional[str], value:str) -> str:
+    """Serialized <value label="label">value</value>"""
+    if label is None:
+        return f"<value>{value}</value>"
+    if _SAFE_ATTR.match(label):
+        return f'<value label="{label}">{value}</value>'
+    el = ET.Element("value")
+    el.text = value
+    el.attrib["label"] = label
+    return ET.tostring(el, encoding="ASCII").decode()
+
+
+def value_elements(labels:list[str], value:str) -> list[str]:
+    """value_element for every label"""
+    if _SAFE_ATTR.match("".join(labels)):
+        return [f'<value label="{label}">{value}</value>' for label in labels]
+    return [value_element(label, value) for label in labels]
+
+
+def _text(text:str) -> bytes:
+    el = ET.Element("t")
+    el.text = text
+    return ET.tostring(el, encoding="ASCII")[len(b"<t>"):-len(b"</t>")]
+
+
+def write_tree(
+        f:IO[bytes], template:TreeTemplate, fields:Iterable[str], gradient_classes:int,
+        rows:Iterable[tuple[str, list[str]]], description:Optional[str]=None):
+    """Writes the tree with a heatmap graph
+
+    rows are (id of the clade, serialized <value> elements in the order of fields)
+    """
+    f.write(template.head)
+    if template.middle is not None:
+        f.write(_text(description or ""))
+        f.write(template.middle)
+    with ET.xmlfile(f, encoding="ASCII") as xf:
+        with xf.element("graphs"):
+            with xf.element("graph", type="heatmap"):
+                name = ET.Element("name")
+                name.text = "Presense"
+                xf.write(name)
+                legend = ET.Element("legend", show="1")
+                for field_name in fields:
+                    field = ET.SubElement(legend, "field")
+                    ET.SubElement(field, "name").text = field_name
+                gradient = ET.SubElement(legend, "gradient")
+                ET.SubElement(gradient, "name").text = "Custom"
+                ET.SubElement(gradient, "classes").text = str(gradient_classes)
+                xf.write(legend)
+                with xf.element("data"):
+                    xf.flush()
+                    f.writelines(
+                        f'<values for="{clade_id}">{"".join(values)}</values>'.encode()
+                        for clade_id, values in rows
+                    )
+    f.write(template.tail)
+
+
+class HeatmapTree(NamedTuple):
+    template: TreeTemplate
+    fields: list[str]
+    gradient_classes: int
+    # (id of the clade, serialized <value> elements), see write_tree
+    rows: list[tuple[str, list[str]]]
+
+
+def split_heatmap(tree:ET._ElementTree) -> HeatmapTree:
+    """Splits a tree written by write_tree into the template and the heatmap to write it again
+
+    Graphs are removed from the tree.
+    """
+    graph = tree.getroot().find("./graphs/graph", NS)
+    fields = [el.text for el in graph.iterfind("./legend/field/name", NS)]
+    gradient_classes = int(graph.findtext("./legend/gradient/classes", "2", NS))
+    rows = [
+        (
+            row.attrib["for"],
+            [value_element(el.get("label"), el.text) for el in row.iterfind("./value", NS)],
+        )
+        for row in graph.iterfind("./data/values", NS)
+    ]
+    return HeatmapTree(make_template(tree), fields, gradient_classes, rows)
@@ -1,4 +1,5 @@
 from .db import redis, raw_redis, enqueue, init_db, LEVELS, TAXID_TO_NAME
+from .cache_client import cache, CacheClient, CACHE_REDIS_URL
 
 GROUP = "worker_group"
 CONSUMER = "worker_group_consumer"
\ No newline at end of file
@@ -0,0 +1,304 @@
+"""Cache tier: /cache/* entries and their expiry index
+
+The cache lives in its own redis (CACHE_REDIS_URL) with maxmemory and an
+eviction policy, so memory pressure evicts cold entries and never touches
+tasks and queues. Without CACHE_REDIS_URL the main redis is used.
+
+Cached entries are indexed in 2 sorted sets, so expiry doesn't need to SCAN the db:
+    /cache_index/accessed   entry -> time of the last access
+    /cache_index/created    entry -> time of creation
+
+An entry is either a path, its keys are {path}/{name} for name in ENTRY_KEYS,
+or a field of a hash: {hash_key}#{field}, see hash_entry.
+Paths must not contain "#".
+
+Only the keys of path entries have a ttl, the cache redis evicts volatile keys
+only (volatile-lfu), so the index and the hashes holding many entries are kept.
+"""
+import asyncio
+import os
+from time import time
+from typing import Iterable
+
+import aioredis
+
+from .db import HOST
+from ..utils import decode_int
+
+# empty to keep the cache in the main redis
+CACHE_REDIS_URL = os.environ.get("CACHE_REDIS_URL", "").strip()
+
+_EXPIRE_SCRIPT = """
+    -- KEYS[1] - accessed index
+    -- KEYS[2] - created index
+    -- ARGV[1] - delete entries accessed before or at this time
+    -- ARGV[2] - delete entries created before or at this time
+    -- ARGV[3] - max entries to take from each index
+    -- ARGV[4:] - ENTRY_KEYS
+
+    local expired = {}
+    local seen = {}
+    local full = 0
+    for i = 1, 2 do
+        local members = redis.call('zrangebyscore', KEYS[i], '-inf', ARGV[i], 'LIMIT', 0, ARGV[3])
+        if #members == tonumber(ARGV[3]) then
+            full = 1
+        end
+        for _, member in ipairs(members) do
+            if not seen[member] then
+                seen[member] = true
+                table.insert(expired, member)
+            end
+        end
+    end
+
+    for _, member in ipairs(expired) do
+        local hash_key, field = string.match(member, '^(.*)#([^#]*)$')
+        if hash_key then
+            redis.call('hdel', hash_key, field)
+        else
+            for i = 4, #ARGV do
+                redis.call('unlink', member .. '/' .. ARGV[i])
+            end
+        end
+        redis.call('zrem', KEYS[1], member)
+        redis.call('zrem', KEYS[2], member)
+    end
+    return {#expired, full}
+"""
+
+
+
+class CacheClient():
+    """Clients of the cache tier, task modules read and write /cache/* only through it"""
+    ACCESSED_INDEX = "/cache_index/accessed"
+    CREATED_INDEX = "/cache_index/created"
+    STATS_KEY = "/cache_index/stats"
+    # set after the entries cached before the index were added to it
+    LEGACY_INDEXED_KEY = "/cache_index/legacy_indexed"
+
+    # set after the entries cached before the ttls got one
+    ENTRY_TTLS_KEY = "/cache_index/entry_ttls"
+
+    DATA_KEYS = ("data", "counts", "gene_names")
+    # keys an entry may have, accessed and created are only left by the caches before the index
+    ENTRY_KEYS = DATA_KEYS + ("accessed", "created")
+    # backstop of the expiry by age (MAX_CACHE_LIFE of the worker), makes the entries evictable
+    ENTRY_TTL = 6*30*24*60*60
+
+    def __init__(self, url:str):
+        self.redis = aioredis.from_url(url, encoding="utf-8", decode_responses=True)
+        self.raw_redis = aioredis.from_url(url, decode_responses=False)
+        self._expire_script = self.redis.register_script(_EXPIRE_SCRIPT)
+
+    async def wait(self):
+        """Waits for the cache redis to accept connections"""
+        for i in range(10):
+            try:
+                await self.redis.ping()
+                await self.raw_redis.ping()
+                break
+            except Exception:
+                if i == 9:
+                    raise
+                await asyncio.sleep(1)
+
+    def register_script(self, script:str):
+        return self.redis.register_script(script)
+
+    @staticmethod
+    def hash_entry(hash_key:str, field:str) -> str:
+        return f"{hash_key}#{field}"
+
+    def add(self, pipe, entries:Iterable[str], cur_time:int):
+        """Indexes new cache entries, creation time of the already indexed ones is kept"""
+        entries = dict.fromkeys(entries, cur_time)
+        if entries:
+            pipe.zadd(self.ACCESSED_INDEX, entries)
+            pipe.zadd(self.CREATED_INDEX, entries, nx=True)
+            self._expire_at(pipe, entries)
+
+    def _expire_at(self, pipe, entries:dict[str, int]):
+        """Sets the ttl of the path entries, entries -> creation time"""
+        for entry, created in entries.items():
+            # hashes with the entries in their fields have no ttl, the fields expire with the index
+            if "#" in entry:
+                continue
+            for name in self.DATA_KEYS:
+                pipe.expireat(f"{entry}/{name}", int(created) + self.ENTRY_TTL)
+
+    def touch(self, pipe, entries:Iterable[str], cur_time:int):
+        """Updates the access time of the indexed entries"""
+        entries = dict.fromkeys(entries, cur_time)
+        if entries:
+            pipe.zadd(self.ACCESSED_INDEX, entries, xx=True)
+
+    def delete(self, pipe, entries:Iterable[str]):
+        """Deletes path entries with their index records"""
+        entries = list(entries)
+        if entries:
+            pipe.delete(*(f"{entry}/{name}" for entry in entries for name in self.ENTRY_KEYS))
+            pipe.zrem(self.ACCESSED_INDEX, *entries)
+            pipe.zrem(self.CREATED_INDEX, *entries)
+
+    async def flush(self):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            async for item in self.redis.scan_iter(match="/cache/*"):
+                pipe.delete(item)
+            pipe.delete(self.ACCESSED_INDEX, self.CREATED_INDEX)
+            await pipe.execute()
+
+    async def expire(self, max_life_without_access:float, max_life:float, batch_size:int=500) -> dict[str, float]:
+        """Deletes expired entries in batches of at most 2*batch_size entries, returns the stats of the run"""
+        start = time()
+        cur_time = int(start)
+        expired = 0
+        batches = 0
+        full = True
+        while full:
+            batch_expired, full = await self._expire_script(
+                keys=(self.ACCESSED_INDEX, self.CREATED_INDEX),
+                args=(
+                    cur_time - int(max_life_without_access),
+                    cur_time - int(max_life),
+                    batch_size,
+                    *self.ENTRY_KEYS,
+                ),
+            )
+            expired += batch_expired
+            batches += 1
+
+        stats = {
+            "time": cur_time,
+            "entries": await self.redis.zcard(self.ACCESSED_INDEX),
+            "expired": expired,
+            "batches": batches,
+            "duration": round(time() - start, 3),
+        }
+        await self.redis.hset(self.STATS_KEY, mapping=stats)
+        return stats
+
+    async def index_legacy_entries(self) -> int:
+        """Adds the entries cached before the index to it, once
+
+        Their accessed and created keys (or hashes) are replaced by the index.
+        """
+        if await self.redis.exists(self.LEGACY_INDEXED_KEY):
+            return 0
+        count = 0
+        async for accessed_key in self.redis.scan_iter(match="/cache/*/accessed", count=1000):
+            path = accessed_key.rsplit("/", maxsplit=1)[0]
+            created_key = f"{path}/created"
+            if await self.redis.type(accessed_key) == "hash":
+                # {path}/data, {path}/accessed and {path}/created hashes with the same fields
+                accessed = await self.redis.hgetall(accessed_key)
+                created = await self.redis.hgetall(created_key)
+                entries = {
+                    self.hash_entry(f"{path}/data", field): (decode_int(value), decode_int(created.get(field), decode_int(value)))
+                    for field, value in accessed.items()
+                }
+            else:
+                accessed, created = await self.redis.mget(accessed_key, created_key)
+                if accessed is None:
+                    continue
+                accessed = decode_int(accessed)
+                entries = {path: (accessed, decode_int(created, accessed))}
+            if entries:
+                async with self.redis.pipeline(transaction=True) as pipe:
+                    pipe.zadd(self.ACCESSED_INDEX, {entry: times[0] for entry, times in entries.items()})
+                    pipe.zadd(self.CREATED_INDEX, {entry: times[1] for entry, times in entries.items()}, nx=True)
+                    pipe.unlink(accessed_key, created_key)
+                    await pipe.execute()
+            count += len(entries)
+        await self.redis.set(self.LEGACY_INDEXED_KEY, int(time()))
+        return count
+
+    async def set_entry_ttls(self, batch_size:int=1000) -> int:
+        """Gives the entries cached before the ttls their ttl from the creation time, once"""
+        if await self.redis.exists(self.ENTRY_TTLS_KEY):
+            return 0
+        count = 0
+        entries = {}
+        async for entry, created in self.redis.zscan_iter(self.CREATED_INDEX, count=batch_size):
+            entries[entry] = created
+            if len(entries) >= batch_size:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    self._expire_at(pipe, entries)
+                    await pipe.execute()
+                count += len(entries)
+                entries = {}
+        if entries:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                self._expire_at(pipe, entries)
+                await pipe.execute()
+            count += len(entries)
+        await self.redis.set(self.ENTRY_TTLS_KEY, int(time()))
+        return count
+
+    async def move_from(self, other, batch_size:int=1000) -> int:
+        """Moves the cache keys left in other redis (the main one) to the cache tier
+
+        Keys already in the cache tier win: index records and hash fields are
+        merged without overwriting, other keys that exist are kept.
+        """
+        count = 0
+        keys = []
+        async for key in other.scan_iter(match="/cache*", count=batch_size):
+            keys.append(key)
+            if len(keys) >= batch_size:
+                count += await self._move_keys(other, keys)
+                keys = []
+        if keys:
+            count += await self._move_keys(other, keys)
+        return count
+
+    async def _move_keys(self, other, keys:list[bytes]) -> int:
+        async with other.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.type(key)
+                pipe.pttl(key)
+            replies = await pipe.execute()
+        types = [key_type.decode() for key_type in replies[::2]]
+        ttls = replies[1::2]
+
+        async with other.pipeline(transaction=False) as pipe:
+            for key, key_type in zip(keys, types):
+                if key_type == "hash":
+                    pipe.hgetall(key)
+                elif key_type not in ("zset", "none"):
+                    pipe.dump(key)
+            values = iter(await pipe.execute())
+
+        count = 0
+        async with self.raw_redis.pipeline(transaction=False) as pipe:
+            for key, key_type, ttl in zip(keys, types, ttls):
+                if key_type == "none":
+                    continue
+                count += 1
+                if key_type == "zset":
+                    # the index sets are large, merged in parts
+                    await self._merge_zset(other, key, batch_size=len(keys))
+                elif key_type == "hash":
+                    for field, value in next(values).items():
+                        pipe.hsetnx(key, field, value)
+                else:
+                    pipe.restore(key, max(ttl, 0), next(values))
+            results = await pipe.execute(raise_on_error=False)
+        for res in results:
+            # restoring a key written in the cache tier already
+            if isinstance(res, Exception) and "BUSYKEY" not in str(res):
+                raise res
+        await other.unlink(*keys)
+        return count
+
+    async def _merge_zset(self, other, key:bytes, batch_size:int):
+        members = {}
+        async for member, score in other.zscan_iter(key, count=batch_size):
+            members[member] = score
+            if len(members) >= batch_size:
+                await self.raw_redis.zadd(key, members, nx=True)
+                members = {}
+        if members:
+            await self.raw_redis.zadd(key, members, nx=True)
+
+cache = CacheClient(CACHE_REDIS_URL or f"redis://{HOST}")
@@ -1,6 +1,5 @@
 import asyncio
 import os
-from pathlib import Path
 import json
 from itertools import chain
 from typing import Optional, Any
@@ -15,6 +14,8 @@ NS = {
 
 import aioredis
 
+from .. import levels
+
 
 HOST = os.environ["REDIS_HOST"]
 
@@ -97,58 +98,25 @@ async def init_db():
 
 async def init_availible_levels():
     global LEVELS
-    phyloxml_dir = Path.cwd() / "phyloxml"
-    l = []
-    for file in phyloxml_dir.glob("*.xml"):
-        items = file.stem.split("_", maxsplit=2)
-        if len(items) == 3:
-            id, level, name = items
-        elif len(items) == 2:
-            id, level = items
-            name = level
-        else:
-            raise RuntimeError(f"incorrect file name {file}")
-
-        l.append(
-            (
-                int(id),
-                level,
-                name,
-                str(file.resolve()),
-            )
-        )
-
-    l.sort()
-
-    parser = ET.XMLParser(remove_blank_text=True)
+    # parsed once here, worker processes read the registry files
+    registry = levels.build()
 
     async with redis.pipeline(transaction=False) as pipe:
         availible_levels = {}
-        for id, level, name, path in l:
-            LEVELS[id] = (level, path)
-            availible_levels[name] = id
+        for id, level in registry.items():
+            LEVELS[id] = (level.level, level.phyloxml_file)
+            availible_levels[level.name] = id
 
             # options for the gene search dropdown
-
-            tree = ET.parse(path, parser)
-            root = tree.getroot()
-
-            orgs_xml = root.xpath("//pxml:id/..", namespaces={'pxml':"http://www.phyloxml.org"})
-            # Assuming only children have IDs
             orgs = []
-            for org_xml in orgs_xml:
-                try:
-                    taxid = int(org_xml.find("id", NS).text)
-                    name = org_xml.find("name", NS).text
-                    orgs.append({
-                        'label': name,
-                        'value': taxid,
-                    })
-                    TAXID_TO_NAME[taxid] = name
-
-                except Exception:
-                    # org_id contains letters, this could happen for missing organism
-                    pass
+            for taxid, name in zip(level.organism_list(), level.names):
+                if name is None:
+                    continue
+                orgs.append({
+                    'label': name,
+                    'value': taxid,
+                })
+                TAXID_TO_NAME[taxid] = name
             orgs.sort(key=lambda x: x['label'])
             pipe.set(f"/availible_levels/{id}/search_dropdown", json.dumps(orgs))
 
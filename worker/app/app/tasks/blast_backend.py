@@ -0,0 +1,231 @@
+"""BLAST engines of the blast tasks
+
+An engine blasts a group of proteins against a group of organisms, the
+results are the pruned hits of every protein packed per taxid
+(blast_sync.pack_hits), the values stored in the cache. Proteins without
+results map to an empty dict.
+
+tasks/blast_ncbi.py searches with the NCBI web BLAST, tasks/blast_local.py
+runs blastp on a local database (BLAST_DB). Both share the submission
+sizing (BatchController) and the fair slots of the tasks (FairSemaphore).
+"""
+from abc import ABC, abstractmethod
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Hashable, Union
+
+
+class FairScheduler():
+    """Waiting owners (tasks) wake up in turns, each one in the order of its waits"""
+    def __init__(self):
+        self._waiters: dict[Hashable, deque[asyncio.Future]] = {}
+        self._order: deque[Hashable] = deque()
+
+    def wait(self, owner:Hashable) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        waiters = self._waiters.get(owner)
+        if waiters is None:
+            waiters = self._waiters[owner] = deque()
+            self._order.append(owner)
+        waiters.append(fut)
+        return fut
+
+    def has_waiters(self) -> bool:
+        return any(
+            not fut.done()
+            for waiters in self._waiters.values()
+            for fut in waiters
+        )
+
+    def wake_next(self) -> bool:
+        """Wakes the next waiter, False if nobody is waiting"""
+        while self._order:
+            owner = self._order.popleft()
+            waiters = self._waiters[owner]
+            # skipping the cancelled waits
+            while waiters and waiters[0].done():
+                waiters.popleft()
+            if not waiters:
+                del self._waiters[owner]
+                continue
+            waiters.popleft().set_result(None)
+            if waiters:
+                self._order.append(owner)
+            else:
+                del self._waiters[owner]
+            return True
+        return False
+
+
+class FairSemaphore():
+    def __init__(self, value:int):
+        self._value = value
+        self._scheduler = FairScheduler()
+
+    @asynccontextmanager
+    async def slot(self, owner:Hashable):
+        if self._value > 0 and not self._scheduler.has_waiters():
+            self._value -= 1
+        else:
+            fut = self._scheduler.wait(owner)
+            try:
+                await fut
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled():
+                    # the slot was handed over before the cancellation
+                    self._release()
+                raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self):
+        # the slot goes directly to the next waiter
+        if not self._scheduler.wake_next():
+            self._value += 1
+
+
+class BatchController():
+    """AIMD sizing of the blast submissions (proteins and organisms per search)
+
+    Sizes grow additively after fast submissions that were full while more work
+    was waiting, and shrink multiplicatively after "CPU usage limit" errors and
+    slow submissions. Shared by all tasks, NCBI limits aren't per task.
+
+    The size of the last "CPU usage limit" error is a ceiling, sizes don't grow
+    into it again until CEILING_SUBMISSIONS successful submissions later.
+    """
+    MIN_PROTS = 1
+    MAX_PROTS = 10
+    MIN_ORGANISMS = 10
+    MAX_ORGANISMS = 400
+    PROT_INCR = 1
+    ORGANISM_INCR = 20
+    DECREASE = 0.5
+    # submissions slower than this shrink the batches
+    TARGET_ELAPSED = 10*60
+    # the limit isn't fixed, it's probed again after this many successful submissions
+    CEILING_SUBMISSIONS = 20
+
+    def __init__(self, prots:int=5, organisms:int=MAX_ORGANISMS):
+        self.prots = prots
+        self.organisms = organisms
+        self.counters = {
+            "submissions": 0,
+            "cpu_limit_errors": 0,
+            "errors": 0,
+            "increases": 0,
+            "decreases": 0,
+        }
+        # (protein, organism) pairs of the last "CPU usage limit" error, 0 for none
+        self.ceiling = 0
+        self._below_ceiling = 0
+        self.last_elapsed = 0.0
+        self.last_decision = "start"
+
+    def _fits(self, prots:int, organisms:int) -> bool:
+        return not self.ceiling or prots * organisms < self.ceiling
+
+    def _decrease(self, prots:int, organisms:int, reason:str):
+        # the smallest unit is a single protein, then organisms are cut
+        if prots > self.MIN_PROTS:
+            self.prots = max(self.MIN_PROTS, min(self.prots, int(prots * self.DECREASE)))
+        else:
+            self.organisms = max(self.MIN_ORGANISMS, min(self.organisms, int(organisms * self.DECREASE)))
+        self.counters["decreases"] += 1
+        self.last_decision = f"decrease: {reason}"
+
+    def success(self, prots:int, organisms:int, elapsed:float, queue_depth:int):
+        """queue_depth is the number of proteins still waiting for a submission"""
+        self.counters["submissions"] += 1
+        self.last_elapsed = elapsed
+        if self.ceiling:
+            self._below_ceiling += 1
+            if self._below_ceiling >= self.CEILING_SUBMISSIONS:
+                self.ceiling = 0
+        if elapsed > self.TARGET_ELAPSED:
+            self._decrease(prots, organisms, "slow")
+        elif queue_depth == 0:
+            self.last_decision = "keep: no queue"
+        elif prots >= self.prots and self.prots < self.MAX_PROTS and self._fits(self.prots + self.PROT_INCR, self.organisms):
+            self.prots += self.PROT_INCR
+            self.counters["increases"] += 1
+            self.last_decision = "increase: proteins"
+        elif (organisms >= self.organisms and self.organisms < self.MAX_ORGANISMS
+                and self._fits(self.prots, min(self.MAX_ORGANISMS, self.organisms + self.ORGANISM_INCR))):
+            self.organisms = min(self.MAX_ORGANISMS, self.organisms + self.ORGANISM_INCR)
+            self.counters["increases"] += 1
+            self.last_decision = "increase: organisms"
+        else:
+            self.last_decision = "keep"
+
+    def too_large(self, prots:int, organisms:int):
+        self.counters["cpu_limit_errors"] += 1
+        # a stale larger submission doesn't raise the ceiling
+        self.ceiling = min(self.ceiling, prots * organisms) if self.ceiling else prots * organisms
+        self._below_ceiling = 0
+        self._decrease(prots, organisms, "cpu usage limit")
+
+    def failure(self):
+        # network errors and the like, sizes aren't the cause
+        self.counters["errors"] += 1
+        self.last_decision = "keep: error"
+
+    def metrics(self) -> dict[str, Union[int, float, str]]:
+        return {
+            "prots_per_request": self.prots,
+            "organisms_per_request": self.organisms,
+            "pairs_ceiling": self.ceiling,
+            "last_elapsed": round(self.last_elapsed, 1),
+            "last_decision": self.last_decision,
+            **self.counters,
+        }
+
+
+class RequestTooLargeException(Exception):
+    """The submission has to be split into smaller ones"""
+
+
+class BackendSession():
+    """Searches of one task"""
+    def __init__(self, owner:Hashable):
+        self.owner = owner
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    @asynccontextmanager
+    async def search_slot(self):
+        """Held while a search of the task runs"""
+        yield
+
+    def backoff(self, delay:float):
+        """Pauses the searches of all tasks after an error"""
+
+
+class BlastBackend(ABC):
+    def __init__(self, batch:BatchController):
+        # submission sizes, shared by all tasks
+        self.batch = batch
+
+    def session(self, owner:Hashable) -> BackendSession:
+        return BackendSession(owner)
+
+    @abstractmethod
+    async def organisms(self, sess:BackendSession, taxids:set[int], db) -> dict[int, str]:
+        """Names of the taxids used in the searches, taxids without one can't be blasted
+
+        Progress is reported to the task db.
+        """
+
+    @abstractmethod
+    async def search(self, sess:BackendSession, prot_list:list[str], organisms:list[str]) -> tuple[dict[str, dict[int, bytes]], Awaitable]:
+        """Results of every protein and an awaitable that cleans up after the results are stored
+
+        Raises RequestTooLargeException if the submission has to be smaller.
+        """
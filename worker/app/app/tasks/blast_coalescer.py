@@ -0,0 +1,155 @@
+"""Worker-wide registry of the (protein, taxid) pairs being blasted
+
+Tasks join the pairs they miss in the cache and wait for their futures. A pair
+that is already wanted by another task isn't requested again. Pairs waiting for
+a submission are pooled: whichever task submits next takes the proteins it
+waits for first and fills the rest of the submission with the pending proteins
+of the other tasks.
+"""
+import asyncio
+from typing import Optional
+
+from . import blast_sync
+
+Pair = tuple[str, int]
+
+
+class _Inflight():
+    def __init__(self):
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        # tasks waiting for the pair
+        self.refs = 0
+        self.submitted = False
+
+
+class BlastCoalescer():
+    def __init__(self):
+        self._pairs: dict[Pair, _Inflight] = {}
+        # proteins waiting for a submission -> taxids, in the order of arrival
+        self._pending: dict[str, set[int]] = {}
+        self._organisms: dict[int, str] = {}
+        self._returned: Optional[asyncio.Future] = None
+
+    def join(self, prots_to_get:dict[str, set[int]], organisms:dict[int, str]) -> dict[Pair, asyncio.Future]:
+        """Futures with the hits (None if nothing found) of every pair, leave them when done
+
+        organisms are the NCBI names of the taxids, pairs without them aren't joined.
+        """
+        self._organisms.update(organisms)
+        futures = {}
+        for prot, taxids in prots_to_get.items():
+            for taxid in taxids:
+                if taxid not in self._organisms:
+                    continue
+                pair = (prot, taxid)
+                inflight = self._pairs.get(pair)
+                if inflight is None:
+                    inflight = self._pairs[pair] = _Inflight()
+                    self._pending.setdefault(prot, set()).add(taxid)
+                inflight.refs += 1
+                futures[pair] = inflight.future
+        return futures
+
+    def leave(self, pairs):
+        """Pairs nobody waits for anymore aren't submitted"""
+        for pair in pairs:
+            inflight = self._pairs.get(pair)
+            if inflight is None:
+                continue
+            inflight.refs -= 1
+            if inflight.refs <= 0 and not inflight.submitted:
+                del self._pairs[pair]
+                inflight.future.cancel()
+                self._remove_pending(pair)
+
+    def has_pending(self, pairs) -> bool:
+        return any(
+            taxid in self._pending.get(prot, ())
+            for prot, taxid in pairs
+        )
+
+    def take(self, wanted:set[str], max_prots:int, max_organisms:int) -> dict[str, set[int]]:
+        """Takes pending pairs for a submission: up to max_prots proteins and max_organisms taxids in total
+
+        Proteins in wanted go first, then the ones of the other tasks in the order of arrival.
+        Taxids that don't fit stay in the pool.
+        """
+        prots = [prot for prot in self._pending if prot in wanted]
+        if not prots:
+            return {}
+        prots.extend(prot for prot in self._pending if prot not in wanted)
+
+        chunk = {}
+        organisms = set()
+        for prot in prots:
+            if len(chunk) >= max_prots:
+                break
+            pending = self._pending[prot]
+            # taxids already in the submission are free
+            taxids = pending & organisms
+            for taxid in sorted(pending - organisms):
+                if len(organisms) >= max_organisms:
+                    break
+                taxids.add(taxid)
+                organisms.add(taxid)
+            if not taxids:
+                continue
+            chunk[prot] = taxids
+            pending -= taxids
+            if not pending:
+                del self._pending[prot]
+            for taxid in taxids:
+                self._pairs[(prot, taxid)].submitted = True
+        return chunk
+
+    def queue_depth(self) -> int:
+        """Proteins waiting for a submission"""
+        return len(self._pending)
+
+    def returned(self) -> asyncio.Future:
+        """Resolved when pairs of a failed submission get back to the pool"""
+        if self._returned is None or self._returned.done():
+            self._returned = asyncio.get_running_loop().create_future()
+        return self._returned
+
+    def organisms(self, chunk:dict[str, set[int]]) -> dict[int, str]:
+        return {
+            taxid: self._organisms[taxid]
+            for taxids in chunk.values()
+            for taxid in taxids
+        }
+
+    def done(self, chunk:dict[str, set[int]], blasted:dict[str, dict[int, Optional[blast_sync.Hits]]]):
+        for prot, taxids in chunk.items():
+            for taxid in taxids:
+                inflight = self._pairs.pop((prot, taxid), None)
+                if inflight is not None and not inflight.future.done():
+                    inflight.future.set_result(blasted.get(prot, {}).get(taxid))
+
+    def failed(self, chunk:dict[str, set[int]]):
+        """Returns the pairs of a failed submission to the pool"""
+        for prot, taxids in chunk.items():
+            for taxid in taxids:
+                inflight = self._pairs.get((prot, taxid))
+                if inflight is None:
+                    continue
+                if inflight.refs <= 0:
+                    del self._pairs[(prot, taxid)]
+                    inflight.future.cancel()
+                    continue
+                inflight.submitted = False
+                self._pending.setdefault(prot, set()).add(taxid)
+        if self._returned is not None and not self._returned.done():
+            self._returned.set_result(None)
+
+    def _remove_pending(self, pair:Pair):
+        prot, taxid = pair
+        taxids = self._pending.get(prot)
+        if taxids is None:
+            return
+        taxids.discard(taxid)
+        if not taxids:
+            del self._pending[prot]
+
+
+coalescer = BlastCoalescer()
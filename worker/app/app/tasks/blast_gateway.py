@@ -0,0 +1,145 @@
+"""Worker-wide access to NCBI BLAST shared by all blast tasks
+
+All requests go through one pooled httpx client (cookies are fetched once) and
+a token bucket, searches in flight are limited by a semaphore. Both hand out
+their tokens and slots to the waiting tasks in turns, so a large request
+doesn't starve the smaller ones.
+"""
+import asyncio
+import time
+from typing import Hashable, Optional
+
+import httpx
+
+from ..utils import NCBI_URL
+from .blast_backend import BatchController, FairScheduler, FairSemaphore
+
+BLAST_URL = f"{NCBI_URL}/Blast.cgi"
+
+# requests to NCBI per second over all tasks, and the burst allowed after a pause
+REQUESTS_PER_SECOND = 1.0
+REQUESTS_BURST = 5
+# blast searches running on NCBI at the same time over all tasks
+MAX_SEARCHES = 4
+MAX_CONNECTIONS = 8
+
+
+class RateLimiter():
+    """Token bucket with fair dispatch of the tokens"""
+    def __init__(self, rate:float, burst:int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._scheduler = FairScheduler()
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    async def acquire(self, owner:Hashable):
+        fut = self._scheduler.wait(owner)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await fut
+
+    def pause(self, delay:float):
+        """No tokens for everyone for delay seconds"""
+        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+
+    async def _dispatch(self):
+        while self._scheduler.has_waiters():
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                continue
+            if self._scheduler.wake_next():
+                self._tokens -= 1
+
+
+class BlastGateway():
+    def __init__(self, rate:float=REQUESTS_PER_SECOND, burst:int=REQUESTS_BURST, max_searches:int=MAX_SEARCHES):
+        self.limiter = RateLimiter(rate, burst)
+        self.searches = FairSemaphore(max_searches)
+        self.batch = BatchController()
+        self.counters = {
+            "requests": 0,
+            "retries": 0,
+        }
+        self._client: Optional[httpx.AsyncClient] = None
+        self._client_task: Optional[asyncio.Task] = None
+
+    async def _new_client(self, owner:Hashable) -> httpx.AsyncClient:
+        client = httpx.AsyncClient(
+            timeout=3*60,
+            limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS),
+        )
+        try:
+            # getting cookies
+            await self.limiter.acquire(owner)
+            resp = await client.get(BLAST_URL, params={
+                "PROGRAM": "blastp",
+                "PAGE_TYPE": "BlastSearch",
+                "LINK_LOC": "blasthome",
+            })
+            resp.raise_for_status()
+        except BaseException:
+            await client.aclose()
+            raise
+        self._client = client
+        return client
+
+    async def client(self, owner:Hashable) -> httpx.AsyncClient:
+        if self._client is not None:
+            return self._client
+        # a finished task without a client has failed, trying again
+        if self._client_task is None or self._client_task.done():
+            self._client_task = asyncio.create_task(self._new_client(owner))
+        return await asyncio.shield(self._client_task)
+
+    async def request(self, owner:Hashable, method:str, url:str, **kwargs) -> httpx.Response:
+        client = await self.client(owner)
+        await self.limiter.acquire(owner)
+        self.counters["requests"] += 1
+        return await client.request(method, url, **kwargs)
+
+    def session(self, owner:Hashable) -> "BlastSession":
+        return BlastSession(self, owner)
+
+    async def aclose(self):
+        if self._client is not None:
+            client, self._client, self._client_task = self._client, None, None
+            await client.aclose()
+
+
+class BlastSession():
+    """Requests of one task, same interface as httpx.AsyncClient.get/post"""
+    def __init__(self, gateway:BlastGateway, owner:Hashable):
+        self.gateway = gateway
+        self.owner = owner
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def get(self, url:str, **kwargs) -> httpx.Response:
+        return await self.gateway.request(self.owner, "GET", url, **kwargs)
+
+    async def post(self, url:str, **kwargs) -> httpx.Response:
+        return await self.gateway.request(self.owner, "POST", url, **kwargs)
+
+    def search_slot(self):
+        """Held while a search of the task runs on NCBI"""
+        return self.gateway.searches.slot(self.owner)
+
+    def backoff(self, delay:float):
+        """Stops the requests of all tasks for delay seconds (NCBI limits are per IP)"""
+        self.gateway.limiter.pause(delay)
+
+
+gateway = BlastGateway()
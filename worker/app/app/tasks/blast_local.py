@@ -0,0 +1,157 @@
+"""Searches with blastp on a local database (BLAST_DB)
+
+Every protein of a search is blasted against parts of the taxids, each
+(protein, taxids) shard is a separate blastp process with its own -taxidlist.
+Shards of all tasks share the cores, the tabular output of every shard is
+pruned as it arrives, so only the non-dominated hits are kept in memory.
+"""
+import asyncio
+import os
+from tempfile import NamedTemporaryFile
+from typing import Hashable, Optional
+
+import httpx
+import pandas as pd
+
+from . import blast_sync, blast_local_sync
+from .blast_backend import BlastBackend, BackendSession, BatchController, FairSemaphore
+
+BLASTP = "blastp"
+BLASTDBCMD = "blastdbcmd"
+UNIPROT_URL = "https://rest.uniprot.org/uniprotkb"
+
+THREADS_PER_SHARD = 4
+MAX_SHARDS = max(1, (os.cpu_count() or 1) // THREADS_PER_SHARD)
+# taxid lists aren't split further, blastp startup isn't worth it
+MIN_TAXIDS_PER_SHARD = 50
+# tabular output is pruned in parts of this size
+STREAM_CHUNK = 4 * 2**20
+
+# same search parameters as the NCBI web BLAST request (see blast_ncbi.do_blast_request)
+SEARCH_ARGS = (
+    "-evalue", "1e-8",
+    "-max_target_seqs", "5000",
+    "-max_hsps", "1",
+    "-matrix", "BLOSUM62",
+    "-gapopen", "11",
+    "-gapextend", "1",
+    "-word_size", "6",
+    "-comp_based_stats", "2",
+)
+# blastp fails if none of the taxids are in the database
+NO_TAXIDS_ERROR = b"Taxonomy ID(s) not found"
+
+
+class LocalBatchController(BatchController):
+    # proteins and taxids are split into shards, large submissions just keep more cores busy
+    MAX_PROTS = max(MAX_SHARDS, BatchController.MAX_PROTS)
+    MAX_ORGANISMS = 5000
+
+
+def plan_shards(prot_list:list[str], taxids:list[int], max_shards:int=MAX_SHARDS) -> list[tuple[str, list[int]]]:
+    """(protein, taxids) of every blastp run, taxids are split if there are less proteins than shards"""
+    parts = max(1, min(max_shards // max(len(prot_list), 1), len(taxids) // MIN_TAXIDS_PER_SHARD))
+    taxids = sorted(taxids)
+    return [
+        (prot, taxids[part::parts])
+        for prot in prot_list
+        for part in range(parts)
+    ]
+
+
+class LocalBackend(BlastBackend):
+    def __init__(self, db:str, max_shards:int=MAX_SHARDS):
+        super().__init__(LocalBatchController(prots=max_shards, organisms=LocalBatchController.MAX_ORGANISMS))
+        self.db = db
+        self.max_shards = max_shards
+        self.shards = FairSemaphore(max_shards)
+
+    async def organisms(self, sess:BackendSession, taxids:set[int], db) -> dict[int, str]:
+        # blastp takes the taxids as they are
+        return {taxid: str(taxid) for taxid in taxids}
+
+    async def query_fasta(self, prot:str) -> Optional[str]:
+        """Sequence from the database, UniProt if it isn't there. None if there is none"""
+        proc = await asyncio.create_subprocess_exec(
+            BLASTDBCMD, "-db", self.db, "-entry", prot, "-outfmt", "%f",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        fasta, _ = await proc.communicate()
+        if proc.returncode == 0 and fasta.strip():
+            return fasta.decode()
+
+        async with httpx.AsyncClient(timeout=60) as client:
+            resp = await client.get(f"{UNIPROT_URL}/{prot}.fasta")
+        if resp.status_code in (400, 404):
+            return None
+        resp.raise_for_status()
+        return resp.text if resp.text.strip() else None
+
+    async def run_shard(self, owner:Hashable, fasta:str, taxids:list[int]) -> dict[int, bytes]:
+        async with self.shards.slot(owner):
+            with (NamedTemporaryFile("w", suffix=".req_file.fa") as req_f,
+                NamedTemporaryFile("w", suffix=".taxids") as taxids_f):
+                await blast_sync.write_blast_files(req_f, fasta, taxids_f, taxids)
+                proc = await asyncio.create_subprocess_exec(
+                    BLASTP,
+                    "-query", req_f.name,
+                    "-taxidlist", taxids_f.name,
+                    "-db", self.db,
+                    "-outfmt", blast_local_sync.OUTFMT,
+                    "-num_threads", str(THREADS_PER_SHARD),
+                    *SEARCH_ARGS,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+                try:
+                    # warnings are read along, a full stderr pipe would stop blastp
+                    stderr = asyncio.create_task(proc.stderr.read())
+                    pruned: dict[int, pd.DataFrame] = {}
+                    taxid_set = set(taxids)
+                    tail = b''
+                    while data := await proc.stdout.read(STREAM_CHUNK):
+                        data = tail + data
+                        end = data.rfind(b'\n') + 1
+                        tail = data[end:]
+                        if end:
+                            pruned = await blast_local_sync.prune_tabular(data[:end], taxid_set, pruned)
+                    if tail:
+                        pruned = await blast_local_sync.prune_tabular(tail, taxid_set, pruned)
+                    return_code = await proc.wait()
+                    stderr = await stderr
+                except BaseException:
+                    if proc.returncode is None:
+                        proc.kill()
+                        await proc.wait()
+                    raise
+
+        if return_code != 0:
+            if NO_TAXIDS_ERROR in stderr:
+                return {}
+            raise RuntimeError(f"blastp exited with {return_code}: {stderr.decode(errors='replace').strip()}")
+        return await blast_local_sync.pack_pruned(pruned)
+
+    async def search(self, sess:BackendSession, prot_list:list[str], organisms:list[str]):
+        taxids = [int(org) for org in organisms]
+        fastas = dict(zip(prot_list, await asyncio.gather(*map(self.query_fasta, prot_list))))
+        shards = plan_shards([prot for prot in prot_list if fastas[prot]], taxids, self.max_shards)
+
+        tasks = [
+            asyncio.create_task(self.run_shard(sess.owner, fastas[prot], shard_taxids))
+            for prot, shard_taxids in shards
+        ]
+        try:
+            results = await asyncio.gather(*tasks)
+        finally:
+            # the rest of the shards is useless if one fails
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        prot_2_data = {prot: {} for prot in prot_list}
+        for (prot, _), res in zip(shards, results):
+            # taxids of the shards don't overlap
+            prot_2_data[prot].update(res)
+        # nothing to clean up
+        return prot_2_data, asyncio.sleep(0)
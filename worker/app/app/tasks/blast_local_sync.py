@@ -0,0 +1,48 @@
+import io
+
+import numpy as np
+import pandas as pd
+
+from ..async_executor import async_pool
+from . import blast_sync
+
+# blastp -outfmt, fields in the order of blast_sync.COLS,
+# staxids lists all taxids of the merged (identical) sequences of nr
+OUTFMT = "6 staxids evalue pident qcovs saccver"
+
+
+def read_tabular(data: bytes, taxids: set[int]) -> pd.DataFrame:
+    """Hits (blast_sync.COLS) of the taxids in a part of the tabular output"""
+    df = pd.read_csv(
+        io.BytesIO(data),
+        sep='\t', header=None, names=blast_sync.COLS.keys(), engine="c",
+        dtype={**blast_sync.COLS, 'taxid': str},
+    )
+    df['taxid'] = df['taxid'].str.split(';')
+    df = df.explode('taxid', ignore_index=True)
+    df['taxid'] = df['taxid'].astype(np.uint32)
+    return df[df['taxid'].isin(taxids)]
+
+
+@async_pool.in_thread(max_running=6)
+def prune_tabular(data: bytes, taxids: set[int], pruned: dict[int, pd.DataFrame]) -> dict[int, pd.DataFrame]:
+    """Adds the hits of a part of the tabular output to the pruned hits of every taxid
+
+    Pruning is repeated on the kept hits and the new part, so the result is the same
+    as pruning the whole output at once.
+    """
+    df = blast_sync.prepare_hits(read_tabular(data, taxids))
+    if df.empty:
+        return pruned
+    return blast_sync.prune_hits(pd.concat(
+        [hits.assign(taxid=taxid) for taxid, hits in pruned.items()] + [df],
+        ignore_index=True,
+    ))
+
+
+@async_pool.in_thread()
+def pack_pruned(pruned: dict[int, pd.DataFrame]) -> dict[int, bytes]:
+    return {
+        taxid: blast_sync.pack_hits(hits)
+        for taxid, hits in pruned.items()
+    }
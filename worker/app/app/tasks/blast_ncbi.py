@@ -0,0 +1,421 @@
+"""Searches with the NCBI web BLAST
+
+The results pages are scraped, requests go through blast_gateway.
+"""
+import asyncio
+from functools import partial, wraps
+import traceback
+from typing import Optional
+import re
+
+import json
+import hashlib
+
+from urllib.parse import urlencode
+
+from ..task_manager import ReportErrorException
+from ..utils import NCBI_URL
+from ..redis import cache
+from . import blast_sync
+from .blast_backend import BlastBackend, RequestTooLargeException
+from .blast_gateway import gateway, BlastSession, BLAST_URL
+
+DELAY_RE = re.compile(rb'var tm = "(\d+)"')
+SUGGEST_RE = re.compile(rb'new Array\("([^@]+)')
+PROT_CODE_RE = re.compile(r'sp\|([A-Z0-9]+)')
+
+MAX_ATTEMPTS = 12
+MAX_ELAPSED = "00:30:00" # max time a request can chill in NCBI waitng screen
+MAX_NCBI_STATUS_REFRESHES = 1000
+
+
+def retry(func=None, max_delay_length=60, start_delay=0.1):
+    if func is None:
+        return partial(retry, max_delay_length=max_delay_length, start_delay=start_delay)
+    else:
+        @wraps(func)
+        async def repeater(*args, **kwargs):
+            delay = start_delay
+            for attempt in range(1, MAX_ATTEMPTS+1):
+                try:
+                    return await func(*args, **kwargs)
+                except ReportErrorException:
+                    raise
+                except Exception as e:
+                    if attempt == MAX_ATTEMPTS:
+                        raise ReportErrorException("Retry limit exceeded") from e
+                    gateway.counters["retries"] += 1
+                    print(f"Request retry #{attempt}, exception:")
+                    traceback.print_exc()
+                    await asyncio.sleep(delay)
+                    if delay<max_delay_length:
+                        delay = min(delay * 2, max_delay_length)
+        return repeater
+
+class NcbiWebApi():
+    """Steps of a search on the NCBI web BLAST, each one returns the raw page
+
+    NCBI_URL can point to a fake server (benchmarks/fake_ncbi.py).
+    """
+    def __init__(self, sess:BlastSession):
+        self.sess = sess
+
+    async def _get(self, url:str, **kwargs) -> bytes:
+        resp = await self.sess.get(url, **kwargs)
+        # error pages would be parsed as searches without results
+        resp.raise_for_status()
+        return resp.content
+
+    async def _post(self, url:str, **kwargs) -> bytes:
+        resp = await self.sess.post(url, **kwargs)
+        resp.raise_for_status()
+        return resp.content
+
+    async def submit(self, request_data:dict[str, str]) -> bytes:
+        return await retry(self._post)(BLAST_URL,
+            data=request_data,
+            files={
+                'QUERYFILE': ('', b'', 'application/octet-stream'),
+                'SUBJECTFILE': ('', b'', 'application/octet-stream'),
+                'PSSM': ('', b'', 'application/octet-stream'),
+            },
+        )
+
+    async def resume(self, req_id:str) -> bytes:
+        """Status or the results of a submitted search"""
+        return await retry(self._get)(
+            BLAST_URL,
+            params={
+                "RID": req_id,
+                "CMD": "Get",
+            }
+        )
+
+    async def poll(self, params:dict[str, str]) -> bytes:
+        """Sends the form of the status page"""
+        return await retry(self._post)(
+            BLAST_URL,
+            data=urlencode(params),
+        )
+
+    async def fetch_page(self, params:dict[str, str], query_index:str) -> bytes:
+        """Results of another protein, params are the ones of the last results page"""
+        params = {
+            **params,
+            # choosing next item from the list
+            "QUERY_INDEX": query_index,
+            # max rows for the table
+            "DESCRIPTIONS": "5000",
+        }
+        return await retry(self._post)(
+            BLAST_URL,
+            data=urlencode(params),
+        )
+
+    async def delete(self, req_id:str):
+        content = await retry(self._get)(f"{BLAST_URL}?CMD=GetSaved&RECENT_RESULTS=on")
+        del_link = await blast_sync.find_saved_request_delete_link(content, req_id)
+        if del_link:
+            await retry(self._get)(f'{NCBI_URL}/{del_link}')
+
+    async def organism_name(self, taxid:int) -> Optional[str]:
+        content = await retry(self._get)(f"{NCBI_URL}/portal/utils/autocomp.fcgi", params={
+            "dict": "blast_nr_prot_sg",
+            "q": f"taxid:{taxid}",
+        })
+        match = SUGGEST_RE.search(content)
+        return match.group(1).decode() if match else None
+
+
+async def do_blast_request(api:NcbiWebApi, prot_list, organisms):
+    """performs one search and extracts the data for all proteins"""
+    request_data = {
+        "ADV_VIEW": "on",
+        "ALIGNMENT_VIEW": "Pairwise",
+        "ALIGNMENTS": "100",
+        "BLAST_PROGRAMS": "blastp",
+        "BLAST_SPEC": "",
+        "CDD_SEARCH": "on",
+        "CHECKSUM": "",
+        "CLIENT": "web",
+        "CMD": "request",
+        "COMPOSITION_BASED_STATISTICS": "2",
+        "CONFIG_DESCR": "2,3,6,7,8,9,10,11,12",
+        "DATABASE": "nr",
+        "DB_DIR_PREFIX": "",
+        "DB_DISPLAY_NAME": "nr",
+        "db": "protein",
+        "DESCRIPTIONS": "5000",
+        "DI_THRESH": "",
+        "EQ_TEXT": "",
+        "EXPECT_HIGH": "",
+        "EXPECT_LOW": "",
+        "EXPECT": "0.00000001",
+        "FORMAT_EQ_TEXT": "",
+        "FORMAT_NUM_ORG": "1",
+        "FORMAT_OBJECT": "Alignment",
+        "FORMAT_ORGANISM": "",
+        "FORMAT_TYPE": "HTML",
+        "GAPCOSTS": "11 1",
+        "GENETIC_CODE": "1",
+        "GET_SEQUENCE": "on",
+        "HSP_RANGE_MAX": "0",
+        "I_THRESH": "",
+        "ID_FOR_PSSM": "",
+        "LINE_LENGTH": "60",
+        "MASK_CHAR": "2",
+        "MASK_COLOR": "1",
+        "MATCH_SCORES": "1,-2",
+        "MATRIX_NAME": "BLOSUM62",
+        "MAX_NUM_SEQ": "5000", # Max items to find
+        "MEGABLAST": "",
+        "MIXED_DATABASE": "",
+        "NCBI_GI": "",
+        "NEW_VIEW": "on",
+        "NO_COMMON": "",
+        "NUM_DIFFS": "2",
+        "NUM_OPTS_DIFFS": "2",
+        "NUM_OVERVIEW": "100",
+        "ORG_DBS": "giless_dbvers5",
+        "PAGE_TYPE": "BlastSearch",
+        "PAGE": "Proteins",
+        "PERC_IDENT_HIGH": "",
+        "PERC_IDENT_LOW": "",
+        "PHI_PATTERN": "",
+        "PROGRAM": "blastp",
+        "PSI_PSEUDOCOUNT": "",
+        "QUERY_BELIEVE_DEFLINE": "",
+        "QUERY_FROM": "",
+        "QUERY_INDEX": "0",
+        "QUERY_TO": "",
+        "REPEATS": "566037",
+        "RUN_PSIBLAST": "",
+        "SAVED_PSSM": "",
+        "SAVED_SEARCH": "",
+        "SELECTED_PROG_TYPE": "blastp",
+        "SERVICE": "plain",
+        "SHORT_QUERY_ADJUST": "on",
+        "SHOW_CDS_FEATURE": "",
+        "SHOW_LINKOUT": "on",
+        "SHOW_OVERVIEW": "on",
+        "stype": "protein",
+        "SUBJECTS_FROM": "",
+        "SUBJECTS_TO": "",
+        "SUBJECTS": "",
+        "TEMPLATE_LENGTH": "0",
+        "TEMPLATE_TYPE": "0",
+        "TWO_HITS": "",
+        "UNIQ_DEFAULTS_NAME": "",
+        "USER_DATABASE": "",
+        "USER_DEFAULT_MATRIX": "4",
+        "USER_DEFAULT_PROG_TYPE": "blastp",
+        "USER_FORMAT_DEFAULTS": "",
+        "USER_MATCH_SCORES": "",
+        "USER_WORD_SIZE": "",
+        "WORD_SIZE": "6",
+        "WWW_BLAST_TYPE": "",
+    }
+
+    request_data["NUM_ORG"] = str(len(organisms))
+    request_data["EQ_MENU"] = organisms[0]
+    for i, org_name in enumerate(organisms[1:], 1):
+        request_data[f"EQ_MENU{i}"] = org_name
+
+    request_data["QUERY"] = '\n'.join(prot_list)
+    request_data["JOB_TITLE"] = f"Blast search job for {';'.join(prot_list)}"
+
+    # request continuation mechanism:
+    req_hash = hashlib.sha256(json.dumps(request_data, sort_keys=True).encode()).hexdigest()
+
+    from_cache = False
+    deleter = None
+    try:
+        ncbi_request_id = await cache.redis.get(f"/cache/ongoing_blast_requests/{req_hash}")
+
+        if ncbi_request_id:
+            # get the page from results
+            content = await api.resume(ncbi_request_id)
+            from_cache = True
+            deleter = ncbi_delete_req(None, ncbi_request_id, req_hash)
+            print(f"Request continuation on {ncbi_request_id}")
+        else:
+            # Send request
+            content = await api.submit(request_data)
+
+        # Update status
+        for req_no in range(MAX_NCBI_STATUS_REFRESHES):
+            page = await blast_sync.parse_status_page(content)
+
+            # Check errors
+            if page.errors:
+                print(page.errors)
+                error_msg = '; '.join(page.errors)
+                if "CPU usage limit was exceeded" in error_msg:
+                    raise RequestTooLargeException()
+                raise RuntimeError(error_msg)
+
+            # Get wait data
+            if page.stat_info is None:
+                # probably finished
+                break
+
+            # extract parameters form the page
+            params = page.params
+
+            if not from_cache and req_no == 0:
+                ncbi_request_id = params["RID"].strip()
+                deleter = ncbi_delete_req(api, ncbi_request_id, req_hash)
+                await cache.redis.set(
+                    f"/cache/ongoing_blast_requests/{req_hash}",
+                    ncbi_request_id,
+                    ex=24*60*60, # 1 day, less than ncbi expiery
+                )
+
+            # extract delay from the page
+            delay_match = DELAY_RE.search(content)
+            if delay_match:
+                delay = int(delay_match.group(1))//1000
+            else:
+                if req_no == 0:
+                    delay = 1
+                else:
+                    print("can't find delay")
+                    delay = 10
+            delay = max(delay, 1)
+
+            rows = page.stat_info
+            status = rows[1][-1]
+            elapsed = rows[-1][-1]
+            if elapsed > MAX_ELAPSED:
+                raise RuntimeError(f"Request takes more than {MAX_ELAPSED}")
+
+            print(
+                f'Blast request {ncbi_request_id}: '
+                f'status: {status}; '
+                f'elapsed: {elapsed}; '
+                f'refresh in: {delay}'
+            )
+            await asyncio.sleep(delay)
+
+            content = await api.poll(params)
+        else:
+            # no break -> 1000 requests without result
+            raise RuntimeError(f"Request took over {MAX_NCBI_STATUS_REFRESHES}")
+
+        if not page.queries:
+            # neither the status nor the results, caching it would leave the proteins without hits
+            raise RuntimeError("Unexpected page: no search status and no queries")
+
+        # search finished, parsing results
+        prot_2_data = {}
+        prot_pages = []
+
+        for text, value, classes, selected in page.queries:
+            match = PROT_CODE_RE.search(text)
+
+            if not match:
+                continue
+            prot_id = match.group(1)
+
+            if 'nohits' in classes:
+                # empty page
+                continue
+
+            if selected:
+                prot_2_data[prot_id], params = await blast_sync.extract_table_data(content)
+                del content
+            else:
+                prot_pages.append((prot_id, value))
+
+        del page
+
+        for prot_id, opt_id in prot_pages:
+            content = await api.fetch_page(params, opt_id)
+            prot_2_data[prot_id], params = await blast_sync.extract_table_data(content)
+
+
+        # delete result to be nice to ncbi
+
+        # fill any missing proteins from request (empty pages or errors(?))
+        for prot in prot_list:
+            if prot not in prot_2_data:
+                prot_2_data[prot] = {}
+
+    except Exception:
+        if deleter is not None:
+            await deleter
+        raise
+    # finished at the first page: no RID and nothing to clean up
+    return prot_2_data, deleter if deleter is not None else asyncio.sleep(0)
+
+
+
+
+async def ncbi_delete_req(api:Optional[NcbiWebApi], req_id, req_hash):
+    try:
+        await cache.redis.delete(f"/cache/ongoing_blast_requests/{req_hash}")
+        if api is None:
+            return
+        await api.delete(req_id)
+    except Exception:
+        # best-effort task, swallowing exceptions
+        print("Error while deleting the request (non-critical)")
+        traceback.print_exc()
+
+
+async def get_ncbi_taxids_from_cache(taxids_to_get):
+    if not taxids_to_get:
+        return {}
+    taxids_to_get_list = list(taxids_to_get)
+    values = await cache.redis.hmget("/cache/taxids-for-blast", taxids_to_get_list)
+
+    res = {}
+    for taxid, org_name in zip(taxids_to_get_list, values):
+        if org_name is None:
+            continue
+        if isinstance(org_name, bytes):
+            org_name = org_name.decode()
+        res[taxid] = org_name
+    return res
+
+
+class NcbiBackend(BlastBackend):
+    def __init__(self):
+        super().__init__(gateway.batch)
+
+    def session(self, owner) -> BlastSession:
+        # connection, rate limit and running searches are shared with the other blast tasks
+        return gateway.session(owner)
+
+    async def organisms(self, sess:BlastSession, taxids:set[int], db) -> dict[int, str]:
+        taxid_to_organism = await get_ncbi_taxids_from_cache(taxids)
+        taxids_to_get = taxids - taxid_to_organism.keys()
+        if not taxids_to_get:
+            return taxid_to_organism
+
+        # get ncbi tax names from the taxid number
+        db.report_progress(
+            current=0,
+            total=len(taxids_to_get),
+            message="Getting organisms",
+        )
+
+        api = NcbiWebApi(sess)
+        async with cache.redis.pipeline(transaction=False) as pipe:
+            for taxid in taxids_to_get:
+                org_name = await api.organism_name(taxid)
+                if org_name is None:
+                    print(f"no result for taxid {taxid}")
+                    db.report_progress(total_delta=-1)
+                    continue
+                db.report_progress(current_delta=1)
+
+                taxid_to_organism[taxid] = org_name
+
+                pipe.hset("/cache/taxids-for-blast", taxid, org_name)
+
+            await pipe.execute()
+        return taxid_to_organism
+
+    async def search(self, sess:BlastSession, prot_list:list[str], organisms:list[str]):
+        return await do_blast_request(NcbiWebApi(sess), prot_list, organisms)
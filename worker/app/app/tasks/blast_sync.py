@@ -1,13 +1,16 @@
 from collections import defaultdict
+import io
+from typing import NamedTuple, Optional
 
 import pandas as pd
 import numpy as np
 
 from lxml import etree as ET
-from bs4 import BeautifulSoup
+import lxml.html
 
 from ..async_executor import async_pool
 from ..utils import open_existing
+from .. import phyloxml
 
 
 ET.register_namespace("xsi", "http://www.w3.org/2001/XMLSchema-instance")
@@ -41,7 +44,7 @@ def load_data(phyloxml_file:str, og_file:str):
             if el.text == "0":
                 to_blast[prot].append(taxid)
 
-    return to_blast, name_2_prot, name_to_idx, tree
+    return to_blast, name_2_prot, name_to_idx, phyloxml.split_heatmap(tree)
 
 @async_pool.in_thread()
 def write_blast_files(req_f, req, taxids_f, taxids):
@@ -61,93 +64,305 @@ COLS = {
     'id'    : pd.StringDtype(),
 }
 DF_COLS = tuple(COLS.keys())[1:]
-def parse_page(raw_content: bytes):
-    soup = BeautifulSoup(raw_content, 'html.parser')
+PAGE_COLUMNS = ("Taxid", "E value", "Per. Ident", "Query Cover", "Accession")
 
-    form = soup.find("form", id="results")
-    params = {}
-    for inp in form.find_all("input"):
-        if 'name' in inp.attrs and 'value' in inp.attrs:
-            params[inp['name']] = inp['value']
-
-    columns_to_extract = {
-        "Taxid": None,
-        "E value": None,
-        "Per. Ident": None,
-        "Query Cover": None,
-        "Accession": None,
-    }
+def _text(el) -> str:
+    return "".join(el.itertext())
 
-    table = soup.find("table", id="dscTable")
-    header = table.find("thead").find("tr").find_all("th")
-    for idx, col in enumerate(header):
-        col_name = col.text.strip()
-        if col_name in columns_to_extract:
-            columns_to_extract[col_name] = idx
+def _drop_row(row):
+    # rows are processed on their end event, nothing references them afterwards
+    row.clear()
+    parent = row.getparent()
+    if parent is not None:
+        while row.getprevious() is not None:
+            del parent[0]
 
-    columns_to_extract = tuple(columns_to_extract.values())
+def parse_page(raw_content: bytes):
+    """Extracts hits from dscTable and inputs of the "results" form
 
-    if None in columns_to_extract:
+    Streams the page and drops table rows as soon as they are parsed,
+    the rest of the page (alignments) is not read after both elements are closed
+    """
+    params = {}
+    columns_to_extract = None
+    data = tuple([] for _ in PAGE_COLUMNS)
+
+    form = None
+    form_done = False
+    table = None
+    table_done = False
+
+    for event, el in ET.iterparse(
+        io.BytesIO(raw_content),
+        events=("start", "end"),
+        tag=("form", "input", "table", "tr"),
+        html=True,
+        recover=True,
+    ):
+        if event == "start":
+            if el.tag == "input":
+                if form is not None and not form_done and 'name' in el.attrib and 'value' in el.attrib:
+                    params[el.attrib['name']] = el.attrib['value']
+            elif el.tag == "form":
+                if form is None and el.get("id") == "results":
+                    form = el
+            elif el.tag == "table":
+                if table is None and el.get("id") == "dscTable":
+                    table = el
+            continue
+
+        if el.tag == "tr":
+            if table is not None and not table_done and next(el.iterancestors("table"), None) is table:
+                if columns_to_extract is None:
+                    header = [_text(th).strip() for th in el.iter("th")]
+                    if header:
+                        columns_to_extract = tuple(
+                            header.index(col) if col in header else None
+                            for col in PAGE_COLUMNS
+                        )
+                        if None in columns_to_extract:
+                            raise RuntimeError("Missing columns!")
+                else:
+                    tds = list(el.iter("td"))
+                    data[0].append(int(_text(tds[columns_to_extract[0]]).strip("\n ")))
+                    data[1].append(float(_text(tds[columns_to_extract[1]]).strip("\n ")))
+                    data[2].append(float(_text(tds[columns_to_extract[2]]).strip("\n %")))
+                    data[3].append(float(_text(tds[columns_to_extract[3]]).strip("\n %")))
+                    data[4].append(_text(tds[columns_to_extract[4]]).strip())
+            _drop_row(el)
+        elif el is form:
+            form_done = True
+        elif el is table:
+            table_done = True
+        if form_done and table_done:
+            break
+
+    if form is None or table is None:
+        raise RuntimeError("Missing results table!")
+    if columns_to_extract is None:
         raise RuntimeError("Missing columns!")
 
-    data = []
-    row = table.find("tbody").find("tr")
-    while row:
-        tds = row.find_all("td")
-        data.append((
-            int(tds[columns_to_extract[0]].text.strip("\n ")),
-            float(tds[columns_to_extract[1]].text.strip("\n ")),
-            float(tds[columns_to_extract[2]].text.strip("\n %")),
-            float(tds[columns_to_extract[3]].text.strip("\n %")),
-            tds[columns_to_extract[4]].text.strip(),
-        ))
-        row = row.find_next_sibling("tr")
-    df = pd.DataFrame(data, columns=COLS.keys())
+    df = pd.DataFrame(dict(zip(COLS.keys(), data)))
     for col, dtype in COLS.items():
         df[col] = df[col].astype(dtype=dtype, copy=False)
     return df, params
 
-#in_proces
+
+class StatusPage(NamedTuple):
+    errors: list[str]
+    # cell texts of the statInfo rows, None if the search has finished
+    stat_info: Optional[list[list[str]]]
+    # inputs of the first form in the content div
+    params: dict[str, str]
+    # (text, value, classes, selected) of the queryList options
+    queries: list[tuple[str, str, list[str], bool]]
+
+
 @async_pool.in_thread(max_running=6)
-def extract_table_data(raw_content: bytes) -> tuple[dict[int, pd.DataFrame], dict]:
-    """Takes raw page data, returns optimized points for each taxid and params for next request"""
+def parse_status_page(raw_content: bytes) -> StatusPage:
+    """Extracts the parts of the page do_blast_request needs, drops table rows as they are parsed"""
+    errors = None
+    error_list = None
+    stat_info = None
+    stat_table = None
+    params = {}
+    form = None
+    form_done = False
+    queries = []
+
+    for event, el in ET.iterparse(
+        io.BytesIO(raw_content),
+        events=("start", "end"),
+        tag=("ul", "li", "table", "tr", "form", "input", "option"),
+        html=True,
+        recover=True,
+    ):
+        if event == "start":
+            if el.tag == "input":
+                if form is not None and not form_done and 'name' in el.attrib and 'value' in el.attrib:
+                    params[el.attrib['name']] = el.attrib['value']
+            elif el.tag == "form":
+                if form is None and any(div.get("id") == "content" for div in el.iterancestors("div")):
+                    form = el
+            elif el.tag == "ul":
+                # only the first error list is reported
+                if errors is None and {"msg", "error"}.issubset(el.get("class", "").split()):
+                    error_list = el
+                    errors = []
+            elif el.tag == "table":
+                if stat_table is None and el.get("id") == "statInfo":
+                    stat_table = el
+                    stat_info = []
+            continue
+
+        if el.tag == "li":
+            if error_list is not None and any(ul is error_list for ul in el.iterancestors("ul")):
+                errors.append(_text(el).strip())
+        elif el.tag == "ul":
+            if el is error_list:
+                error_list = None
+        elif el.tag == "tr":
+            if stat_table is not None and next(el.iterancestors("table"), None) is stat_table:
+                stat_info.append([_text(td).strip() for td in el.iter("td")])
+            _drop_row(el)
+        elif el.tag == "option":
+            if any(parent.get("id") == "queryList" for parent in el.iterancestors()):
+                queries.append((
+                    _text(el),
+                    el.get("value"),
+                    el.get("class", "").split(),
+                    "selected" in el.attrib,
+                ))
+        elif el is form:
+            form_done = True
+
+    if errors is not None and not errors:
+        errors.append("Unknown error")
+    return StatusPage(errors or [], stat_info, params, queries)
 
-    df, params = parse_page(raw_content)
-    del raw_content
 
+@async_pool.in_thread()
+def find_saved_request_delete_link(raw_content: bytes, req_id:str) -> Optional[str]:
+    """Finds the link that deletes req_id on the "Recent results" page"""
+    root = lxml.html.fromstring(raw_content)
+    for table in root.xpath('(//div[@id="content"]//table)[1]'):
+        for row in list(table.iter("tr"))[1:]:
+            tds = row.findall(".//td")
+            if tds[1].text_content().strip() == req_id:
+                del_link = row.xpath('.//a[contains(concat(" ", normalize-space(@class), " "), " del ")]')
+                return del_link[0].get("href") if del_link else None
+    return None
+
+
+POINT_COLS = ['evalue','pident','qcov']
+
+def prepare_hits(df: pd.DataFrame) -> pd.DataFrame:
+    """Hits (COLS) with evalues turned into "larger is better" values for prune_hits"""
     # Removing Evals > 1 (sanity check)
-    df.drop(df[df['evalue'] > 1].index, inplace=True)
+    df = df.drop(df[df['evalue'] > 1].index)
 
     # replacing 0es with a VERY small value (for log to work)
-    df['evalue'].replace(0.0, 1e-300, inplace=True)
+    evalue = df['evalue'].replace(0.0, 1e-300)
 
     # transforming evalue: log switches it from extremely small numbers (like 10^-100)
     # to reasonable numbers like -100. "-" turns this parameter from "smaller is better"
     # to "larger is better", this way the point-pruning algorithm works
     # under the assumption "larger is always better" (and all parameters are positive)
-    df['evalue'] = -np.log10(df['evalue'])
+    df['evalue'] = -np.log10(evalue)
+    return df
+
+
+def prune_hits(df: pd.DataFrame) -> dict[int, pd.DataFrame]:
+    """Keeps only the non-dominated hits of every taxid (since our filters are all >=)
+
+    All metrics are "larger is better". Kept hits are in the descending norm order,
+    of the exact duplicates the first one on the page is kept.
+    """
+    if df.empty:
+        return {}
+    points = df[POINT_COLS].to_numpy()
+    # groups in the order of appearance on the page
+    groups = pd.factorize(df['taxid'])[0]
+
+    # a point can only be dominated by a point with a larger norm,
+    # so after this sort the first remaining point of each group is always kept
+    order = np.lexsort((-np.linalg.norm(points, axis=1), groups))
+    points = points[order]
+    groups = groups[order]
+
+    keep = np.zeros(len(order), dtype=bool)
+    # indices of points that aren't dominated by any kept point yet
+    alive = np.arange(len(order))
+    while alive.size:
+        alive_groups = groups[alive]
+        is_first = np.empty(alive.size, dtype=bool)
+        is_first[0] = True
+        np.not_equal(alive_groups[1:], alive_groups[:-1], out=is_first[1:])
+        keep[alive[is_first]] = True
+
+        # first alive point of the group for every alive point
+        leaders = alive[is_first][np.cumsum(is_first) - 1]
+        alive = alive[(points[alive] > points[leaders]).any(axis=1)]
+
+    kept = order[keep]
+    # kept points are still sorted by group, split them with slices
+    bounds = np.flatnonzero(np.diff(groups[keep])) + 1
+    starts = np.concatenate(([0], bounds)).tolist()
+    ends = np.concatenate((bounds, [len(kept)])).tolist()
+    taxids = df['taxid'].to_numpy()[kept[starts]].tolist()
+    kept = df[POINT_COLS + ['id']].iloc[kept]
+    return {
+        taxid: kept.iloc[start:end]
+        for taxid, start, end in zip(taxids, starts, ends)
+    }
 
-    result = {}
+# Hits of a taxid are cached packed: uint32 hit count, HIT_DTYPE records, then the utf-8 ids,
+# id_end is the end offset of the id in the ids part. b'' if blast found nothing.
+HIT_DTYPE = np.dtype([
+    ('evalue', '<f8'),
+    ('pident', '<f8'),
+    ('qcov', '<f8'),
+    ('id_end', '<u4'),
+])
+_COUNT_DTYPE = np.dtype('<u4')
+
+
+class Hits(NamedTuple):
+    # (hit count, 3) of evalue, pident, qcov
+    points: np.ndarray
+    ids: list[str]
+
+
+def pack_hits(df: pd.DataFrame) -> bytes:
+    ids = [prot_id.encode() for prot_id in df['id']]
+    records = np.empty(len(df), dtype=HIT_DTYPE)
+    for col in POINT_COLS:
+        records[col] = df[col].to_numpy()
+    records['id_end'] = np.cumsum([len(prot_id) for prot_id in ids])
+    return np.array(len(df), dtype=_COUNT_DTYPE).tobytes() + records.tobytes() + b''.join(ids)
+
+
+def unpack_hits(data: bytes) -> Optional[Hits]:
+    """Hits packed by pack_hits, None for b''"""
+    if not data:
+        return None
+    count = int.from_bytes(data[:_COUNT_DTYPE.itemsize], 'little')
+    records = np.frombuffer(data, dtype=HIT_DTYPE, count=count, offset=_COUNT_DTYPE.itemsize)
+    ids = data[_COUNT_DTYPE.itemsize + count * HIT_DTYPE.itemsize:]
+    id_ends = records['id_end'].tolist()
+    # evalue, pident and qcov are the leading fields of the records, viewed without a copy
+    points = np.ndarray(
+        (count, len(POINT_COLS)), dtype='<f8', buffer=records,
+        strides=(HIT_DTYPE.itemsize, 8),
+    )
+    return Hits(
+        points,
+        [ids[start:end].decode() for start, end in zip([0] + id_ends[:-1], id_ends)],
+    )
 
-    for taxid, group in df.groupby('taxid', sort=False):
-        group: pd.DataFrame
 
-        # points = group[group.columns.difference(['taxid', 'id'])].to_numpy()
-        points = group[['evalue','pident','qcov']]
-        points = points.reindex(group.index[np.argsort(-np.linalg.norm(points, axis=1))], copy=False)
-        # optimizing the number of stored points (since our filters are all >=)
-        pts_to_keep = []
+#in_proces
+@async_pool.in_thread(max_running=6)
+def extract_table_data(raw_content: bytes) -> tuple[dict[int, bytes], dict]:
+    """Takes raw page data, returns packed optimized points for each taxid and params for next request"""
 
-        while points.size:
-            pts_to_keep.append(points.index[0])
-            points = points[(points>points.iloc[0]).any(axis=1)]
-        result[taxid] = group[['evalue','pident','qcov','id']].loc[pts_to_keep]
+    df, params = parse_page(raw_content)
+    del raw_content
 
-    return result, params
+    return {
+        taxid: pack_hits(hits)
+        for taxid, hits in prune_hits(prepare_hits(df)).items()
+    }, params
 
 # limited by max blast workers
 @async_pool.in_thread()
-def write_tree(output_file, tree):
+def write_tree(output_file, heatmap:phyloxml.HeatmapTree):
     with open_existing(output_file, 'wb') as f:
-        tree.write(f, xml_declaration=True)
+        phyloxml.write_tree(
+            f,
+            heatmap.template,
+            fields=heatmap.fields,
+            gradient_classes=heatmap.gradient_classes,
+            rows=heatmap.rows,
+        )
 
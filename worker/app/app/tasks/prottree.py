@@ -1,11 +1,31 @@
+import os
+from datetime import timedelta
 from pathlib import Path
 from ..task_manager import queue_manager
 from ..redis import redis, GROUP
-from .prottree_sync import prottree_generator
+from . import prottree_sync
 from ..utils import DATA_PATH, atomic_file
 
 PROTTREE_DIR = DATA_PATH/'prottrees'
 PROTTREE_DIR.mkdir(exist_ok=True)
+# trees are the same for all proteins of a PANTHER family: they are built once per family,
+# {prot_id}.xml in PROTTREE_DIR is a symlink to the tree of its family
+FAMILY_DIR = PROTTREE_DIR/'families'
+FAMILY_DIR.mkdir(exist_ok=True)
+MAX_FAMILY_CACHE_SIZE = 512 * 2**20
+# family trees unused for this long are deleted
+MAX_FAMILY_CACHE_AGE = timedelta(days=30*3).total_seconds()
+
+NO_MATCHES = "No matches found for this protein"
+
+
+def link_alias(prot_id:str, family_file:Path):
+    alias = PROTTREE_DIR/f'{prot_id}.xml'
+    tmp_alias = PROTTREE_DIR/f'.{prot_id}.xml.tmp'
+    tmp_alias.unlink(missing_ok=True)
+    tmp_alias.symlink_to(family_file.relative_to(PROTTREE_DIR))
+    os.replace(tmp_alias, alias)
+
 
 @queue_manager.add_handler("/queues/prottree")
 async def build_prottree(queue_name, q_id, prot_id):
@@ -14,10 +34,30 @@ async def build_prottree(queue_name, q_id, prot_id):
         "message": "Building gene/protein subfamily tree",
     })
     try:
-        prottree_file = (PROTTREE_DIR/f'{prot_id}.xml')
-        with atomic_file(prottree_file) as tmp_path:
-            error_msg = await prottree_generator(prot_id, tmp_path)
-            print(error_msg)
+        panther_id, db_version = await prottree_sync.find_panther_id(prot_id)
+        if panther_id is None:
+            error_msg = NO_MATCHES
+        else:
+            # trees built from an older db are not used and get evicted
+            family_file = FAMILY_DIR/f'{panther_id}.{db_version}.xml'
+            if family_file.exists():
+                # mtime is the time of the last use
+                os.utime(family_file)
+            else:
+                # empty file if the family has nothing to show
+                with atomic_file(family_file) as tmp_path:
+                    await prottree_sync.prottree_generator(panther_id, tmp_path)
+                await prottree_sync.prune_family_cache(
+                    FAMILY_DIR, PROTTREE_DIR,
+                    max_size=MAX_FAMILY_CACHE_SIZE,
+                    max_age=MAX_FAMILY_CACHE_AGE,
+                )
+            if family_file.stat().st_size == 0:
+                error_msg = NO_MATCHES
+            else:
+                link_alias(prot_id, family_file)
+                error_msg = ""
+        print(error_msg)
     except:
         error_msg = "Error while building the gene/protein subfamily tree"
         raise
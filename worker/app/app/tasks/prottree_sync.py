@@ -1,4 +1,9 @@
-import sqlite3
+from contextlib import closing
+from functools import lru_cache
+import os
+import time
+from typing import Optional
+import numpy as np
 import pandas as pd
 from pathlib import Path
 
@@ -10,78 +15,110 @@ NS = {
 }
 
 from ..async_executor import async_pool
+from .. import panther, phyloxml
+from ..panther import PANTHERDB
 
-PANTHERDB = "/PANTHERDB/panther.sqlite"
 PANTHER_PATH = Path.cwd() / 'panther'
 
 
-@async_pool.in_process(max_running=1)
-def prottree_generator(prot_id:str, prottree_file:str):
-    with sqlite3.connect(PANTHERDB) as conn:
-        res = conn.execute("""
-            SELECT Genome, Gene, Family, Subfamily, Uniprot
-            FROM panther
-            WHERE PantherID=(
-                SELECT PantherID
-                FROM panther
-                WHERE Gene = ?
-            );
-        """, (prot_id,))
-        data = res.fetchall()
-        print(prot_id, data)
-        panther_df = pd.DataFrame(
-            data,
-            columns=['Genome', 'Gene', 'Family', 'Subfamily', 'Uniprot']
-        )
+# the converter and the tree are a part of the image, they are loaded
+# once per worker process and reused by the following jobs
+@lru_cache(maxsize=1)
+def id_converter() -> pd.DataFrame:
+    return pd.read_csv(PANTHER_PATH / "prottree_id_converter.csv")
+
+
+def panther_template() -> phyloxml.TreeTemplate:
+    return phyloxml.load_template(PANTHER_PATH / "PANTHER.xml", description=True)
+
+
+@lru_cache(maxsize=1)
+def genome_rows() -> dict[str, list[int]]:
+    """Genome -> rows of the id converter"""
+    rows = {}
+    for row, genome in enumerate(id_converter()['Genome'].tolist()):
+        rows.setdefault(genome, []).append(row)
+    return rows
+
+
+def family_matrix(family:panther.Family) -> np.ndarray:
+    """Presence (100) of the subfamilies (columns) in the id converter rows"""
+    rows_of_genome = genome_rows()
+    col_of_subfamily = {subfamily: col for col, subfamily in enumerate(family.subfamilies)}
+    values = np.zeros((len(id_converter()), len(family.subfamilies)))
+    for genome, subfamily in family.presence:
+        for row in rows_of_genome.get(genome, ()):
+            values[row, col_of_subfamily[subfamily]] = 100
+    return values
+
+
+@async_pool.in_thread()
+def find_panther_id(prot_id:str) -> tuple[Optional[str], int]:
+    """PantherID of the protein and the version (mtime) of the PANTHER db"""
+    with closing(panther.connect(PANTHERDB)) as conn:
+        return panther.family_id(conn, prot_id), os.stat(PANTHERDB).st_mtime_ns
+
+
+@async_pool.in_thread()
+def prune_family_cache(family_dir:Path, alias_dir:Path, max_size:int, max_age:float) -> int:
+    """Deletes family trees unused for max_age and the least recently used ones above max_size
+
+    Aliases pointing to the deleted trees are deleted too, returns the number of deleted trees
+    """
+    now = time.time()
+    entries = []
+    for entry in os.scandir(family_dir):
+        if entry.is_file(follow_symlinks=False) and entry.name.endswith(".xml"):
+            stat = entry.stat()
+            # mtime is the time of the last use
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    entries.sort(reverse=True)
+
+    total_size = 0
+    deleted = 0
+    for last_used, size, path in entries:
+        total_size += size
+        if now - last_used > max_age or total_size > max_size:
+            Path(path).unlink(missing_ok=True)
+            deleted += 1
+    if deleted:
+        for entry in os.scandir(alias_dir):
+            if entry.is_symlink() and not os.path.exists(entry.path):
+                Path(entry.path).unlink(missing_ok=True)
+    return deleted
 
-    if panther_df.empty:
-        return "No matches found for this protein"
-    family = data[0][2].strip("'\" \n\t")
 
-    value_count = panther_df['Subfamily'].value_counts().sort_index(ascending=True)
-    value_count = value_count.where(value_count > 8).dropna()
-    threshold_families = value_count.index.tolist()
+@async_pool.in_process(max_running=1)
+def prottree_generator(panther_id:str, prottree_file:str):
+    """Writes the tree of the family, returns an error message if there's nothing to show"""
+    with closing(panther.connect(PANTHERDB)) as conn:
+        family = panther.get_family(conn, panther_id, panther.has_family_tables(conn))
+
+    family_name = (family.name or "").strip("'\" \n\t")
+    threshold_families = family.subfamilies
 
     if len(threshold_families) == 0:
         return "No matches found for this protein"
 
-    panther_df = panther_df.drop_duplicates(subset=['Genome', 'Subfamily'], keep='last').assign(v=1).pivot('Subfamily', 'Genome').fillna(0)
-    panther_df = panther_df['v'].T
-    panther_df = panther_df[threshold_families]
-
-    tree_taxid = pd.read_csv(PANTHER_PATH / "prottree_id_converter.csv")
-    tree_taxid = tree_taxid.merge(panther_df, on='Genome', how='left', copy=False)
-    tree_taxid.fillna(0, inplace=True)
-    tree_taxid.set_index('TreeID', inplace=True)
-
-    parser = ET.XMLParser(remove_blank_text=True)
-    tree = ET.parse(str(PANTHER_PATH / "PANTHER.xml"), parser)
-    root = tree.getroot()
-    # t = root.find("./phylogeny", NS)
-    # t.find("./name", NS).text =
-    root.find("./phylogeny/description", NS).text = f'Family: "{family}"'
-
-    graphs = ET.SubElement(root, "graphs")
-    graph = ET.SubElement(graphs, "graph", type="heatmap")
-    ET.SubElement(graph, "name").text = "Presense"
-    legend = ET.SubElement(graph, "legend", show="1")
-
-    for col in threshold_families:
-        field = ET.SubElement(legend, "field")
-        ET.SubElement(field, "name").text = col
-
-    gradient = ET.SubElement(legend, "gradient")
-    ET.SubElement(gradient, "name").text = "Custom"
-    ET.SubElement(gradient, "classes").text = "2"
-
-    data = ET.SubElement(graph, "data")
-    for index, row in tree_taxid.iterrows():
-        values = ET.SubElement(data, "values", {"for":str(index)})
-        for col in threshold_families:
-            ET.SubElement(values, "value").text = f"{row[col] * 100:.0f}"
+    values = family_matrix(family)
+    value_elements = {
+        value: phyloxml.value_element(None, f"{value:.0f}")
+        for value in np.unique(values).tolist()
+    }
+    rows = [
+        (str(index), [value_elements[value] for value in row])
+        for index, row in zip(id_converter()['TreeID'].tolist(), values.tolist())
+    ]
 
     with open(prottree_file, 'wb') as f:
-        tree.write(f, xml_declaration=True)
+        phyloxml.write_tree(
+            f,
+            panther_template(),
+            fields=threshold_families,
+            gradient_classes=2,
+            rows=rows,
+            description=f'Family: "{family_name}"',
+        )
 
     return ""
 
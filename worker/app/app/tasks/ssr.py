@@ -2,8 +2,8 @@ import asyncio
 import json
 
 import time
-import asyncio
 import base64
+from typing import Optional
 
 import pyppeteer
 import pyppeteer.browser
@@ -12,19 +12,129 @@ import pyppeteer.element_handle
 from aioredis.client import Pipeline
 
 from ..task_manager import get_db, queue_manager, cancellation_manager
-from ..utils import atomic_file
+from ..utils import atomic_file, SSR_BROWSER
+from . import ssr_sync
 
 
 MAX_PAGES = 3
 MAX_BROWSER_IDLE = 5*60
+# pages are reloaded after this many renders to keep the js heap small
+MAX_RENDERS_PER_PAGE = 50
+MAX_PNG_RENDER_TIME = 5*60
+SSR_URL = "http://web:8050/some_non_public_ssr_path"
 
 running_workers = 0
 browser = None
 browser_closer: asyncio.Task = None
 
-async def render(page:pyppeteer.browser.Page):
+
+class SSRPage():
+    """Page with the phyd3 bundle loaded, reused between renders"""
+    def __init__(self, page:pyppeteer.browser.Page, page_browser:pyppeteer.browser.Browser):
+        self.page = page
+        self.browser = page_browser
+        self.renders = 0
+        self.png_result: Optional[asyncio.Future] = None
+
+    def _png_callback(self, data):
+        if self.png_result is not None and not self.png_result.done():
+            self.png_result.set_result(data)
+
+    async def load(self):
+        # exposed functions survive navigation, so this is done once per page
+        await self.page.exposeFunction("png_callback", self._png_callback)
+        ttv = time.time()
+        for attempt in range(30):
+            try:
+                await self.page.goto(SSR_URL)
+                await self.page.waitForSelector("#loaded", timeout=30)
+                break
+            except Exception as e:
+                if attempt == 29:
+                    raise
+                await asyncio.sleep(1)
+        print("page load took", time.time()-ttv)
+
+    async def is_healthy(self) -> bool:
+        if self.browser is not browser or self.page.isClosed():
+            return False
+        try:
+            return await asyncio.wait_for(
+                self.page.evaluate(
+                    "() => !!document.getElementById('loaded') && typeof window.build_tree === 'function'"
+                ),
+                timeout=5,
+            )
+        except Exception:
+            return False
+
+    async def close(self):
+        try:
+            await self.page.close()
+        except Exception:
+            pass
+
+    async def build_tree(self, xml:str, opts:dict) -> str:
+        return await self.page.evaluate(
+            "(xml, opts) => {document.getElementById('svg').textContent = ''; return window.build_tree(xml, opts)}",
+            xml, opts,
+        )
+
+    async def build_tree_png(self, xml:str, opts:dict) -> bytes:
+        self.png_result = asyncio.get_running_loop().create_future()
+        try:
+            await self.page.evaluate(
+                "(xml, opts) => {document.getElementById('svg').textContent = ''; return window.build_tree_png(xml, opts)}",
+                xml, opts,
+            )
+            return base64.urlsafe_b64decode(
+                await asyncio.wait_for(self.png_result, timeout=MAX_PNG_RENDER_TIME)
+            )
+        finally:
+            self.png_result = None
+
+
+idle_pages: list[SSRPage] = []
+
+async def acquire_page() -> SSRPage:
+    global browser
+    while idle_pages:
+        page = idle_pages.pop()
+        if await page.is_healthy():
+            return page
+        await page.close()
+
+    for attempt in range(3):
+        try:
+            browser = await get_browser()
+            page = SSRPage(await browser.newPage(), browser)
+            break
+        except Exception:
+            await force_close_browser()
+            if attempt == 2:
+                raise
+    try:
+        await page.load()
+    except Exception:
+        await page.close()
+        raise
+    return page
+
+async def release_page(page:SSRPage, reuse:bool):
+    page.renders += 1
+    if (
+        reuse and page.renders < MAX_RENDERS_PER_PAGE and
+        page.browser is browser and len(idle_pages) < MAX_PAGES
+    ):
+        idle_pages.append(page)
+    else:
+        await page.close()
+
+
+async def render(page:Optional[SSRPage]):
+    """Renders tree.xml with the page or with ssr_sync if page is None"""
     db = get_db()
-    xml = (db.task_dir / "tree.xml").read_text()
+    tree_file = db.task_dir / "tree.xml"
     @db.transaction
     async def tx(pipe: Pipeline):
         pipe.multi()
@@ -74,28 +184,12 @@ async def render(page:pyppeteer.browser.Page):
     }
     opts.update(opts_override)
 
-    ttv = time.time()
-    for attempt in range(30):
-        try:
-            await page.goto("http://web:8050/some_non_public_ssr_path")
-            await page.waitForSelector("#loaded", timeout=30)
-            break
-        except Exception as e:
-            if attempt == 29:
-                raise
-            await asyncio.sleep(1)
-    print("page load took", time.time()-ttv)
-
     if info["kind"] == "png":
         ttv = time.time()
-        fut = asyncio.Future()
-        await page.exposeFunction("png_callback", fut.set_result)
-
-        await page.evaluate(
-            "(xml, opts) => {return window.build_tree_png(xml, opts)}",
-            xml, opts,
-        )
-        res = base64.urlsafe_b64decode(await fut)
+        if page is None:
+            res = await ssr_sync.render_png(str(tree_file), opts)
+        else:
+            res = await page.build_tree_png(tree_file.read_text(), opts)
         print("took", time.time()-ttv)
 
         with atomic_file(db.task_dir / "ssr_img.png") as tmp_file:
@@ -108,10 +202,10 @@ async def render(page:pyppeteer.browser.Page):
         print("ssr png done: ", res[:10])
     elif info["kind"] == "svg":
         ttv = time.time()
-        svg = await page.evaluate(
-            "(xml, opts) => {return window.build_tree(xml, opts)}",
-            xml, opts,
-        )
+        if page is None:
+            svg = await ssr_sync.render_svg(str(tree_file), opts)
+        else:
+            svg = await page.build_tree(tree_file.read_text(), opts)
         print("took", time.time()-ttv)
         with atomic_file(db.task_dir / "ssr_img.svg") as tmp_file:
             with open(tmp_file, "w") as f:
@@ -146,6 +240,7 @@ async def close_unused_browser():
     br = browser
     browser = None
     browser_closer = None
+    idle_pages.clear()
     await br.close()
 
 
@@ -156,6 +251,7 @@ async def force_close_browser():
     except Exception:
         pass
     running_workers = 0
+    idle_pages.clear()
     if browser_closer:
         browser_closer.cancel()
         browser_closer = None
@@ -169,28 +265,20 @@ async def force_close_browser():
 @cancellation_manager.wrap_handler
 async def handler():
     """tasks come here"""
-    db = get_db()
-    global running_workers, browser_closer, browser
-    page = None
+    if not SSR_BROWSER:
+        await render(None)
+        return
+    global running_workers, browser_closer
     running_workers += 1
     try:
-        for attempt in range(3):
-            try:
-                browser = await get_browser()
-                page = await browser.newPage()
-                break
-            except Exception:
-                await force_close_browser()
-                if attempt == 2:
-                    raise
-        await render(page)
-        await page.close()
-    except Exception as e:
+        page = await acquire_page()
         try:
-            await page.close()
-        except Exception:
-            await force_close_browser()
-        raise e
+            await render(page)
+        except:
+            # cancelled or failed mid-render, the page state is unknown
+            await release_page(page, reuse=False)
+            raise
+        await release_page(page, reuse=True)
 
     finally:
         if running_workers != 0: # not force-quit the browser
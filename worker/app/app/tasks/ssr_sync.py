@@ -0,0 +1,385 @@
+"""Server-side render of the phyloxml tree with the heatmap, without a browser
+
+Follows the layout of phyd3.phylogram.build + gensvg_static as it is run by the
+SSR page (dash_app/app/ssr/index.html): d3 cluster layout, right angle links,
+lined up leaf names and one square per heatmap value.
+"""
+import io
+from typing import NamedTuple, Optional
+
+from lxml import etree as ET
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection, PolyCollection
+
+from ..async_executor import async_pool
+
+NS = {
+    "xsi": "http://www.w3.org/2001/XMLSchema-instance",
+    "": "http://www.phyloxml.org"
+}
+
+# width of the #svg div in the SSR page (800px viewport - body margins)
+SELECTOR_WIDTH = 784
+# phyd3 defaults
+DEFAULT_OPTS = {
+    "height": 800,
+    "margin": 20,
+    "nodeHeight": 6,
+    "scaleX": 1,
+    "scaleY": 1,
+    "textLength": 100,
+    "outline": 0.3,
+    "lineupNodes": True,
+    "showNodeNames": True,
+    "showNodesType": "only leaf",
+    "showGraphs": True,
+    "showGraphLegend": True,
+    "invertColors": False,
+    "nanColor": "#fff",
+    "foregroundColor": "#000",
+    "backgroundColor": "#fff",
+}
+TEXT_PADDING = 100
+LEGEND_PADDING = 100
+# heatmap colors (dash_app/phyd3/js/colorbrewer.min.js), values are quantized over [0, 100]
+GRADIENTS = {
+    "Custom": {
+        2: ["#170a1c", "#228cdb"],
+        4: ["#666666", "#170a1c", "#f72585", "#228cdb"],
+    },
+}
+# average glyph width of Open Sans relative to the font size
+CHAR_WIDTH = 0.55
+
+
+class Node():
+    __slots__ = ("name", "id", "children", "x", "y")
+    def __init__(self, name:str, id:Optional[str]):
+        self.name = name
+        self.id = id
+        self.children: list["Node"] = []
+        self.x = 0.0
+        self.y = 0.0
+
+
+class Text(NamedTuple):
+    x: float
+    y: float
+    text: str
+    font_size: float
+    rotate: bool
+    fill: str
+    stroke_width: float
+
+
+class Rect(NamedTuple):
+    x: float
+    y: float
+    size: float
+    fill: str
+    stroke: str
+    title: Optional[str]
+
+
+class Layout(NamedTuple):
+    width: float
+    height: float
+    # offset of the drawing (translate of the "main" group)
+    dx: float
+    dy: float
+    background: str
+    foreground: str
+    outline: float
+    links: list[list[tuple[int, int]]]
+    support_lines: list[list[tuple[int, int]]]
+    texts: list[Text]
+    rects: list[Rect]
+
+
+def _text_width(text:str, font_size:float) -> float:
+    return len(text) * font_size * CHAR_WIDTH
+
+
+def _parse(tree_file:str):
+    parser = ET.XMLParser(remove_blank_text=True)
+    root = ET.parse(tree_file, parser).getroot()
+
+    root_clade = root.find("./phylogeny/clade", NS)
+    tree_root = Node(root_clade.findtext("name", "", NS), root_clade.findtext("id", None, NS))
+    stack = [(root_clade, tree_root)]
+    while stack:
+        clade, node = stack.pop()
+        for child_clade in clade.iterfind("clade", NS):
+            child = Node(child_clade.findtext("name", "", NS), child_clade.findtext("id", None, NS))
+            node.children.append(child)
+            stack.append((child_clade, child))
+
+    fields = []
+    gradient = GRADIENTS["Custom"][2]
+    show_legend = False
+    values = {}
+    graph = root.find("./graphs/graph[@type='heatmap']", NS)
+    if graph is not None:
+        legend = graph.find("legend", NS)
+        show_legend = legend.get("show", "1") != "0"
+        fields = [el.text or "" for el in legend.iterfind("field/name", NS)]
+        gradient_name = legend.findtext("gradient/name", "Custom", NS)
+        classes = int(legend.findtext("gradient/classes", "2", NS))
+        gradient = GRADIENTS.get(gradient_name, GRADIENTS["Custom"]).get(classes, gradient)
+        for row in graph.iterfind("data/values", NS):
+            values[row.get("for")] = [
+                (el.text, el.get("label"))
+                for el in row.iterfind("value", NS)
+            ]
+    return tree_root, fields, gradient, show_legend, values
+
+
+def _color(value:Optional[str], gradient:list[str], nan_color:str) -> Optional[str]:
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    if value != value:
+        return None
+    # d3.scale.quantize().domain([0, 100])
+    idx = int(value / 100 * len(gradient))
+    return gradient[min(max(idx, 0), len(gradient)-1)]
+
+
+def layout(tree_file:str, opts:dict) -> Layout:
+    opts = {**DEFAULT_OPTS, **opts}
+    root, fields, gradient, show_legend, values = _parse(tree_file)
+
+    fg = opts["backgroundColor"] if opts["invertColors"] else opts["foregroundColor"]
+    bg = opts["foregroundColor"] if opts["invertColors"] else opts["backgroundColor"]
+    h = opts["nodeHeight"]
+    margin = opts["margin"]
+    outline = opts["outline"]
+    show_graphs = opts["showGraphs"] and bool(fields)
+    legend_padding = LEGEND_PADDING if show_legend else 0
+
+    graph_padding = len(fields) * h * 2 + 5 if show_graphs else 0
+    tree_width = int(SELECTOR_WIDTH - (
+        2 * margin + (TEXT_PADDING if opts["showNodeNames"] else 0) + graph_padding
+    ))
+    tree_height = int(opts["height"] - (2 * margin + (legend_padding if show_graphs else 0)))
+    if tree_width < 0:
+        tree_width = SELECTOR_WIDTH - 2 * TEXT_PADDING - (2 * legend_padding if show_graphs else 0)
+    size_x = tree_height * opts["scaleY"]
+    size_y = tree_width * opts["scaleX"]
+
+    # d3.layout.cluster with separation 1: post-order walk
+    nodes: list[Node] = []
+    leaves: list[Node] = []
+    stack = [(root, False)]
+    while stack:
+        node, visited = stack.pop()
+        if visited:
+            node.x = sum(child.x for child in node.children) / len(node.children)
+            node.y = 1 + max(child.y for child in node.children)
+            continue
+        nodes.append(node)
+        if node.children:
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(node.children))
+        else:
+            node.x = len(leaves)
+            node.y = 0
+            leaves.append(node)
+    root_y = root.y
+    for node in nodes:
+        # screen coordinates: the tree grows to the right
+        node.x = int((node.x + 0.5) / len(leaves) * size_x)
+        node.y = int((1 - (node.y / root_y if root_y else 1)) * size_y)
+
+    links = []
+    for node in nodes:
+        for child in node.children:
+            links.append([(node.y, node.x), (node.y, child.x), (child.y, child.x)])
+
+    lineup_x = max(leaf.y for leaf in leaves)
+    font_size = h * 1.5
+    texts = []
+    support_lines = []
+    name_width = 0
+    for node in nodes:
+        is_leaf = not node.children
+        if not opts["showNodeNames"] or not node.name:
+            continue
+        if is_leaf and opts["showNodesType"] == "only inner":
+            continue
+        if not is_leaf and opts["showNodesType"] == "only leaf":
+            continue
+        text_x = node.y + (lineup_x - node.y + 5 if is_leaf and opts["lineupNodes"] else 5)
+        texts.append(Text(text_x, node.x + h / 2, node.name, font_size, False, fg, outline))
+        if is_leaf:
+            name_width = max(name_width, _text_width(node.name + " ", font_size))
+    if opts["lineupNodes"]:
+        support_lines = [
+            [(leaf.y, leaf.x), (lineup_x, leaf.x)]
+            for leaf in leaves
+            if leaf.y != lineup_x
+        ]
+
+    if opts["showNodeNames"] and opts["showNodesType"] != "only inner":
+        text_padding = max(name_width + 10, opts["textLength"])
+    else:
+        text_padding = 5
+
+    rects = []
+    cell = h * 2
+    if show_graphs:
+        graph_x = lineup_x + text_padding
+        for leaf in leaves:
+            row = values.get(leaf.id)
+            if not row:
+                continue
+            for i, (value, label) in enumerate(row):
+                color = _color(value, gradient, opts["nanColor"])
+                rects.append(Rect(
+                    graph_x + i * cell,
+                    leaf.x - h,
+                    cell,
+                    color or opts["nanColor"],
+                    fg if color else opts["nanColor"],
+                    f"{leaf.name}: {label}" if label is not None else None,
+                ))
+        if opts["showGraphLegend"] and show_legend:
+            for i, name in enumerate(fields):
+                texts.append(Text(int(graph_x + (i + 1) * cell), -10, name, cell, True, fg, 0))
+
+    # bounding box of the drawing, node pointer rects are included like in the browser
+    min_x = -(h + 1)
+    min_y = min(node.x for node in nodes) - (h + 1)
+    max_x = max(lineup_x, size_y) + h + 1
+    max_y = max(node.x for node in nodes) + h + 1
+    for text in texts:
+        width = _text_width(text.text, text.font_size)
+        if text.rotate:
+            min_y = min(min_y, text.y - width)
+        else:
+            max_x = max(max_x, text.x + width)
+    if rects:
+        max_x = max(max_x, max(rect.x + rect.size for rect in rects))
+    bbox_width = max_x - min_x
+    bbox_height = max_y - min_y
+
+    return Layout(
+        width=max(SELECTOR_WIDTH, bbox_width) + margin,
+        height=max(opts["height"], bbox_height) + margin + (legend_padding if show_graphs else 0),
+        dx=20 - min_x,
+        dy=20 - min_y,
+        background=bg,
+        foreground=fg,
+        outline=outline,
+        links=links,
+        support_lines=support_lines,
+        texts=texts,
+        rects=rects,
+    )
+
+
+def _fmt(value:float) -> str:
+    return f"{value:.2f}".rstrip("0").rstrip(".")
+
+
+def _points(points) -> str:
+    return "M" + " ".join(f"{x},{y}" for x, y in points)
+
+
+def to_svg(lt:Layout) -> str:
+    f = io.BytesIO()
+    with ET.xmlfile(f, encoding="utf-8") as xf:
+        with xf.element("svg", {
+            "xmlns": "http://www.w3.org/2000/svg",
+            "version": "1.1",
+            "width": _fmt(lt.width),
+            "height": _fmt(lt.height),
+            "overflow": "hidden",
+            "font-family": "Open Sans",
+        }):
+            xf.write(ET.Element("rect", {"class": "canvas", "width": "100%", "height": "100%", "fill": lt.background}))
+            with xf.element("g", {"id": "main", "transform": f"translate({_fmt(lt.dx)}, {_fmt(lt.dy)})"}):
+                with xf.element("g", {"class": "links", "fill": "none", "stroke": lt.foreground}):
+                    for link in lt.links:
+                        xf.write(ET.Element("path", {"class": "link", "d": _points(link)}))
+                    for line in lt.support_lines:
+                        xf.write(ET.Element("path", {
+                            "class": "support", "d": _points(line),
+                            "stroke-dasharray": "2,3", "stroke-width": "0.5px",
+                        }))
+                with xf.element("g", {"class": "graph heatmap", "stroke-width": f"{_fmt(lt.outline)}px"}):
+                    for rect in lt.rects:
+                        el = ET.Element("rect", {
+                            "class": "heatmap",
+                            "x": _fmt(rect.x), "y": _fmt(rect.y),
+                            "width": _fmt(rect.size), "height": _fmt(rect.size),
+                            "fill": rect.fill, "stroke": rect.stroke,
+                        })
+                        if rect.title is not None:
+                            ET.SubElement(el, "title").text = rect.title
+                        xf.write(el)
+                for text in lt.texts:
+                    attrs = {
+                        "fill": text.fill,
+                        "font-size": f"{_fmt(text.font_size)}px",
+                    }
+                    if text.rotate:
+                        attrs["class"] = "legend"
+                        attrs["transform"] = f"translate({_fmt(text.x)},{_fmt(text.y)}) rotate(-90)"
+                    else:
+                        attrs["class"] = "name"
+                        attrs["x"] = _fmt(text.x)
+                        attrs["y"] = _fmt(text.y)
+                        attrs["stroke"] = text.fill
+                        attrs["stroke-width"] = f"{_fmt(text.stroke_width)}px"
+                    el = ET.Element("text", attrs)
+                    el.text = text.text
+                    xf.write(el)
+    return f.getvalue().decode()
+
+
+def to_png(lt:Layout) -> bytes:
+    # 72 dpi: one svg px is one point
+    fig = Figure(figsize=(lt.width / 72, lt.height / 72), dpi=72, facecolor=lt.background)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_axis_off()
+    ax.set_xlim(-lt.dx, lt.width - lt.dx)
+    ax.set_ylim(lt.height - lt.dy, -lt.dy)
+
+    ax.add_collection(LineCollection(lt.links, colors=lt.foreground, linewidths=1))
+    if lt.support_lines:
+        ax.add_collection(LineCollection(lt.support_lines, colors=lt.foreground, linewidths=0.5, linestyles=(0, (2, 3))))
+    if lt.rects:
+        ax.add_collection(PolyCollection(
+            [
+                [(r.x, r.y), (r.x + r.size, r.y), (r.x + r.size, r.y + r.size), (r.x, r.y + r.size)]
+                for r in lt.rects
+            ],
+            facecolors=[r.fill for r in lt.rects],
+            edgecolors=[r.stroke for r in lt.rects],
+            linewidths=lt.outline,
+        ))
+    for text in lt.texts:
+        ax.text(
+            text.x, text.y, text.text,
+            fontsize=text.font_size, color=text.fill,
+            rotation=90 if text.rotate else 0, rotation_mode="anchor",
+            ha="left", va="baseline",
+        )
+
+    f = io.BytesIO()
+    canvas.print_png(f)
+    return f.getvalue()
+
+
+@async_pool.in_process()
+def render_svg(tree_file:str, opts:dict) -> str:
+    return to_svg(layout(tree_file, opts))
+
+
+@async_pool.in_process()
+def render_png(tree_file:str, opts:dict) -> bytes:
+    return to_png(layout(tree_file, opts))
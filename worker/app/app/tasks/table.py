@@ -12,8 +12,8 @@ import pandas as pd
 
 from . import table_sync
 from ..task_manager import queue_manager, cancellation_manager, get_db
-from ..redis import redis, LEVELS, enqueue
-from ..utils import atomic_file
+from ..redis import redis, cache, LEVELS, enqueue
+from ..utils import atomic_file, ORTHODB_SQLITE
 
 
 TABLE_COLUMNS = [
@@ -41,6 +41,53 @@ REQUEST_COLUMNS.append("og")
 
 PROTTREE_URL = re.compile(r"(.+)")
 
+# Proteins of a level are cached in the /cache/uniprot/{level}/data hash with prot_id as the field
+_get_cached_script = cache.register_script("""
+    -- KEYS[1] - data hash
+    -- KEYS[2] - accessed index of the cache
+    -- ARGV[1] - current time
+    -- ARGV[2:] - prot_ids
+
+    -- returns data for each of prot_ids (nil if not cached), updates accessed time of the found ones
+    local res = {}
+    for i = 2, #ARGV do
+        local data = redis.call('hget', KEYS[1], ARGV[i])
+        res[i-1] = data
+        if data then
+            redis.call('zadd', KEYS[2], 'XX', ARGV[1], KEYS[1] .. '#' .. ARGV[i])
+        end
+    end
+    return res
+""")
+
+
+async def get_cached_proteins(level:str, prot_ids:list[str]) -> dict[str, list]:
+    if not prot_ids:
+        return {}
+    cache_data = await _get_cached_script(
+        keys=(
+            f"/cache/uniprot/{level}/data",
+            cache.ACCESSED_INDEX,
+        ),
+        args=(int(time()), *prot_ids),
+    )
+    return {
+        prot_id: json.loads(data)
+        for prot_id, data in zip(prot_ids, cache_data)
+        if data is not None
+    }
+
+
+async def cache_proteins(level:str, prots:dict[str, list]):
+    data_key = f"/cache/uniprot/{level}/data"
+    async with cache.redis.pipeline(transaction=False) as pipe:
+        pipe.hset(data_key, mapping={
+            prot_id: json.dumps(prot_data, separators=(',', ':'))
+            for prot_id, prot_data in prots.items()
+        })
+        cache.add(pipe, (cache.hash_entry(data_key, prot_id) for prot_id in prots), int(time()))
+        await pipe.execute()
+
 
 async def fetch_proteins(level:str, prots_to_fetch:list[str]):
     db = get_db()
@@ -83,10 +130,14 @@ async def fetch_proteins(level:str, prots_to_fetch:list[str]):
     max_items_per_chunk = 200
     preferred_chunk_count = 10
 
-    chunk_count = max(
-        min(preferred_chunk_count, math.ceil(len(prots_to_fetch) / min_items_per_chunk)), # target request count
-        math.ceil(len(prots_to_fetch) / max_items_per_chunk), # minimal num of requests
-    )
+    if ORTHODB_SQLITE:
+        # local db resolves the whole batch in one query
+        chunk_count = 1
+    else:
+        chunk_count = max(
+            min(preferred_chunk_count, math.ceil(len(prots_to_fetch) / min_items_per_chunk)), # target request count
+            math.ceil(len(prots_to_fetch) / max_items_per_chunk), # minimal num of requests
+        )
     chunk_length = math.ceil(len(prots_to_fetch)/chunk_count)
     tasks = [
         asyncio.create_task(fetch_prot_chunk(
@@ -104,18 +155,8 @@ async def fetch_proteins(level:str, prots_to_fetch:list[str]):
             t.cancel()
         raise
 
-    cur_time = int(time())
-    async with redis.pipeline(transaction=False) as pipe:
-        # Add all prots to the cache
-        for prot_id, prot_data in result.items():
-            pipe.mset(
-                {
-                    f"/cache/uniprot/{level}/{prot_id}/data": json.dumps(prot_data, separators=(',', ':')),
-                    f"/cache/uniprot/{level}/{prot_id}/accessed": cur_time,
-                }
-            )
-            pipe.setnx(f"/cache/uniprot/{level}/{prot_id}/created", cur_time)
-        await pipe.execute()
+    if result:
+        await cache_proteins(level, result)
     return result
 
 
@@ -169,16 +210,58 @@ async def fetch_orthogroups(orthogroups_to_fetch: list[str], dash_columns: list[
             t.cancel()
         raise
 
-    cur_time = int(time())
-    async with redis.pipeline(transaction=False) as pipe:
+    async with cache.redis.pipeline(transaction=False) as pipe:
         for og, og_data in og_info.items():
             pipe.hset(f"/cache/ortho/{og}/data", mapping=og_data)
-            pipe.set(f"/cache/ortho/{og}/accessed", cur_time)
-            pipe.setnx(f"/cache/ortho/{og}/created", cur_time)
+        cache.add(pipe, (f"/cache/ortho/{og}" for og in og_info), int(time()))
         await pipe.execute()
 
     return og_info
 
+
+async def fetch_orthogroups_local(og_list: list[str], dash_columns: list[str]):
+    """Gets orthogroup info for all OGs with a single lookup in the local db"""
+    db = get_db()
+    await db.flush_progress(message="Requesting orthogroup info")
+
+    og_info = {}
+    for og, data in (await table_sync.ortho_data_get(og_list, dash_columns)).items():
+        if data:
+            og_info[og] = data
+    db.report_progress(current=len(og_info), total=len(og_info))
+    return og_info
+
+
+async def fetch_orthogroups_cached(og_list: pd.Series, dash_columns: list[str]):
+    """Gets orthogroup info from the redis cache, requests the rest with sparql"""
+    db = get_db()
+    og_info = defaultdict(dict)
+
+    async with cache.redis.pipeline(transaction=False) as pipe:
+        for og in og_list:
+            pipe.hmget(f"/cache/ortho/{og}/data", dash_columns)
+        cache.touch(pipe, (f"/cache/ortho/{og}" for og in og_list), int(time()))
+
+        cache_data = (await pipe.execute())[:len(og_list)]
+
+    for og, data in zip(og_list, cache_data):
+        if None in data:
+            continue
+        og_info[og] = dict(zip(dash_columns, data))
+
+    db.report_progress(current_delta=len(og_info))
+    orthogroups_to_fetch = list(set(og_list)-og_info.keys())
+
+    if orthogroups_to_fetch:
+        og_info.update(
+            await fetch_orthogroups(
+                orthogroups_to_fetch=orthogroups_to_fetch,
+                dash_columns=dash_columns,
+            )
+        )
+
+    return og_info
+
 # https://www.uniprot.org/help/accession_numbers
 VALID_PROT_IDS = re.compile(r"[OPQ][0-9][A-Z0-9]{3}[0-9]|[A-NR-Z][0-9]([A-Z][A-Z0-9]{2}[0-9]){1,2}")
 COMMENT = re.compile(r"#.*\n")
@@ -210,21 +293,7 @@ async def table():
     level, _ = LEVELS[level_id]
 
     # Filter out already cached proteins
-    cache_data = await redis.mget([
-        f"/cache/uniprot/{level}/{prot_id}/data"
-        for prot_id in prot_ids
-    ])
-
-    res_dict = {}
-
-    cur_time = int(time())
-    async with redis.pipeline(transaction=False) as pipe:
-        for prot_id, cache in zip(prot_ids, cache_data):
-            if cache is None:
-                continue
-            pipe.set(f"/cache/uniprot/{level}/{prot_id}/accessed", cur_time, xx=True)
-            res_dict[prot_id] = json.loads(cache)
-        await pipe.execute()
+    res_dict = await get_cached_proteins(level, prot_ids)
 
     await db.flush_progress(current=len(res_dict))
     prots_to_fetch = list(
@@ -277,34 +346,10 @@ async def table():
     og_list = uniprot_df['label']
     db.report_progress(total=len(og_list))
 
-    orthogroups_to_fetch = []
-
-    og_info = defaultdict(dict)
-
-    cur_time = int(time())
-    async with redis.pipeline(transaction=False) as pipe:
-        for og in og_list:
-            pipe.hmget(f"/cache/ortho/{og}/data", REQUEST_COLUMNS)
-            pipe.set(f"/cache/ortho/{og}/accessed", cur_time, xx=True)
-
-        cache_data = (await pipe.execute())[::2]
-
-    for og, data in zip(og_list, cache_data):
-        if None in data:
-            continue
-        og_info[og] = dict(zip(REQUEST_COLUMNS, data))
-
-    db.report_progress(current_delta=len(og_info))
-    orthogroups_to_fetch = list(set(og_list)-og_info.keys())
-
-    if orthogroups_to_fetch:
-        og_info.update(
-            await fetch_orthogroups(
-                orthogroups_to_fetch=orthogroups_to_fetch,
-                dash_columns=REQUEST_COLUMNS,
-            )
-        )
-
+    if ORTHODB_SQLITE:
+        og_info = await fetch_orthogroups_local(og_list.tolist(), REQUEST_COLUMNS)
+    else:
+        og_info = await fetch_orthogroups_cached(og_list, REQUEST_COLUMNS)
 
     og_info_df = pd.DataFrame(
         (
@@ -1,5 +1,8 @@
 from collections import defaultdict
+from contextlib import closing
 import json
+import sqlite3
+from typing import Optional
 
 import SPARQLWrapper
 import requests
@@ -7,10 +10,16 @@ import pandas as pd
 import numpy as np
 
 from ..async_executor import async_pool
-from ..utils import open_existing
+from ..utils import open_existing, ORTHODB_SQLITE
+
+
+def orthodb_connect() -> sqlite3.Connection:
+    # workers never modify the database
+    return sqlite3.connect(f"file:{ORTHODB_SQLITE}?mode=ro", uri=True)
+
 
 @async_pool.in_thread(max_running=3)
-def orthodb_get(level:str, prot_ids:list) -> defaultdict[str, list]:
+def orthodb_get_sparql(level:str, prot_ids:list) -> defaultdict[str, list]:
     endpoint = SPARQLWrapper.SPARQLWrapper("http://sparql.orthodb.org/sparql")
 
     endpoint.setQuery(f"""
@@ -44,6 +53,42 @@ def orthodb_get(level:str, prot_ids:list) -> defaultdict[str, list]:
     return res
 
 
+@async_pool.in_thread(max_running=3)
+def orthodb_get_sqlite(level:str, prot_ids:list) -> defaultdict[str, list]:
+    """Same as orthodb_get_sparql, but answers the whole batch from the local db with one query"""
+    res = defaultdict(list)
+    with closing(orthodb_connect()) as conn:
+        # temp table instead of "IN (?, ?, ...)": sqlite limits the number of query parameters
+        conn.execute("CREATE TEMP TABLE requested_ids (uniprot_id TEXT PRIMARY KEY)")
+        conn.executemany(
+            "INSERT OR IGNORE INTO requested_ids VALUES (?)",
+            ((prot_id,) for prot_id in prot_ids),
+        )
+        rows = conn.execute("""
+            SELECT
+                genes.uniprot_id,
+                orthodb_to_og.cluster_id || 'at' || orthodb_to_og.clade,
+                genes.gene_name
+            FROM requested_ids
+            JOIN genes ON genes.uniprot_id = requested_ids.uniprot_id
+            JOIN orthodb_to_og ON orthodb_to_og.orthodb_id = genes.orthodb_id
+            JOIN levels ON levels.level_id = orthodb_to_og.clade
+            WHERE
+                levels.scientific_name = ? AND
+                genes.gene_name IS NOT NULL
+        """, (level,))
+
+        # Tuples of 'label', 'Name', 'PID'
+        for prot_id, og, gene_name in rows:
+            prot_id = prot_id.strip().upper()
+            res[prot_id].append((og, gene_name, prot_id))
+
+    return res
+
+
+orthodb_get = orthodb_get_sqlite if ORTHODB_SQLITE else orthodb_get_sparql
+
+
 @async_pool.in_thread(max_running=6)
 def uniprot_get(prot_id:str):
     try:
@@ -69,7 +114,7 @@ def uniprot_get(prot_id:str):
 
 
 @async_pool.in_thread(max_running=50)
-def ortho_data_get(requested_ids:list, fields:list) -> dict[str, dict[str, str]]:
+def ortho_data_get_sparql(requested_ids:list, fields:list) -> dict[str, Optional[dict[str, str]]]:
     og_string = ', '.join(f'odbgroup:{og}' for og in requested_ids)
 
     endpoint = SPARQLWrapper.SPARQLWrapper("http://sparql.orthodb.org/sparql")
@@ -100,9 +145,11 @@ def ortho_data_get(requested_ids:list, fields:list) -> dict[str, dict[str, str]]
     """)
     endpoint.setReturnFormat(SPARQLWrapper.JSON)
     result = endpoint.query().convert()
-    og_info = {}
+    og_info = dict.fromkeys(requested_ids)
 
-    for og, data in zip(requested_ids, result["results"]["bindings"]):
+    # the endpoint doesn't keep the order of the requested ids (and skips unknown ones)
+    for data in result["results"]["bindings"]:
+        og = data["og"]["value"].split('/')[-1].strip()
         try:
             og_info[og] = {
                 field: data[field]["value"]
@@ -113,6 +160,66 @@ def ortho_data_get(requested_ids:list, fields:list) -> dict[str, dict[str, str]]
 
     return og_info
 
+
+# REQUEST_COLUMNS -> og_stats table
+OG_STATS_COLUMNS = {
+    "label": "og_stats.cluster_id || 'at' || og_stats.clade",
+    "description": "og_stats.description",
+    "clade": "levels.scientific_name",
+    "evolRate": "og_stats.evol_rate",
+    "totalGenesCount": "og_stats.total_genes_count",
+    "multiCopyGenesCount": "og_stats.multi_copy_genes_count",
+    "singleCopyGenesCount": "og_stats.single_copy_genes_count",
+    "inSpeciesCount": "og_stats.in_species_count",
+    "medianProteinLength": "og_stats.median_protein_length",
+    "stddevProteinLength": "og_stats.stddev_protein_length",
+    "og": "'http://purl.orthodb.org/odbgroup/' || og_stats.cluster_id || 'at' || og_stats.clade",
+}
+
+
+@async_pool.in_thread(max_running=3)
+def ortho_data_get_sqlite(requested_ids:list, fields:list) -> dict[str, Optional[dict[str, str]]]:
+    """Same as ortho_data_get_sparql, but gets all OGs from the local db with one query"""
+    og_info = dict.fromkeys(requested_ids)
+
+    og_keys = []
+    for og in requested_ids:
+        try:
+            cluster_id, clade = og.split("at", maxsplit=1)
+            og_keys.append((og, int(cluster_id), int(clade)))
+        except ValueError:
+            # not an OrthoDB id, could be returned by uniprot_get
+            pass
+
+    with closing(orthodb_connect()) as conn:
+        conn.execute("""
+            CREATE TEMP TABLE requested_ogs (
+                og TEXT NOT NULL,
+                cluster_id INTEGER NOT NULL,
+                clade INTEGER NOT NULL
+            )
+        """)
+        conn.executemany("INSERT INTO requested_ogs VALUES (?, ?, ?)", og_keys)
+        rows = conn.execute(f"""
+            SELECT
+                requested_ogs.og,
+                {', '.join(OG_STATS_COLUMNS[field] for field in fields)}
+            FROM requested_ogs
+            JOIN og_stats USING (cluster_id, clade)
+            JOIN levels ON levels.level_id = og_stats.clade
+        """)
+        for og, *values in rows:
+            og_info[og] = {
+                # missing values are NULL in the db
+                field: "" if val is None else str(val)
+                for field, val in zip(fields, values)
+            }
+
+    return og_info
+
+
+ortho_data_get = ortho_data_get_sqlite if ORTHODB_SQLITE else ortho_data_get_sparql
+
 @async_pool.in_thread(max_running=3)
 def process_prot_data(data:list[tuple[str, str, str]], output_file:str)-> pd.DataFrame:
     # this uses pandas dataframes, but is not really cpu-bound
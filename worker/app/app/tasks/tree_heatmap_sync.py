@@ -12,6 +12,7 @@ from scipy.cluster import hierarchy
 
 from ..async_executor import async_pool
 from ..utils import open_existing
+from .. import levels, phyloxml
 
 ET.register_namespace("xsi", "http://www.w3.org/2001/XMLSchema-instance")
 NS = {
@@ -19,8 +20,25 @@ NS = {
     "": "http://www.phyloxml.org"
 }
 
+def heatmap_rows(df:pd.DataFrame, columns:pd.Index, prot_ids, do_blast:bool) -> list[tuple[str, list[str]]]:
+    """<values> rows of the presence heatmap of df[columns] for phyloxml.write_tree"""
+    organisms = [str(index) for index in df.index]
+    present = df[columns].to_numpy() != 0
+
+    cells = np.empty(present.shape, dtype=object)
+    cells[:] = phyloxml.value_element("Not BLASTed" if do_blast else None, "0")
+    for col_idx, og_name in enumerate(columns):
+        gene_names = prot_ids.get(og_name, {})
+        rows = np.flatnonzero(present[:, col_idx])
+        cells[rows, col_idx] = phyloxml.value_elements(
+            ["OrthoDB: " + gene_names.get(organisms[row], "Not Found") for row in rows.tolist()],
+            "100",
+        )
+    return list(zip(organisms, cells.tolist()))
+
+
 @async_pool.in_process()
-def tree(phyloxml_file:str, OG_names: pd.Series, df: pd.DataFrame, organisms: list[str], output_file:str, do_blast:bool, prot_ids):
+def tree(level_id:int, OG_names: pd.Series, df: pd.DataFrame, organisms: list[str], output_file:str, do_blast:bool, prot_ids):
     df = df[OG_names]
 
     df.clip(upper=1, inplace=True)
@@ -33,38 +51,15 @@ def tree(phyloxml_file:str, OG_names: pd.Series, df: pd.DataFrame, organisms: li
 
     reordered_ind = dendro['leaves']
 
-    parser = ET.XMLParser(remove_blank_text=True)
-    tree = ET.parse(phyloxml_file, parser)
-    root = tree.getroot()
-    graphs = ET.SubElement(root, "graphs")
-    graph = ET.SubElement(graphs, "graph", type="heatmap")
-    ET.SubElement(graph, "name").text = "Presense"
-    legend = ET.SubElement(graph, "legend", show="1")
-
-    for col_idx in reordered_ind:
-        field = ET.SubElement(legend, "field")
-        ET.SubElement(field, "name").text = df.columns[col_idx]
-
-    gradient = ET.SubElement(legend, "gradient")
-    ET.SubElement(gradient, "name").text = "Custom"
-    ET.SubElement(gradient, "classes").text = "4" if do_blast else "2"
-
-    data = ET.SubElement(graph, "data")
-    for index, row in df.iterrows():
-        values = ET.SubElement(data, "values", {"for":str(index)})
-        for col_idx in reordered_ind:
-            el = ET.SubElement(values, "value")
-            if row[df.columns[col_idx]]:
-                el.text = "100"
-                el.attrib["label"] = "OrthoDB: " + prot_ids.get(df.columns[col_idx], {}).get(str(index), "Not Found")
-            else:
-                el.text = "0"
-                if do_blast:
-                    el.attrib["label"] = "Not BLASTed"
-
-
+    columns = df.columns[reordered_ind]
     with open_existing(output_file, 'wb') as f:
-        tree.write(f, xml_declaration=True)
+        phyloxml.write_tree(
+            f,
+            levels.get(level_id).template(),
+            fields=columns,
+            gradient_classes=4 if do_blast else 2,
+            rows=heatmap_rows(df, columns, prot_ids, do_blast),
+        )
 
     return df.shape
 
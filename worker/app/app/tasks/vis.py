@@ -1,10 +1,11 @@
 import asyncio
+import json
 
 from aioredis.client import Pipeline
 from . import vis_sync
 
 from ..task_manager import get_db, queue_manager, cancellation_manager, ReportErrorException
-from ..redis import redis, LEVELS, enqueue
+from ..redis import cache, LEVELS, enqueue
 from ..utils import atomic_file
 from .tree_heatmap import tree, heatmap
 
@@ -38,10 +39,10 @@ async def vis():
     blast_enable, level_id = (await res)[-1]
     blast_enable = bool(blast_enable)
     level_id = int(level_id)
-    level, phyloxml_file = LEVELS[level_id]
+    level, _ = LEVELS[level_id]
 
     organisms, csv_data = await vis_sync.read_org_info(
-        phyloxml_file=phyloxml_file,
+        level_id=level_id,
         og_csv_path=str(db.task_dir/'OG.csv')
     )
     organisms:list[int]
@@ -56,26 +57,62 @@ async def vis():
     corr_info = {}
     prot_ids = {}
 
-    cur_time = int(time.time())
-    async with redis.pipeline(transaction=False) as pipe:
-        for _, data in csv_data.iterrows():
-            label=data['label']
-            pipe.hgetall(f"/cache/corr/{level}/{label}/data")
-            pipe.hgetall(f"/cache/corr/{level}/{label}/gene_names")
-
-            pipe.set(f"/cache/corr/{level}/{label}/accessed", cur_time, xx=True)
-        res = iter(await pipe.execute())
-        for _, data in csv_data.iterrows():
-            og_name=data['Name']
-            ortho_counts = next(res)
-            gene_names = next(res)
-            _ = next(res)
-            if ortho_counts:
-                corr_info[og_name] = ortho_counts
-                prot_ids[og_name] = gene_names
-                db.report_progress(current_delta=1)
-            else:
-                corr_info_to_fetch[og_name] = data['label']
+    # precomputed counts from the local OrthoDB copy (if built)
+    matrix_rows = await vis_sync.get_corr_matrix_rows(
+        level_id=level_id,
+        organisms=organisms,
+        labels=dict(zip(csv_data['Name'], csv_data['label'])),
+    )
+    for og_name, (ortho_counts, gene_names) in matrix_rows.items():
+        corr_info[og_name] = ortho_counts
+        prot_ids[og_name] = gene_names
+    db.report_progress(current_delta=len(matrix_rows))
+    del matrix_rows
+
+    to_request = [
+        (og_name, label)
+        for og_name, label in zip(csv_data['Name'], csv_data['label'])
+        if og_name not in corr_info
+    ]
+
+    # cached counts are int16 vectors aligned to the organisms of the level,
+    # so the key includes the organism order
+    cache_path = f"/cache/corr/{level_id}/{vis_sync.organisms_digest(organisms)}"
+    org_pos = {taxid: i for i, taxid in enumerate(organisms)}
+
+    cache_data = []
+    if to_request:
+        cur_time = int(time.time())
+        async with cache.raw_redis.pipeline(transaction=False) as pipe:
+            pipe.mget(
+                [f"{cache_path}/{label}/counts" for _, label in to_request] +
+                [f"{cache_path}/{label}/gene_names" for _, label in to_request]
+            )
+            cache.touch(pipe, (f"{cache_path}/{label}" for _, label in to_request), cur_time)
+            cache_data = (await pipe.execute())[0]
+
+    cached_counts = cache_data[:len(to_request)]
+    cached_gene_names = cache_data[len(to_request):]
+    del cache_data
+    hits = [
+        i
+        for i, counts in enumerate(cached_counts)
+        if counts is not None and len(counts) == 2*len(organisms)
+    ]
+    if hits:
+        hit_counts = np.frombuffer(
+            b''.join(cached_counts[i] for i in hits),
+            dtype='<i2',
+        ).reshape(len(hits), len(organisms))
+        for row, i in enumerate(hits):
+            og_name = to_request[i][0]
+            corr_info[og_name] = hit_counts[row]
+            prot_ids[og_name] = json.loads(cached_gene_names[i] or b'{}')
+        db.report_progress(current_delta=len(hits))
+    for og_name, label in to_request:
+        if og_name not in corr_info:
+            corr_info_to_fetch[og_name] = label
+    del cached_counts, cached_gene_names
 
     if corr_info_to_fetch:
         db.report_progress(total=-1)
@@ -95,13 +132,14 @@ async def vis():
                 name=name,
                 label=label,
                 level=level,
+                org_pos=org_pos,
             )
             for name, label in corr_info_to_fetch.items()
         ]
         tasks[0].set_progress_callback(progress)
 
         try:
-            async with redis.pipeline(transaction=False) as pipe:
+            async with cache.raw_redis.pipeline(transaction=False) as pipe:
                 for _ in range(3):
                     for f in asyncio.as_completed(tasks):
                         og_name, ortho_counts, gene_names = await f
@@ -109,14 +147,15 @@ async def vis():
                             corr_info_to_retry[og_name] = corr_info_to_fetch[og_name]
                             continue
                         og_name: str
-                        ortho_counts: dict
+                        ortho_counts: np.ndarray
 
                         cur_time = int(time.time())
                         label = corr_info_to_fetch[og_name]
-                        pipe.hset(f"/cache/corr/{level}/{label}/data", mapping=ortho_counts)
-                        pipe.hset(f"/cache/corr/{level}/{label}/gene_names", mapping=gene_names)
-                        pipe.set(f"/cache/corr/{level}/{label}/accessed", cur_time)
-                        pipe.setnx(f"/cache/corr/{level}/{label}/created", cur_time)
+                        pipe.mset({
+                            f"{cache_path}/{label}/counts": ortho_counts.astype('<i2', copy=False).tobytes(),
+                            f"{cache_path}/{label}/gene_names": json.dumps(gene_names, separators=(',', ':')),
+                        })
+                        cache.add(pipe, (f"{cache_path}/{label}",), cur_time)
 
                         corr_info[og_name] = ortho_counts
                         prot_ids[og_name] = gene_names
@@ -130,6 +169,7 @@ async def vis():
                                 name=name,
                                 label=label,
                                 level=level,
+                                org_pos=org_pos,
                             )
                             for name, label in corr_info_to_fetch.items()
                         ]
@@ -145,18 +185,11 @@ async def vis():
             raise
 
     df = pd.DataFrame(
-        data={
-            col_name: pd.Series(
-                data=ortho_counts.values(),
-                index=np.fromiter(ortho_counts.keys(), count=len(ortho_counts), dtype=np.int64),
-                name=col_name,
-            )
-            for col_name, ortho_counts in corr_info.items()
-        },
+        np.column_stack(list(corr_info.values())) if corr_info else np.zeros((len(organisms), 0), dtype=np.int16),
         index=organisms,
+        columns=list(corr_info.keys()),
     )
-    df.fillna(0, inplace=True)
-    df = df.astype(np.int16, copy=False)
+    del corr_info
     db.report_progress(message="Processing correlation data")
 
 
@@ -180,7 +213,7 @@ async def vis():
     tasks.append(
         asyncio.create_task(
             tree(
-                phyloxml_file=phyloxml_file,
+                level_id=level_id,
                 OG_names=csv_data['Name'],
                 df=df,
                 organisms=organisms,
@@ -244,11 +277,13 @@ async def build_tree_csv():
                 status="Executing",
                 pipe=pipe,
             )
-        await res
+            pipe.get(f"/tasks/{db.task_id}/request/tax-level")
+        level_id = int((await res)[-1])
 
         try:
             with atomic_file(db.task_dir/'tree.csv') as tmp_path:
                 await vis_sync.csv_generator(
+                    level_id,
                     str((db.task_dir/'tree.xml').absolute()),
                     tmp_path,
                 )
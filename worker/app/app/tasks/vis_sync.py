@@ -1,11 +1,14 @@
 import csv
+import hashlib
 from logging import exception
 import SPARQLWrapper
+import numpy as np
 import pandas as pd
 import traceback
 from lxml import etree as ET
 
 from ..async_executor import async_pool
+from .. import corr_matrix, levels
 
 ET.register_namespace("xsi", "http://www.w3.org/2001/XMLSchema-instance")
 NS = {
@@ -19,27 +22,37 @@ NS_XPATH = {
 }
 
 @async_pool.in_thread()
-def read_org_info(phyloxml_file:str, og_csv_path:str):
-    parser = ET.XMLParser(remove_blank_text=True)
-    tree = ET.parse(phyloxml_file, parser)
-    root = tree.getroot()
-
-    orgs_xml = root.xpath("//pxml:id/..", namespaces={'pxml':"http://www.phyloxml.org"})
-    # Assuming only children have IDs
-    orgs = []
-    for org_xml in orgs_xml:
-        try:
-            org_id = org_xml.find("id", NS).text
-            orgs.append(int(org_id))
-        except Exception:
-            # org_id contains letters, this could happen for missing organ
-            pass
-
+def read_org_info(level_id:int, og_csv_path:str):
+    orgs = levels.get(level_id).organism_list()
     csv_data = pd.read_csv(og_csv_path, sep=';')
     return orgs, csv_data
 
+@async_pool.in_thread()
+def get_corr_matrix_rows(level_id:int, organisms:list[int], labels:dict[str, str]) -> dict[str, tuple[np.ndarray, dict[str, str]]]:
+    """Counts from the precomputed matrix: "Name" -> (counts aligned to organisms, gene names)"""
+    matrix = corr_matrix.load(level_id)
+    if matrix is None:
+        return {}
+    return matrix.rows(labels, organisms)
+
+
+def counts_to_vector(ortho_counts:dict[str, int], org_pos:dict[int, int]) -> np.ndarray:
+    """{taxid: count} -> counts aligned to organisms, taxids outside of the tree are dropped"""
+    res = np.zeros(len(org_pos), dtype=np.int16)
+    for taxid, count in ortho_counts.items():
+        pos = org_pos.get(int(taxid))
+        if pos is not None:
+            res[pos] = min(int(count), np.iinfo(np.int16).max)
+    return res
+
+
+def organisms_digest(organisms:list[int]) -> str:
+    """Short id of the organism order that the cached count vectors are aligned to"""
+    return hashlib.sha1(np.array(organisms, dtype='<i8').tobytes()).hexdigest()[:12]
+
+
 @async_pool.in_thread(max_pool_share=0.5)
-def get_corr_data(label:str, name:str, level:str) -> tuple[str, dict]:
+def get_corr_data(label:str, name:str, level:str, org_pos:dict[int, int]) -> tuple[str, np.ndarray, dict]:
     endpoint = SPARQLWrapper.SPARQLWrapper("http://sparql.orthodb.org/sparql")
 
     try:
@@ -73,7 +86,7 @@ def get_corr_data(label:str, name:str, level:str) -> tuple[str, dict]:
             ortho_counts[taxid] = int(orthologs_count)
             gene_names[taxid] = row_gene_names
 
-        return name, ortho_counts, gene_names
+        return name, counts_to_vector(ortho_counts, org_pos), gene_names
     except Exception:
         try:
             endpoint.setQuery(
@@ -104,38 +117,27 @@ def get_corr_data(label:str, name:str, level:str) -> tuple[str, dict]:
                 ortho_counts[taxid] = int(orthologs_count)
                 gene_names[taxid] = "<sparql error>"
 
-            return name, ortho_counts, gene_names
+            return name, counts_to_vector(ortho_counts, org_pos), gene_names
         except Exception:
             traceback.print_exc()
             return name, None, None
 
 
 @async_pool.in_process()
-def csv_generator(phyloxml_file:str, csv_file:str):
-    parser = ET.XMLParser(remove_blank_text=True)
-    tree = ET.parse(phyloxml_file, parser)
-    root = tree.getroot()
-    heatmap_data = root.find('.//graphs/graph/data', NS)
-
-    orgs_xml = root.xpath("//pxml:id/..", namespaces={'pxml':"http://www.phyloxml.org"})
-    # Assuming only children have IDs
-    orgs = []
-    for org_xml in orgs_xml:
-        try:
-            orgs.append((int(org_xml.find("id", NS).text), org_xml.find("name", NS).text))
-        except Exception:
-            # org_id contains letters, this could happen for missing organism
-            pass
+def csv_generator(level_id:int, phyloxml_file:str, csv_file:str):
+    level = levels.get(level_id)
+    fields = []
+    labels = {}
+    # only the heatmap is read, organisms come from the level registry
+    for _, el in ET.iterparse(phyloxml_file, tag=(f"{{{NS['']}}}name", f"{{{NS['']}}}values")):
+        if el.tag.endswith("}values"):
+            labels[el.attrib['for']] = [value.attrib.get('label', '-') for value in el]
+            el.clear()
+        elif el.getparent().tag.endswith("}field"):
+            fields.append(el.text)
 
     with open(csv_file, 'w', newline='') as csvfile:
         spamwriter = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
-        row = [""]
-        for el in tree.getroot().findall('.//graphs/graph/legend/field/name', NS):
-            row.append(el.text)
-        spamwriter.writerow(row)
-        for tax_id, org_name in orgs:
-            row[0] = org_name
-            for i, el in enumerate(heatmap_data.xpath(f"(./pxml:values[@for='{tax_id}']/pxml:value)", namespaces=NS_XPATH), 1):
-                row[i] = el.attrib.get('label', '-')
-            spamwriter.writerow(row)
-
+        spamwriter.writerow([""] + fields)
+        for tax_id, org_name in zip(level.organism_list(), level.names):
+            spamwriter.writerow([org_name] + labels.get(str(tax_id), []))
@@ -2,6 +2,14 @@ from .utils import (
     decode_int,
     DEBUG,
     DATA_PATH,
+    ORTHODB_SQLITE,
+    CORR_MATRIX_PATH,
+    PHYLOXML_PATH,
+    LEVELS_PATH,
+    SSR_BROWSER,
+    NCBI_URL,
+    BLAST_DB,
+    list_level_files,
     atomic_file,
     open_existing,
 )
\ No newline at end of file
@@ -15,6 +15,21 @@ def decode_int(item:Text, default=0) -> int:
 
 DEBUG = bool(os.environ.get('DEBUG', '').strip())
 DATA_PATH = Path.cwd() / "user_data"
+# Path to the OrthoDB sqlite database built by support_scripts/orthodb
+# if set, OrthoDB is queried locally instead of sparql.orthodb.org
+ORTHODB_SQLITE = os.environ.get('ORTHODB_SQLITE', '').strip()
+# Precomputed ortholog count matrices (see app/corr_matrix.py), built next to the db
+CORR_MATRIX_PATH = Path(ORTHODB_SQLITE).parent / "corr_matrix" if ORTHODB_SQLITE else None
+PHYLOXML_PATH = Path.cwd() / "phyloxml"
+# parsed phyloxml levels shared by the worker processes, see app/levels.py
+LEVELS_PATH = Path(tempfile.gettempdir()) / "levels"
+# render SSR images with headless chromium instead of tasks/ssr_sync
+SSR_BROWSER = bool(os.environ.get('SSR_BROWSER', '').strip())
+# NCBI BLAST web server, point it to a local server for testing
+NCBI_URL = os.environ.get('NCBI_URL', '').strip().rstrip('/') or "https://blast.ncbi.nlm.nih.gov"
+# blastp database (e.g. "/blast/blastdb/nr"), if set BLAST searches run locally
+# instead of the NCBI web BLAST, see tasks/blast_local.py
+BLAST_DB = os.environ.get('BLAST_DB', '').strip()
 
 
 @contextlib.contextmanager
@@ -32,6 +47,31 @@ def atomic_file(file:Path):
     else:
         os.replace(tmp, file)
 
+def list_level_files(phyloxml_dir:Path=PHYLOXML_PATH) -> list[tuple[int, str, str, str]]:
+    """Returns sorted (id, level, name, path) for every phyloxml file, see phyloxml/README.md"""
+    l = []
+    for file in phyloxml_dir.glob("*.xml"):
+        items = file.stem.split("_", maxsplit=2)
+        if len(items) == 3:
+            id, level, name = items
+        elif len(items) == 2:
+            id, level = items
+            name = level
+        else:
+            raise RuntimeError(f"incorrect file name {file}")
+
+        l.append(
+            (
+                int(id),
+                level,
+                name,
+                str(file.resolve()),
+            )
+        )
+
+    l.sort()
+    return l
+
 def _if_exists(path, flags):
     flags &= ~os.O_CREAT
     return os.open(path, flags)
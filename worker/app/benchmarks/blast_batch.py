@@ -0,0 +1,100 @@
+"""Decisions of the submission sizing (tasks/blast_backend.py: BatchController)
+
+Run from /app inside of the worker container:
+    python3 -m benchmarks.blast_batch [cpu_limit] [submissions]
+
+Deterministic, nothing is requested. First the single steps: "CPU usage limit"
+errors shrink the proteins down to one, then the organisms, and aren't grown
+into again for a while, fast full submissions grow the proteins up to the max,
+then the organisms. Then a long queue of submissions against the rule of the
+fake NCBI (benchmarks/fake_ncbi.py): searches of more than cpu_limit
+(protein, organism) pairs fail.
+"""
+import sys
+
+from app.tasks.blast_backend import BatchController
+
+FAST = 60.0
+
+
+def check_steps():
+    batch = BatchController(prots=5, organisms=400)
+    batch.too_large(5, 400)
+    assert (batch.prots, batch.organisms) == (2, 400), "proteins shrink first"
+    batch.too_large(2, 400)
+    batch.too_large(1, 400)
+    assert (batch.prots, batch.organisms) == (1, 200), "organisms shrink with a single protein"
+    batch.too_large(1, 200)
+    assert (batch.prots, batch.organisms) == (1, 100)
+    # errors of submissions sized before the last decrease don't shrink it again
+    batch.too_large(1, 400)
+    assert (batch.organisms, batch.ceiling) == (100, 200), "stale submissions shrink twice"
+
+    # sizes of the errors aren't reached again for a while
+    for _ in range(BatchController.CEILING_SUBMISSIONS - 1):
+        batch.success(batch.prots, batch.organisms, FAST, queue_depth=10)
+    assert (batch.prots, batch.organisms) == (1, 180), "the batch grows into the cpu limit"
+    batch.success(batch.prots, batch.organisms, FAST, queue_depth=10)
+    # probed again, proteins first
+    assert batch.ceiling == 0 and (batch.prots, batch.organisms) == (2, 180), "the cpu limit isn't probed again"
+
+    batch = BatchController(prots=2, organisms=50)
+    # not full or nothing waiting: no growth
+    batch.success(1, 30, FAST, queue_depth=10)
+    batch.success(2, 50, FAST, queue_depth=0)
+    assert (batch.prots, batch.organisms) == (2, 50), "the batch grows without a reason"
+    for _ in range(BatchController.MAX_PROTS - 2):
+        batch.success(batch.prots, batch.organisms, FAST, queue_depth=10)
+    assert (batch.prots, batch.organisms) == (BatchController.MAX_PROTS, 50), "proteins grow first"
+    batch.success(batch.prots, batch.organisms, FAST, queue_depth=10)
+    assert batch.organisms == 50 + BatchController.ORGANISM_INCR, "organisms grow at max proteins"
+
+    batch.success(batch.prots, batch.organisms, BatchController.TARGET_ELAPSED + 1, queue_depth=10)
+    assert batch.prots == BatchController.MAX_PROTS // 2, "slow submissions shrink the batch"
+    print("steps are as expected")
+
+
+def simulate(cpu_limit, submissions):
+    """Full submissions of a long queue, searches over cpu_limit pairs fail"""
+    batch = BatchController()
+    errors = 0
+    pairs = 0
+    for _ in range(submissions):
+        prots, organisms = batch.prots, batch.organisms
+        if prots * organisms > cpu_limit:
+            errors += 1
+            batch.too_large(prots, organisms)
+        else:
+            pairs += prots * organisms
+            batch.success(prots, organisms, FAST, queue_depth=100)
+    return batch, errors, pairs
+
+
+def main():
+    args = [int(arg) for arg in sys.argv[1:]]
+    if len(args) > 2:
+        print(__doc__)
+        sys.exit(1)
+    cpu_limit, submissions = args + [600, 200][len(args):]
+
+    check_steps()
+
+    batch, errors, pairs = simulate(cpu_limit, submissions)
+    metrics = batch.metrics()
+    print(
+        f"cpu limit {cpu_limit} pairs, {submissions} submissions: {errors} cpu limit errors, "
+        f"{pairs/(submissions - errors):.0f} pairs per search, "
+        f"{metrics['increases']} increases, {metrics['decreases']} decreases, "
+        f"last size {batch.prots}x{batch.organisms}"
+    )
+    if cpu_limit >= BatchController.MAX_PROTS * BatchController.MAX_ORGANISMS:
+        assert not errors and (batch.prots, batch.organisms) == (BatchController.MAX_PROTS, BatchController.MAX_ORGANISMS), "the batch doesn't grow to the max"
+    else:
+        assert errors and metrics["increases"], "the limit isn't reached"
+    assert errors <= submissions // 5, "too many cpu limit errors"
+    assert pairs / (submissions - errors) >= cpu_limit / 4, "searches stay too small"
+    print("decisions are as expected")
+
+
+if __name__ == "__main__":
+    main()
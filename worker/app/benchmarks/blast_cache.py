@@ -0,0 +1,101 @@
+"""Decoding cached BLAST hits: packed records (blast_sync.unpack_hits) vs the old CSV values
+
+Run from /app inside of the worker container:
+    python3 -m benchmarks.blast_cache [prots] [taxids] [hits_per_page]
+
+Times what blast() does with a fully cached request before the first render:
+decoding the cached value of every (protein, taxid) and building the heatmap labels.
+"""
+import io
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from app.tasks.blast_sync import prune_hits, pack_hits, unpack_hits
+from benchmarks.blast_prune import synthetic_page
+
+COLS = {
+    'evalue': np.float64,
+    'pident': np.float64,
+    'qcov'  : np.float64,
+    'id'    : pd.StringDtype(),
+}
+USER_REQ_COLS = list(COLS.keys())[:-1]
+
+
+def decode_csv(values, user_cond):
+    # implementation used before the packed records
+    labels = []
+    for data in values:
+        if not data:
+            labels.append(None)
+            continue
+        df = pd.read_csv(
+            io.BytesIO(data),
+            header=None, names=COLS.keys(), engine="c", dtype=COLS,
+        )
+        hits = (df[USER_REQ_COLS].to_numpy() >= user_cond).all(axis=1)
+        labels.append("BLAST: "+(df["id"][hits].str.cat(sep=";")) if hits.any() else None)
+    return labels
+
+
+def decode_packed(values, user_cond):
+    labels = []
+    for data in values:
+        hits = unpack_hits(data)
+        if hits is None:
+            labels.append(None)
+            continue
+        matches = (hits.points >= user_cond).all(axis=1)
+        labels.append(
+            "BLAST: "+";".join(prot_id for prot_id, match in zip(hits.ids, matches.tolist()) if match)
+            if matches.any() else None
+        )
+    return labels
+
+
+def main():
+    args = [int(arg) for arg in sys.argv[1:]]
+    if len(args) > 3:
+        print(__doc__)
+        sys.exit(1)
+    prot_count, taxids, hits = args + [700, 20, 200][len(args):]
+
+    rng = np.random.default_rng(0)
+    csv_values = []
+    packed_values = []
+    for _ in range(prot_count):
+        pruned = prune_hits(synthetic_page(rng, hits, taxids))
+        for taxid in range(1, taxids + 1):
+            df = pruned.get(taxid * 1000)
+            if df is None:
+                csv_values.append(b'')
+                packed_values.append(b'')
+            else:
+                csv_values.append(df.to_csv(header=False, index=False)[:-1].encode())
+                packed_values.append(pack_hits(df))
+    print(
+        f"{prot_count} proteins x {taxids} taxids, "
+        f"csv: {sum(map(len, csv_values))/2**20:.1f} MiB, "
+        f"packed: {sum(map(len, packed_values))/2**20:.1f} MiB"
+    )
+
+    user_cond = np.array([-np.log10(1e-5), 50.0, 50.0])
+    start = time.perf_counter()
+    csv_labels = decode_csv(csv_values, user_cond)
+    csv_time = time.perf_counter() - start
+    print(f"csv + read_csv: {csv_time:.2f}s")
+    start = time.perf_counter()
+    packed_labels = decode_packed(packed_values, user_cond)
+    packed_time = time.perf_counter() - start
+    print(f"packed records: {packed_time:.2f}s")
+    print(f"speedup: {csv_time/packed_time:.1f}x")
+
+    assert csv_labels == packed_labels, "labels differ"
+    print("labels are equal")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""Load test of the blast stage against the fake NCBI server (benchmarks/fake_ncbi.py)
+
+Run from /app inside of the worker container, preferably with a scratch redis:
+    NCBI_URL=http://localhost:8090 python3 -m benchmarks.blast_e2e [tasks] [prots_per_task] [taxids_per_task]
+
+Starts the fake server on the port of NCBI_URL and runs the tasks at the same time,
+every task resolves its organisms and blasts its (protein, taxid) pairs with blast_pairs,
+proteins overlap between the tasks. Organism names are cached up front as they
+are in production, except UNCACHED_TAXIDS looked up by the tasks. Reports tasks/hour, requests, retries, decisions of
+the batch controller and the peak memory of the stage, and checks the hits every task
+got against the ones the fake generated. Cache entries and organism names of the
+run are deleted in the end.
+"""
+import asyncio
+import random
+import subprocess
+import sys
+import time
+from urllib.parse import urlparse
+
+import httpx
+import numpy as np
+
+from app.async_executor import async_pool
+from app.redis import cache
+from app.utils import NCBI_URL
+from app.tasks import blast, blast_sync
+from app.tasks.blast_coalescer import coalescer
+from app.tasks.blast_gateway import gateway
+from app.tasks.blast_ncbi import NcbiBackend
+from benchmarks.blast_pages import peak_rss
+from benchmarks.fake_ncbi import FakeConfig, HitSource, organism_name
+
+FAKE_CONFIG = FakeConfig(
+    seed=0,
+    search_time=2.0,
+    pair_time=0.001,
+    error_rate=0.02,
+    cpu_limit=600,
+)
+# taxids that don't exist, names the fake gives them mustn't mix with the real ones
+TAXID_BASE = 10**9
+TAXID_POOL = 300
+UNCACHED_TAXIDS = 5
+
+
+class ProgressLog():
+    def report_progress(self, **kwargs):
+        pass
+
+
+def make_tasks(count, prots_per_task, taxids_per_task, seed=0) -> list[dict[str, set[int]]]:
+    rng = random.Random(seed)
+    # every protein is wanted by 2 tasks on average
+    prots = [f"B{n:05d}" for n in range(max(1, count * prots_per_task // 2))]
+    taxids = range(TAXID_BASE, TAXID_BASE + TAXID_POOL)
+    return [
+        {
+            prot: set(rng.sample(taxids, taxids_per_task))
+            for prot in rng.sample(prots, min(prots_per_task, len(prots)))
+        }
+        for _ in range(count)
+    ]
+
+
+async def run_task(task_id, prots_to_get:dict[str, set[int]]) -> dict[str, dict]:
+    received = {}
+    async with blast.backend.session(task_id) as sess:
+        taxids = set().union(*prots_to_get.values())
+        taxid_to_organism = await blast.backend.organisms(sess, taxids, ProgressLog())
+        futures = coalescer.join(prots_to_get, taxid_to_organism)
+        await blast.blast_pairs(sess, futures, received.update)
+    return received
+
+
+def check(tasks, results):
+    hit_source = HitSource(FAKE_CONFIG)
+    expected = {}
+    for prots_to_get, received in zip(tasks, results):
+        assert received.keys() == prots_to_get.keys(), "missing proteins"
+        for prot, taxids in prots_to_get.items():
+            if prot not in expected:
+                all_taxids = list(range(TAXID_BASE, TAXID_BASE + TAXID_POOL))
+                pruned = blast_sync.prune_hits(blast_sync.prepare_hits(hit_source.hits(prot, all_taxids)))
+                expected[prot] = {
+                    taxid: blast_sync.unpack_hits(blast_sync.pack_hits(hits))
+                    for taxid, hits in pruned.items()
+                }
+            assert received[prot].keys() == taxids, "missing taxids"
+            for taxid, hits in received[prot].items():
+                exp = expected[prot].get(taxid)
+                if exp is None or hits is None:
+                    assert exp is hits, "hits differ"
+                else:
+                    assert hits.ids == exp.ids and np.array_equal(hits.points, exp.points), "hits differ"
+
+
+async def cache_organisms():
+    await cache.redis.hset("/cache/taxids-for-blast", mapping={
+        taxid: organism_name(taxid)
+        for taxid in range(TAXID_BASE + UNCACHED_TAXIDS, TAXID_BASE + TAXID_POOL)
+    })
+
+
+async def cleanup(tasks):
+    prots = set().union(*tasks)
+    async with cache.redis.pipeline(transaction=False) as pipe:
+        cache.delete(pipe, (f"/cache/blast/{prot}" for prot in prots))
+        pipe.hdel("/cache/taxids-for-blast", *range(TAXID_BASE, TAXID_BASE + TAXID_POOL))
+        await pipe.execute()
+
+
+async def main():
+    args = [int(arg) for arg in sys.argv[1:]]
+    url = urlparse(NCBI_URL)
+    if len(args) > 3 or url.hostname not in ("localhost", "127.0.0.1") or not isinstance(blast.backend, NcbiBackend):
+        print(__doc__)
+        sys.exit(1)
+    task_count, prots_per_task, taxids_per_task = args + [6, 8, 60][len(args):]
+
+    fake = subprocess.Popen([
+        sys.executable, "-m", "benchmarks.fake_ncbi",
+        "--port", str(url.port),
+        "--seed", str(FAKE_CONFIG.seed),
+        "--search-time", str(FAKE_CONFIG.search_time),
+        "--pair-time", str(FAKE_CONFIG.pair_time),
+        "--error-rate", str(FAKE_CONFIG.error_rate),
+        "--cpu-limit", str(FAKE_CONFIG.cpu_limit),
+    ])
+    tasks = make_tasks(task_count, prots_per_task, taxids_per_task)
+    try:
+        await cache_organisms()
+        async with httpx.AsyncClient() as client:
+            for _ in range(100):
+                try:
+                    await client.get(f"{NCBI_URL}/fake/stats")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+
+            async with async_pool:
+                rss_before = peak_rss()
+                start = time.perf_counter()
+                results = await asyncio.gather(*(
+                    run_task(f"benchmark-{i}", prots_to_get)
+                    for i, prots_to_get in enumerate(tasks)
+                ))
+                elapsed = time.perf_counter() - start
+                rss = peak_rss() - rss_before
+                await gateway.aclose()
+            fake_stats = (await client.get(f"{NCBI_URL}/fake/stats")).json()
+    finally:
+        fake.terminate()
+        fake.wait()
+        await cleanup(tasks)
+
+    pairs = sum(len(taxids) for prots_to_get in tasks for taxids in prots_to_get.values())
+    batch = blast.backend.batch.metrics()
+    print(
+        f"{task_count} tasks, {pairs} (protein, taxid) pairs in {elapsed:.1f}s: "
+        f"{task_count/elapsed*3600:.0f} tasks/hour, {pairs/elapsed*3600:.0f} pairs/hour"
+    )
+    print(
+        f"requests: {gateway.counters['requests']}, retries: {gateway.counters['retries']}, "
+        f"injected errors: {fake_stats.get('errors', 0)}"
+    )
+    print(
+        f"searches: {fake_stats.get('searches', 0)} ({fake_stats.get('pairs', 0)} pairs), "
+        f"cpu limit errors: {batch['cpu_limit_errors']}, deleted: {fake_stats.get('deleted', 0)}"
+    )
+    print(
+        f"batch: {batch['prots_per_request']} proteins, {batch['organisms_per_request']} organisms, "
+        f"{batch['increases']} increases, {batch['decreases']} decreases, ceiling {batch['pairs_ceiling']} pairs"
+    )
+    print(f"peak rss of the stage: +{rss/1024:.1f}MiB")
+
+    check(tasks, results)
+    print("hits are equal")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,116 @@
+"""Local BLAST engine: sharded, streamed blastp (tasks/blast_local.py) vs one blastp run per protein
+
+Run from /app inside of the worker container:
+    python3 -m benchmarks.blast_local
+
+A database is built from the bundled benchmarks/data/blast_local.fasta
+(4 query proteins Q00001-Q00004 and their homologs in taxids 1001-1030).
+Both engines have to return the same packed hits for every (protein, taxid).
+"""
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from app.async_executor import async_pool
+from app.tasks import blast_local, blast_local_sync, blast_sync
+from app.tasks.blast_backend import BackendSession
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+PROTS = ["Q00001", "Q00002", "Q00003", "Q00004"]
+TAXIDS = list(range(1001, 1031))
+
+
+def make_db(tmp_dir):
+    db = os.path.join(tmp_dir, "blast_local")
+    subprocess.run(
+        [
+            "makeblastdb",
+            "-in", os.path.join(DATA_DIR, "blast_local.fasta"),
+            "-dbtype", "prot",
+            "-parse_seqids",
+            "-taxid_map", os.path.join(DATA_DIR, "blast_local.taxid_map"),
+            "-blastdb_version", "5",
+            "-out", db,
+        ],
+        check=True, capture_output=True,
+    )
+    return db
+
+
+def blast_whole(db, fasta, taxids, tmp_dir):
+    # single blastp run for all the taxids, output read and pruned at once
+    query = os.path.join(tmp_dir, "query.fa")
+    taxids_file = os.path.join(tmp_dir, "query.taxids")
+    out = os.path.join(tmp_dir, "out.tsv")
+    with open(query, "w") as f:
+        f.write(fasta)
+    with open(taxids_file, "w") as f:
+        f.write("\n".join(map(str, taxids)))
+    subprocess.run(
+        [
+            "blastp",
+            "-query", query,
+            "-taxidlist", taxids_file,
+            "-db", db,
+            "-outfmt", blast_local_sync.OUTFMT,
+            "-num_threads", str(blast_local.THREADS_PER_SHARD * blast_local.MAX_SHARDS),
+            "-out", out,
+            *blast_local.SEARCH_ARGS,
+        ],
+        check=True, capture_output=True,
+    )
+    with open(out, "rb") as f:
+        data = f.read()
+    if not data:
+        return {}
+    df = blast_sync.prepare_hits(blast_local_sync.read_tabular(data, set(taxids)))
+    return {
+        taxid: blast_sync.pack_hits(hits)
+        for taxid, hits in blast_sync.prune_hits(df).items()
+    }
+
+
+async def main():
+    if len(sys.argv) > 1:
+        print(__doc__)
+        sys.exit(1)
+
+    async with async_pool:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = make_db(tmp_dir)
+            # tiny database: split the taxids and the output anyway
+            blast_local.MIN_TAXIDS_PER_SHARD = 5
+            blast_local.STREAM_CHUNK = 4096
+
+            backend = blast_local.LocalBackend(db)
+            start = time.perf_counter()
+            sharded, cleanup = await backend.search(BackendSession("benchmark"), PROTS, list(map(str, TAXIDS)))
+            await cleanup
+            sharded_time = time.perf_counter() - start
+            shards = len(blast_local.plan_shards(PROTS, TAXIDS))
+            print(f"sharded: {sharded_time:.2f}s, {shards} blastp runs, up to {blast_local.MAX_SHARDS} at once")
+
+            start = time.perf_counter()
+            whole = {}
+            for prot in PROTS:
+                fasta = await backend.query_fasta(prot)
+                whole[prot] = blast_whole(db, fasta, TAXIDS, tmp_dir) if fasta else {}
+            whole_time = time.perf_counter() - start
+            print(f"one run per protein: {whole_time:.2f}s")
+            print(f"speedup: {whole_time/sharded_time:.1f}x")
+
+            hits = sum(
+                len(blast_sync.unpack_hits(data).ids)
+                for res in sharded.values()
+                for data in res.values()
+            )
+            print(f"{sum(map(len, sharded.values()))} (protein, taxid) with {hits} pruned hits")
+            assert sharded == whole, "results differ"
+            print("results are equal")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
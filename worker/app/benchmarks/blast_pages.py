@@ -0,0 +1,188 @@
+"""BLAST result page parsing: blast_sync.parse_page (lxml) vs the old BeautifulSoup parser
+
+Run from /app inside of the worker container:
+    python3 -m benchmarks.blast_pages [PAGE.html ...]
+
+PAGE.html is a saved NCBI result page (the one requested with DESCRIPTIONS=5000),
+without arguments a synthetic 5000-hit page is used.
+"""
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from bs4 import BeautifulSoup
+
+from app.tasks.blast_sync import parse_page, COLS
+
+
+def parse_page_bs4(raw_content: bytes):
+    # implementation used before the lxml parser
+    soup = BeautifulSoup(raw_content, 'html.parser')
+
+    form = soup.find("form", id="results")
+    params = {}
+    for inp in form.find_all("input"):
+        if 'name' in inp.attrs and 'value' in inp.attrs:
+            params[inp['name']] = inp['value']
+
+    columns_to_extract = {
+        "Taxid": None,
+        "E value": None,
+        "Per. Ident": None,
+        "Query Cover": None,
+        "Accession": None,
+    }
+
+    table = soup.find("table", id="dscTable")
+    header = table.find("thead").find("tr").find_all("th")
+    for idx, col in enumerate(header):
+        col_name = col.text.strip()
+        if col_name in columns_to_extract:
+            columns_to_extract[col_name] = idx
+
+    columns_to_extract = tuple(columns_to_extract.values())
+
+    if None in columns_to_extract:
+        raise RuntimeError("Missing columns!")
+
+    data = []
+    row = table.find("tbody").find("tr")
+    while row:
+        tds = row.find_all("td")
+        data.append((
+            int(tds[columns_to_extract[0]].text.strip("\n ")),
+            float(tds[columns_to_extract[1]].text.strip("\n ")),
+            float(tds[columns_to_extract[2]].text.strip("\n %")),
+            float(tds[columns_to_extract[3]].text.strip("\n %")),
+            tds[columns_to_extract[4]].text.strip(),
+        ))
+        row = row.find_next_sibling("tr")
+    df = pd.DataFrame(data, columns=COLS.keys())
+    for col, dtype in COLS.items():
+        df[col] = df[col].astype(dtype=dtype, copy=False)
+    return df, params
+
+
+PARSERS = {
+    "bs4": parse_page_bs4,
+    "lxml": parse_page,
+}
+
+
+def synthetic_page(hits=5000, seed=0) -> bytes:
+    # mimics the layout of the NCBI page: results form, descriptions table, alignments
+    rng = np.random.default_rng(seed)
+    rows = []
+    alignments = []
+    for i in range(hits):
+        evalue = f"{rng.uniform(1, 9):.0f}e-{rng.integers(5, 180)}"
+        rows.append(
+            f'<tr class="dflLnk"><td class="l c0"><span class="ind"><input type="checkbox" class="cb" '
+            f'id="chk_{i}" name="getSeqGi" value="XP_{i:09d}.1"></span></td>'
+            f'<td class="ellipsis c1"><span><a href="#alnHdr_{i}" class="deflnDesc" seqfsta="XP_{i:09d}.1">'
+            f'hypothetical protein LOC{i} [Some organism {i % 300}]</a></span></td>'
+            f'<td class="c2 l lim"><span>Some organism {i % 300}</span></td>'
+            f'<td class="c3 l lim"><span>Organism {i % 300}</span></td>'
+            f'<td class="c4">{rng.uniform(30, 900):.1f}</td><td class="c5">{rng.uniform(30, 900):.1f}</td>'
+            f'<td class="c6">{rng.integers(10, 101)}%</td><td class="c7">{evalue}</td>'
+            f'<td class="c8">{rng.uniform(20, 100):.2f}%</td><td class="c9">{rng.integers(100, 2000)}</td>\n'
+            f'<td class="c10 l lim"><a href="https://www.ncbi.nlm.nih.gov/protein/XP_{i:09d}.1">XP_{i:09d}.1</a></td>'
+            f'<td class="c11">\n{1000 + i % 300} </td></tr>\n'
+        )
+        alignments.append(
+            f'<div class="oneSeqAln" id="aln_{i}"><div class="dlfRow"><a name="alnHdr_{i}"></a>'
+            f'<pre>Query  1    MSTNPKPQRKTKRNTNRRPQDVKFPGG  27\n'
+            f'            MSTNPKPQRKTKRNTNRRPQDVKFPGG\nSbjct  1    MSTNPKPQRKTKRNTNRRPQDVKFPGG  27</pre></div></div>\n'
+        )
+    header = "".join(
+        f'<th class="c{i}">{name}</th>'
+        for i, name in enumerate((
+            "", "Description", "Scientific Name", "Common Name", "Max Score", "Total Score",
+            "Query Cover", "E value", "Per. Ident", "Acc. Len", "Accession", "Taxid",
+        ))
+    )
+    return (
+        '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" '
+        '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml" lang="en"><head><meta charset="utf-8">'
+        '<title>NCBI Blast:Protein Sequence</title><script>var tm = "";</script></head><body>\n'
+        '<div id="wrap"><div id="content"><form action="Blast.cgi" method="post" name="results" id="results">\n'
+        '<input name="RID" value="ABCDEF01016" type="hidden"><input name="CMD" value="Get" type="hidden">\n'
+        '<input name="QUERY_INDEX" value="0" type="hidden"><input name="DESCRIPTIONS" value="5000" type="hidden">\n'
+        '<select name="queryList" id="queryList"><option value="0" selected="selected">'
+        'Query_1 sp|P12345|PROT_HUMAN</option></select>\n'
+        f'<table id="dscTable" class="jig-ncbigrid"><thead><tr>{header}</tr></thead><tbody>\n'
+        f'{"".join(rows)}</tbody></table>\n'
+        f'<div id="alignments">{"".join(alignments)}</div>\n'
+        '<input name="ALIGNMENTS" value="100" type="hidden"></form></div></div></body></html>\n'
+    ).encode()
+
+
+def measure_rss(parser_name, path):
+    # peak rss of parsing in a fresh interpreter
+    res = subprocess.run(
+        [sys.executable, "-m", "benchmarks.blast_pages", "--rss", parser_name, path],
+        check=True, capture_output=True, text=True,
+    )
+    return int(res.stdout.split()[-1])
+
+
+def peak_rss():
+    # ru_maxrss survives exec on linux and would report the peak of the parent
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def rss_child(parser_name, path):
+    with open(path, "rb") as f:
+        raw_content = f.read()
+    before = peak_rss()
+    PARSERS[parser_name](raw_content)
+    print(peak_rss() - before)
+
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == "--rss":
+        rss_child(sys.argv[2], sys.argv[3])
+        return
+    if any(arg.startswith("-") for arg in sys.argv[1:]):
+        print(__doc__)
+        sys.exit(1)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pages = sys.argv[1:]
+        if not pages:
+            pages = [os.path.join(tmp_dir, "synthetic.html")]
+            with open(pages[0], "wb") as f:
+                f.write(synthetic_page())
+
+        for path in pages:
+            with open(path, "rb") as f:
+                raw_content = f.read()
+            print(f"{os.path.basename(path)}: {len(raw_content)/2**20:.1f}MiB")
+
+            results = {}
+            times = {}
+            for name, parser in PARSERS.items():
+                start = time.perf_counter()
+                results[name] = parser(raw_content)
+                times[name] = time.perf_counter() - start
+                rss = measure_rss(name, path)
+                print(f"  {name:5}: {times[name]:.3f}s, peak rss +{rss/1024:.1f}MiB, {len(results[name][0])} hits")
+            print(f"  speedup: {times['bs4']/times['lxml']:.1f}x")
+
+            pd.testing.assert_frame_equal(results["bs4"][0], results["lxml"][0])
+            assert results["bs4"][1] == results["lxml"][1], "form parameters differ"
+            print("  results are equal")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Waiting for the pairs of a task (tasks/blast.py: blast_pairs) when a protein is split between submissions
+
+Run from /app inside of the worker container:
+    python3 -m benchmarks.blast_pairs [taxids] [slow_seconds]
+
+One protein, its taxids don't fit one submission. The first submission finishes
+at once, the second one after slow_seconds. Every pass of the loop is counted,
+the loop has to sleep until the second submission is done instead of waking up
+on the already resolved taxids of the first one.
+Submissions are simulated, no requests are made and nothing is cached.
+"""
+import asyncio
+import sys
+import time
+
+import numpy as np
+
+from app.tasks import blast
+from app.tasks.blast_backend import BackendSession
+from app.tasks.blast_coalescer import coalescer
+from app.tasks.blast_sync import Hits
+
+PROT = "P00001"
+# a pass per finished submission and its futures at most, plus the first one
+MAX_PASSES = 5
+
+
+def fake_hits(taxid):
+    return Hits(np.full((1, 3), taxid, dtype=np.float64), [f"XP_{taxid:06d}.1"])
+
+
+async def main():
+    args = [arg for arg in sys.argv[1:]]
+    if len(args) > 2:
+        print(__doc__)
+        sys.exit(1)
+    taxid_count = int(args[0]) if args else 30
+    slow = float(args[1]) if len(args) > 1 else 1.0
+    taxids = set(range(1, taxid_count + 1))
+
+    delays = [0.0, slow]
+
+    async def fake_request_task(sess, chunk):
+        await asyncio.sleep(delays.pop(0))
+        coalescer.done(chunk, {
+            prot: {taxid: fake_hits(taxid) for taxid in chunk_taxids}
+            for prot, chunk_taxids in chunk.items()
+        })
+
+    passes = 0
+    returned = coalescer.returned
+
+    def counting_returned():
+        # called once per pass of the loop
+        nonlocal passes
+        passes += 1
+        return returned()
+
+    blast.blast_request_task = fake_request_task
+    coalescer.returned = counting_returned
+    # the first submission takes half of the taxids
+    blast.backend.batch.organisms = taxid_count // 2
+
+    results = {}
+    futures = coalescer.join({PROT: taxids}, {taxid: str(taxid) for taxid in taxids})
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    await blast.blast_pairs(BackendSession("benchmark"), futures, results.update)
+    cpu = time.process_time() - cpu_start
+    elapsed = time.perf_counter() - start
+
+    print(f"{taxid_count} taxids in 2 submissions, {elapsed:.2f}s: {passes} passes, {cpu:.3f}s of CPU")
+    assert results.keys() == {PROT}, "protein isn't rendered"
+    assert results[PROT].keys() == taxids, "missing taxids"
+    assert all(hits.ids == fake_hits(taxid).ids for taxid, hits in results[PROT].items()), "hits differ"
+    assert passes <= MAX_PASSES, "the loop spins on resolved taxids"
+    print("hits are equal")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
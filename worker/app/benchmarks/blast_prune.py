@@ -0,0 +1,79 @@
+"""Pareto pruning of BLAST hits: blast_sync.prune_hits vs the old per-taxid loop
+
+Run from /app inside of the worker container:
+    python3 -m benchmarks.blast_prune [pages] [hits_per_page] [taxids_per_page]
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from app.tasks.blast_sync import prune_hits, COLS
+
+
+def prune_hits_loop(df: pd.DataFrame) -> dict[int, pd.DataFrame]:
+    # implementation used before prune_hits (stable sort to make the duplicate choice deterministic)
+    result = {}
+    for taxid, group in df.groupby('taxid', sort=False):
+        points = group[['evalue','pident','qcov']]
+        points = points.reindex(group.index[np.argsort(-np.linalg.norm(points, axis=1), kind='stable')], copy=False)
+        pts_to_keep = []
+        while points.size:
+            pts_to_keep.append(points.index[0])
+            points = points[(points>points.iloc[0]).any(axis=1)]
+        result[taxid] = group[['evalue','pident','qcov','id']].loc[pts_to_keep]
+    return result
+
+
+def synthetic_page(rng: np.random.Generator, hits: int, taxids: int) -> pd.DataFrame:
+    # blast pages are sorted by evalue, metrics are rounded as on the page
+    evalue = np.sort(10.0 ** -rng.uniform(0, 200, hits))[::-1].copy()
+    evalue[rng.random(hits) < 0.05] = 0.0
+    df = pd.DataFrame({
+        'taxid': rng.integers(1, taxids + 1, hits) * 1000,
+        'evalue': evalue,
+        'pident': rng.uniform(20, 100, hits).round(2),
+        'qcov': rng.integers(10, 101, hits).astype(np.float64),
+        'id': [f"XP_{i:09d}.1" for i in range(hits)],
+    })
+    for col, dtype in COLS.items():
+        df[col] = df[col].astype(dtype=dtype, copy=False)
+    df['evalue'] = -np.log10(df['evalue'].replace(0.0, 1e-300))
+    return df
+
+
+def timed(func, pages):
+    start = time.perf_counter()
+    res = [func(page) for page in pages]
+    return time.perf_counter() - start, res
+
+
+def main():
+    args = [int(arg) for arg in sys.argv[1:]]
+    if len(args) > 3:
+        print(__doc__)
+        sys.exit(1)
+    page_count, hits, taxids = args + [20, 5000, 500][len(args):]
+
+    rng = np.random.default_rng(0)
+    pages = [synthetic_page(rng, hits, taxids) for _ in range(page_count)]
+    print(f"{page_count} pages, {hits} hits, up to {taxids} taxids per page")
+
+    loop_time, loop_res = timed(prune_hits_loop, pages)
+    print(f"loop:       {loop_time/page_count*1000:.1f}ms per page")
+    vec_time, vec_res = timed(prune_hits, pages)
+    print(f"vectorized: {vec_time/page_count*1000:.1f}ms per page")
+    print(f"speedup: {loop_time/vec_time:.1f}x")
+
+    kept = 0
+    for old, new in zip(loop_res, vec_res):
+        assert list(old.keys()) == list(new.keys()), "taxids differ"
+        for taxid, old_df in old.items():
+            pd.testing.assert_frame_equal(old_df, new[taxid])
+            kept += len(old_df)
+    print(f"results are equal, {kept/page_count:.0f} hits kept per page")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+"""Deterministic fake of the NCBI web BLAST for load tests of the blast stage
+
+Run from /app inside of the worker container:
+    python3 -m benchmarks.fake_ncbi [--port 8090] [--pages DIR] [--search-time S] ...
+
+and point the worker to it with NCBI_URL=http://localhost:8090 (see --help for the options).
+
+Serves the pages blast_ncbi.NcbiWebApi requests: the search form (cookies), submissions,
+status pages with "var tm" refresh delays, results pages of every query, the recent
+results page with delete links and the organism autocomplete. Hits of a (protein, taxid)
+are generated from the seed, or replayed from DIR/{protein}.html, an NCBI results page
+saved with DESCRIPTIONS=5000. Errors are injected with a seeded generator:
+--error-rate of the requests fail with 503, searches of more than --cpu-limit
+(protein, organism) pairs fail with "CPU usage limit was exceeded".
+GET /fake/stats returns the counters as json.
+"""
+import argparse
+import asyncio
+from collections import Counter
+from html import escape
+from pathlib import Path
+import random
+import re
+import time
+from typing import NamedTuple, Optional
+from urllib.parse import parse_qs
+import zlib
+
+from aiohttp import web
+import numpy as np
+import pandas as pd
+
+from app.tasks.blast_sync import parse_page, COLS
+
+TAXID_RE = re.compile(r'\(taxid:(\d+)\)')
+CPU_LIMIT_ERROR = "CPU usage limit was exceeded, resulting in SIGXCPU (24)."
+PAGE_COLUMNS = (
+    "", "Description", "Scientific Name", "Max Score", "Total Score",
+    "Query Cover", "E value", "Per. Ident", "Acc. Len", "Accession", "Taxid",
+)
+
+
+class FakeConfig(NamedTuple):
+    seed: int = 0
+    # seconds a search runs, plus pair_time for every (protein, organism) of it
+    search_time: float = 3.0
+    pair_time: float = 0.002
+    # "var tm" of the status pages, ms
+    refresh: int = 1000
+    # delay of every response
+    latency: float = 0.05
+    # share of the requests that fail with 503
+    error_rate: float = 0.0
+    # max (protein, organism) pairs of a search, 0 - no limit
+    cpu_limit: int = 0
+    # max hits of a taxid
+    hits: int = 20
+    pages: Optional[Path] = None
+
+
+class Search():
+    def __init__(self, rid:str, prots:list[str], taxids:list[int], duration:float, too_large:bool):
+        self.rid = rid
+        self.prots = prots
+        self.taxids = taxids
+        self.started = time.monotonic()
+        self.duration = duration
+        self.too_large = too_large
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+
+def organism_name(taxid:int) -> str:
+    return f"organism {taxid} (taxid:{taxid})"
+
+
+def fake_hits(seed:int, prot:str, taxid:int, max_hits:int) -> pd.DataFrame:
+    """Hits (blast_sync.COLS) of the protein in the taxid, the same for the same arguments"""
+    rng = np.random.default_rng([seed, zlib.crc32(prot.encode()), taxid])
+    count = int(rng.integers(0, max_hits + 1))
+    # values as they are printed on the page
+    evalue = [float(f"{val:.2e}") for val in 10.0 ** -rng.uniform(3, 180, count)]
+    df = pd.DataFrame({
+        'taxid': np.full(count, taxid),
+        'evalue': evalue,
+        'pident': np.round(rng.uniform(20, 100, count), 2),
+        'qcov': rng.integers(10, 101, count).astype(np.float64),
+        'id': [f"XP_{taxid % 10**6:06d}{i:03d}.1" for i in range(count)],
+    })
+    for col, dtype in COLS.items():
+        df[col] = df[col].astype(dtype=dtype, copy=False)
+    return df
+
+
+class HitSource():
+    def __init__(self, config:FakeConfig):
+        self.config = config
+        self._recorded: dict[str, Optional[pd.DataFrame]] = {}
+
+    def recorded(self, prot:str) -> Optional[pd.DataFrame]:
+        if self.config.pages is None:
+            return None
+        if prot not in self._recorded:
+            page = self.config.pages / f"{prot}.html"
+            self._recorded[prot] = parse_page(page.read_bytes())[0] if page.exists() else None
+        return self._recorded[prot]
+
+    def hits(self, prot:str, taxids:list[int]) -> pd.DataFrame:
+        recorded = self.recorded(prot)
+        if recorded is not None:
+            return recorded[recorded['taxid'].isin(taxids)]
+        return pd.concat(
+            [fake_hits(self.config.seed, prot, taxid, self.config.hits) for taxid in taxids],
+            ignore_index=True,
+        )
+
+
+def _page(body:str, title:str="NCBI Blast:Protein Sequence", script:str="") -> str:
+    return (
+        '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" '
+        '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml" lang="en"><head><meta charset="utf-8">'
+        f'<title>{title}</title><script>{script}</script></head><body>\n'
+        f'<div id="wrap"><div id="content">{body}</div></div></body></html>\n'
+    )
+
+
+def _inputs(params:dict[str, str]) -> str:
+    return "".join(
+        f'<input name="{escape(name)}" value="{escape(value)}" type="hidden">'
+        for name, value in params.items()
+    )
+
+
+def status_page(search:Search, refresh:int, errors:list[str]=()) -> str:
+    elapsed = int(search.elapsed())
+    error_list = "".join(f"<li>{escape(error)}</li>" for error in errors)
+    return _page(
+        (f'<ul class="msg error">{error_list}</ul>' if errors else '') +
+        '<form action="Blast.cgi" enctype="application/x-www-form-urlencoded" method="post" name="RequestFrm">'
+        + _inputs({"RID": search.rid, "CMD": "Get", "FORMAT_TYPE": "HTML"}) +
+        '<table id="statInfo" class="WAITING">'
+        f'<tr><td>Request ID</td><td>{search.rid}</td></tr>'
+        '<tr><td>Status</td><td>Searching</td></tr>'
+        f'<tr><td>Time since submission</td><td>{elapsed//3600:02d}:{elapsed//60%60:02d}:{elapsed%60:02d}</td></tr>'
+        '</table></form>',
+        script=f'var tm = "{refresh}";',
+    )
+
+
+def results_page(search:Search, query_index:int, hits:pd.DataFrame, nohits:set[str]) -> str:
+    options = "".join(
+        f'<option value="{i}"'
+        + (' selected="selected"' if i == query_index else '')
+        + (' class="nohits"' if prot in nohits else '')
+        + f'>Query_{i+1} sp|{prot}|{prot}_FAKE</option>'
+        for i, prot in enumerate(search.prots)
+    )
+    header = "".join(f'<th>{name}</th>' for name in PAGE_COLUMNS)
+    rows = "".join(
+        f'<tr class="dflLnk"><td><input type="checkbox" class="cb" name="getSeqGi" value="{row.id}"></td>'
+        f'<td>hypothetical protein [organism {row.taxid}]</td><td>organism {row.taxid}</td>'
+        f'<td>100.0</td><td>100.0</td><td>{row.qcov:.0f}%</td><td>{row.evalue:.2e}</td>'
+        f'<td>{row.pident:.2f}%</td><td>500</td><td>{row.id}</td><td>{row.taxid}</td></tr>\n'
+        for row in hits.itertuples()
+    )
+    return _page(
+        '<form action="Blast.cgi" method="post" name="results" id="results">'
+        + _inputs({
+            "RID": search.rid,
+            "CMD": "Get",
+            "QUERY_INDEX": str(query_index),
+            "DESCRIPTIONS": "100",
+            "FORMAT_TYPE": "HTML",
+        }) +
+        f'<select name="queryList" id="queryList">{options}</select>\n'
+        f'<table id="dscTable"><thead><tr>{header}</tr></thead><tbody>\n{rows}</tbody></table>\n'
+        '</form>',
+    )
+
+
+def saved_page(searches:dict[str, Search]) -> str:
+    rows = "".join(
+        f'<tr><td><input type="checkbox"></td><td>{rid}</td><td>Blast search job</td>'
+        f'<td><a class="del" href="Blast.cgi?CMD=DelSaved&amp;RID={rid}">Delete</a></td></tr>'
+        for rid in searches
+    )
+    return _page(
+        f'<table><tr><th></th><th>Request ID</th><th>Title</th><th></th></tr>{rows}</table>',
+        title="Recent Results",
+    )
+
+
+class FakeNcbi():
+    def __init__(self, config:FakeConfig):
+        self.config = config
+        self.hit_source = HitSource(config)
+        self.rng = random.Random(config.seed)
+        self.searches: dict[str, Search] = {}
+        self.stats = Counter()
+
+    def submit(self, form) -> Search:
+        prots = [line.strip() for line in form.get("QUERY", "").splitlines() if line.strip()]
+        organisms = [form["EQ_MENU"]] + [
+            form[f"EQ_MENU{i}"]
+            for i in range(1, int(form.get("NUM_ORG", "1")))
+        ]
+        taxids = [int(TAXID_RE.search(org).group(1)) for org in organisms]
+        pairs = len(prots) * len(taxids)
+        rid = f"FAKE{self.stats['searches']:06d}"
+        search = Search(
+            rid, prots, taxids,
+            duration=self.config.search_time + pairs * self.config.pair_time,
+            too_large=bool(self.config.cpu_limit) and pairs > self.config.cpu_limit,
+        )
+        self.searches[rid] = search
+        self.stats["searches"] += 1
+        self.stats["pairs"] += pairs
+        return search
+
+    def get(self, search:Search, query_index:int) -> str:
+        if search.elapsed() < search.duration:
+            return status_page(search, self.config.refresh)
+        if search.too_large:
+            self.stats["cpu_limit_errors"] += 1
+            return status_page(search, self.config.refresh, [CPU_LIMIT_ERROR])
+        hits = {prot: self.hit_source.hits(prot, search.taxids) for prot in search.prots}
+        self.stats["result_pages"] += 1
+        return results_page(
+            search, query_index,
+            hits[search.prots[query_index]],
+            {prot for prot, df in hits.items() if df.empty},
+        )
+
+    async def handle_blast(self, request:web.Request) -> web.Response:
+        if request.content_type.startswith("multipart/"):
+            form = await request.post()
+        else:
+            # status and results forms are posted as urlencoded bodies without a content type
+            form = {
+                key: values[-1]
+                for key, values in parse_qs(await request.text(), keep_blank_values=True).items()
+            }
+        params = {**request.query, **form}
+        cmd = params.get("CMD")
+        if cmd == "request":
+            search = self.submit(params)
+            return web.Response(text=status_page(search, self.config.refresh), content_type="text/html")
+        if cmd == "Get":
+            search = self.searches.get(params.get("RID"))
+            if search is None:
+                raise web.HTTPNotFound()
+            page = self.get(search, int(params.get("QUERY_INDEX", 0)))
+            return web.Response(text=page, content_type="text/html")
+        if cmd == "GetSaved":
+            return web.Response(text=saved_page(self.searches), content_type="text/html")
+        if cmd == "DelSaved":
+            if self.searches.pop(params.get("RID"), None) is not None:
+                self.stats["deleted"] += 1
+            return web.Response(text=saved_page(self.searches), content_type="text/html")
+        # search form, the client gets its cookies here
+        return web.Response(
+            text=_page("<form></form>"), content_type="text/html",
+            headers={"Set-Cookie": "ncbi_sid=FAKE; Path=/"},
+        )
+
+    async def handle_autocomp(self, request:web.Request) -> web.Response:
+        taxid = int(request.query["q"].split(":")[-1])
+        return web.Response(
+            text=f'NSuggest_CreateData("{request.query["q"]}", new Array("{organism_name(taxid)}@{taxid}"), 1);',
+            content_type="application/javascript",
+        )
+
+    async def handle_stats(self, request:web.Request) -> web.Response:
+        return web.json_response({**self.stats, "active": len(self.searches)})
+
+    @web.middleware
+    async def middleware(self, request:web.Request, handler):
+        self.stats["requests"] += 1
+        await asyncio.sleep(self.config.latency)
+        if request.path != "/fake/stats" and self.rng.random() < self.config.error_rate:
+            self.stats["errors"] += 1
+            raise web.HTTPServiceUnavailable()
+        return await handler(request)
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self.middleware])
+        app.router.add_route("*", "/Blast.cgi", self.handle_blast)
+        app.router.add_get("/portal/utils/autocomp.fcgi", self.handle_autocomp)
+        app.router.add_get("/fake/stats", self.handle_stats)
+        return app
+
+
+def main():
+    defaults = FakeConfig()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--pages", type=Path, help="dir with recorded results pages, {protein}.html")
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--search-time", type=float, default=defaults.search_time, help="seconds a search runs")
+    parser.add_argument("--pair-time", type=float, default=defaults.pair_time, help="extra seconds per (protein, organism)")
+    parser.add_argument("--refresh", type=int, default=defaults.refresh, help="refresh delay of the status pages, ms")
+    parser.add_argument("--latency", type=float, default=defaults.latency, help="delay of every response, s")
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate, help="share of requests failing with 503")
+    parser.add_argument("--cpu-limit", type=int, default=defaults.cpu_limit, help="max (protein, organism) pairs of a search")
+    parser.add_argument("--hits", type=int, default=defaults.hits, help="max hits of a taxid")
+    args = parser.parse_args()
+    port = args.port
+    config = FakeConfig(**{
+        name: value
+        for name, value in vars(args).items()
+        if name != "port"
+    })
+    web.run_app(FakeNcbi(config).app(), port=port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Local sqlite OrthoDB resolver vs sparql.orthodb.org
+
+Run from /app inside of the worker container (ORTHODB_SQLITE must be set):
+    python3 -m benchmarks.orthodb_get PROTEIN_LIST [level]
+
+PROTEIN_LIST is a file in the same format as the web form (see test_data/700proteins.csv)
+"""
+import asyncio
+import math
+import sys
+import time
+
+from app.async_executor import async_pool
+from app.tasks import table_sync
+from app.tasks.table import VALID_PROT_IDS, COMMENT
+
+
+def chunks(prot_ids, min_items_per_chunk=20, max_items_per_chunk=200, preferred_chunk_count=10):
+    # same split as table.fetch_proteins uses for the sparql endpoint
+    chunk_count = max(
+        min(preferred_chunk_count, math.ceil(len(prot_ids) / min_items_per_chunk)),
+        math.ceil(len(prot_ids) / max_items_per_chunk),
+    )
+    chunk_length = math.ceil(len(prot_ids)/chunk_count)
+    return [
+        prot_ids[i*chunk_length:(i+1)*chunk_length]
+        for i in range(chunk_count)
+    ]
+
+
+async def run(func, level, prot_chunks):
+    start = time.perf_counter()
+    res = {}
+    for part in await asyncio.gather(*(func(level, chunk) for chunk in prot_chunks)):
+        res.update(part)
+    return time.perf_counter() - start, res
+
+
+def as_pairs(res):
+    return {
+        (prot_id, og)
+        for prot_id, items in res.items()
+        for og, _, _ in items
+    }
+
+
+async def main():
+    if len(sys.argv) not in (2, 3):
+        print(__doc__)
+        sys.exit(1)
+    level = sys.argv[2] if len(sys.argv) == 3 else "Eukaryota"
+    with open(sys.argv[1]) as f:
+        prot_ids = list(dict.fromkeys(
+            m.group(0)
+            for m in VALID_PROT_IDS.finditer(COMMENT.sub("", f.read()).upper())
+        ))
+    print(f"{len(prot_ids)} proteins, level {level}")
+
+    async with async_pool:
+        local_time, local_res = await run(table_sync.orthodb_get_sqlite, level, [prot_ids])
+        print(f"sqlite: {local_time:.3f}s, {len(local_res)} proteins found")
+
+        try:
+            sparql_time, sparql_res = await run(table_sync.orthodb_get_sparql, level, chunks(prot_ids))
+        except Exception as e:
+            print(f"sparql: failed ({e!r})")
+            return
+        print(f"sparql: {sparql_time:.3f}s, {len(sparql_res)} proteins found")
+        print(f"speedup: {sparql_time/local_time:.1f}x")
+
+    local_pairs = as_pairs(local_res)
+    sparql_pairs = as_pairs(sparql_res)
+    print(f"(protein, OG) pairs only in sqlite: {len(local_pairs - sparql_pairs)}")
+    print(f"(protein, OG) pairs only in sparql: {len(sparql_pairs - local_pairs)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,172 @@
+"""PANTHER family lookups: panther.find_family (family tables) vs the old query and pivot
+
+Run from /app inside of the worker container:
+    python3 -m benchmarks.prottree_lookup [families] [lookups]
+
+Builds a synthetic PANTHER db (panther table of the import script with the
+genomes of panther/prottree_id_converter.csv) in a temporary directory.
+"""
+from contextlib import closing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from app import panther
+from app.tasks.prottree_sync import family_matrix, id_converter
+
+
+PANTHER_TABLE_SQL = """
+CREATE TABLE panther (
+    Genome TEXT NOT NULL,
+    Genome_2nd_half TEXT NOT NULL,
+    Uniprot TEXT NOT NULL,
+    Gene TEXT NOT NULL,
+    PantherID TEXT NOT NULL,
+    PantherID_2nd_half TEXT NOT NULL,
+    Family TEXT,
+    Subfamily TEXT,
+    col_7 TEXT,
+    col_8 TEXT,
+    col_9 TEXT,
+    col_10 TEXT,
+    col_11 TEXT
+);
+"""
+# indexes of the import script before the family tables
+OLD_INDEXES_SQL = """
+CREATE INDEX pantherid_idx ON panther (PantherID);
+CREATE INDEX gene_idx ON panther (Gene);
+"""
+
+
+def lookup_old(conn, prot_id):
+    # implementation used before panther.find_family
+    res = conn.execute("""
+        SELECT Genome, Gene, Family, Subfamily, Uniprot
+        FROM panther
+        WHERE PantherID=(
+            SELECT PantherID
+            FROM panther
+            WHERE Gene = ?
+        );
+    """, (prot_id,))
+    data = res.fetchall()
+    panther_df = pd.DataFrame(
+        data,
+        columns=['Genome', 'Gene', 'Family', 'Subfamily', 'Uniprot']
+    )
+    if panther_df.empty:
+        return None
+    family = data[0][2].strip("'\" \n\t")
+
+    value_count = panther_df['Subfamily'].value_counts().sort_index(ascending=True)
+    value_count = value_count.where(value_count > 8).dropna()
+    threshold_families = value_count.index.tolist()
+    if len(threshold_families) == 0:
+        return family, [], None
+
+    panther_df = panther_df.drop_duplicates(subset=['Genome', 'Subfamily'], keep='last').assign(v=1).pivot(index='Subfamily', columns='Genome').fillna(0)
+    panther_df = panther_df['v'].T
+    panther_df = panther_df[threshold_families]
+
+    tree_taxid = id_converter().merge(panther_df, on='Genome', how='left')
+    tree_taxid.fillna(0, inplace=True)
+    tree_taxid.set_index('TreeID', inplace=True)
+    return family, threshold_families, tree_taxid[threshold_families].to_numpy() * 100
+
+
+def lookup_new(conn, prot_id, family_tables=True):
+    family = panther.find_family(conn, prot_id, family_tables)
+    if family is None:
+        return None
+    name = family.name.strip("'\" \n\t")
+    if not family.subfamilies:
+        return name, [], None
+    return name, family.subfamilies, family_matrix(family)
+
+
+def build_db(path, family_count, rng):
+    genomes = id_converter()['Genome'].tolist() + [f"OTHER{i}" for i in range(20)]
+    rows = []
+    for family in range(family_count):
+        gene_count = int(rng.integers(5, 400))
+        subfamilies = int(rng.integers(1, 12))
+        for gene in range(gene_count):
+            genome = genomes[rng.integers(len(genomes))]
+            subfamily = rng.integers(subfamilies + 1)
+            rows.append((
+                genome, f"Gene=G{family}_{gene}", f"UniProtKB=P{family:05d}{gene:04d}",
+                f"G{family}_{gene}", f"PTHR{family:05d}", f"SF{subfamily}",
+                f"FAMILY {family}",
+                # genes without a subfamily
+                f"SUBFAMILY {family}.{subfamily}" if subfamily else None,
+            ))
+    with closing(sqlite3.connect(path)) as conn:
+        conn.executescript(PANTHER_TABLE_SQL)
+        conn.executemany(
+            "INSERT INTO panther (Genome, Genome_2nd_half, Uniprot, Gene, PantherID, PantherID_2nd_half, Family, Subfamily) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        conn.executescript(OLD_INDEXES_SQL)
+        conn.commit()
+    return len(rows)
+
+
+def timed(func, path, genes, *args):
+    with closing(panther.connect(path)) as conn:
+        start = time.perf_counter()
+        res = [func(conn, gene, *args) for gene in genes]
+        return len(genes) / (time.perf_counter() - start), res
+
+
+def main():
+    args = [int(arg) for arg in sys.argv[1:]]
+    if len(args) > 2:
+        print(__doc__)
+        sys.exit(1)
+    family_count, lookups = args + [5000, 500][len(args):]
+
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "panther.sqlite")
+        row_count = build_db(path, family_count, rng)
+        print(f"{family_count} families, {row_count} genes")
+        with closing(panther.connect(path)) as conn:
+            genes = [
+                gene
+                for gene, in conn.execute(
+                    "SELECT Gene FROM panther ORDER BY random() LIMIT ?", (lookups,)
+                )
+            ]
+        genes.append("unknown gene")
+
+        old_rate, old_res = timed(lookup_old, path, genes)
+        print(f"old query + pivot:        {old_rate:.0f} lookups/s")
+        start = time.perf_counter()
+        panther.build_family_tables(path)
+        print(f"family tables built in {time.perf_counter() - start:.1f}s")
+        fallback_rate, fallback_res = timed(lookup_new, path, genes, False)
+        print(f"panther table (fallback): {fallback_rate:.0f} lookups/s")
+        new_rate, new_res = timed(lookup_new, path, genes)
+        print(f"family tables:            {new_rate:.0f} lookups/s")
+        print(f"speedup: {new_rate/old_rate:.1f}x")
+
+        for res in (fallback_res, new_res):
+            for old, new in zip(old_res, res):
+                if old is None or new is None:
+                    assert old is new, "unknown gene results differ"
+                    continue
+                assert old[:2] == new[:2], "families differ"
+                if old[2] is not None:
+                    np.testing.assert_array_equal(old[2], new[2])
+        print("results are equal")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""tree.xml writing: phyloxml.write_tree vs parsing the level tree and the old SubElement loop
+
+Run from /app inside of the worker container:
+    python3 -m benchmarks.tree_xml [level_id] [og_count]
+
+Uses the phyloxml file of the level (default: 2, all species) and a random
+presence matrix with og_count OGs (default: 300). The streaming writer is timed
+with the tree template already cached (it's built once per worker process).
+"""
+import io
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from lxml import etree as ET
+
+from app.corr_matrix import level_organisms
+from app import phyloxml
+from app.tasks.tree_heatmap_sync import heatmap_rows
+from app.utils import list_level_files
+
+
+def write_loop(f, phyloxml_file, df, columns, prot_ids, do_blast):
+    # implementation used before phyloxml.write_tree
+    parser = ET.XMLParser(remove_blank_text=True)
+    tree = ET.parse(phyloxml_file, parser)
+    root = tree.getroot()
+    graphs = ET.SubElement(root, "graphs")
+    graph = ET.SubElement(graphs, "graph", type="heatmap")
+    ET.SubElement(graph, "name").text = "Presense"
+    legend = ET.SubElement(graph, "legend", show="1")
+
+    for og_name in columns:
+        field = ET.SubElement(legend, "field")
+        ET.SubElement(field, "name").text = og_name
+
+    gradient = ET.SubElement(legend, "gradient")
+    ET.SubElement(gradient, "name").text = "Custom"
+    ET.SubElement(gradient, "classes").text = "4" if do_blast else "2"
+
+    data = ET.SubElement(graph, "data")
+    for index, row in df.iterrows():
+        values = ET.SubElement(data, "values", {"for":str(index)})
+        for og_name in columns:
+            el = ET.SubElement(values, "value")
+            if row[og_name]:
+                el.text = "100"
+                el.attrib["label"] = "OrthoDB: " + prot_ids.get(og_name, {}).get(str(index), "Not Found")
+            else:
+                el.text = "0"
+                if do_blast:
+                    el.attrib["label"] = "Not BLASTed"
+
+    tree.write(f, xml_declaration=True)
+
+
+def write_streaming(f, phyloxml_file, df, columns, prot_ids, do_blast):
+    phyloxml.write_tree(
+        f,
+        phyloxml.load_template(phyloxml_file),
+        fields=columns,
+        gradient_classes=4 if do_blast else 2,
+        rows=heatmap_rows(df, columns, prot_ids, do_blast),
+    )
+
+
+WRITERS = {
+    "loop": write_loop,
+    "streaming": write_streaming,
+}
+
+
+def synthetic_data(rng: np.random.Generator, organisms: list[int], og_count: int):
+    columns = [f"{i}at2759" for i in range(og_count)]
+    df = pd.DataFrame(
+        (rng.random((len(organisms), og_count)) < 0.6).astype(np.int16),
+        index=organisms,
+        columns=columns,
+    )
+    prot_ids = {
+        og_name: {
+            str(taxid): ";".join(f"GENE{taxid}_{i}" for i in range(rng.integers(1, 3)))
+            for taxid in organisms
+            if rng.random() < 0.95
+        }
+        for og_name in columns
+    }
+    # a few names that need escaping
+    prot_ids[columns[0]][str(organisms[0])] = 'Gene "A" & <B> é'
+    return df, prot_ids
+
+
+def task_data(level_id, og_count):
+    phyloxml_file = {id: path for id, _, _, path in list_level_files()}[level_id]
+    organisms = level_organisms(phyloxml_file)
+    df, prot_ids = synthetic_data(np.random.default_rng(0), organisms, og_count)
+    columns = df.columns[np.random.default_rng(1).permutation(og_count)]
+    return phyloxml_file, df, columns, prot_ids
+
+
+def timed(func, *args):
+    f = io.BytesIO()
+    start = time.perf_counter()
+    func(f, *args)
+    return time.perf_counter() - start, f.getvalue()
+
+
+def peak_rss():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def rss_child(writer, level_id, og_count):
+    phyloxml_file, *args = task_data(level_id, og_count)
+    if writer == "streaming":
+        phyloxml.load_template(phyloxml_file)
+    with open(os.devnull, "wb") as f:
+        before = peak_rss()
+        WRITERS[writer](f, phyloxml_file, *args, True)
+        print(peak_rss() - before)
+
+
+def measure_rss(writer, level_id, og_count):
+    # peak rss of writing in a fresh interpreter
+    res = subprocess.run(
+        [sys.executable, "-m", "benchmarks.tree_xml", "--rss", writer, str(level_id), str(og_count)],
+        check=True, capture_output=True, text=True,
+    )
+    return int(res.stdout.split()[-1])
+
+
+def main():
+    if len(sys.argv) == 5 and sys.argv[1] == "--rss":
+        rss_child(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+        return
+    args = [int(arg) for arg in sys.argv[1:]]
+    if len(args) > 2:
+        print(__doc__)
+        sys.exit(1)
+    level_id, og_count = args + [2, 300][len(args):]
+
+    phyloxml_file, df, columns, prot_ids = task_data(level_id, og_count)
+    print(f"{len(df.index)} organisms x {og_count} OGs")
+    phyloxml.load_template(phyloxml_file)
+
+    for do_blast in (False, True):
+        times = {}
+        results = {}
+        for name, writer in WRITERS.items():
+            times[name], results[name] = timed(writer, phyloxml_file, df, columns, prot_ids, do_blast)
+        print(
+            f"do_blast={do_blast}: loop {times['loop']:.2f}s, streaming {times['streaming']:.2f}s, "
+            f"speedup {times['loop']/times['streaming']:.1f}x"
+        )
+        assert results["loop"] == results["streaming"], "outputs differ"
+    print(f"outputs are equal, {len(results['streaming'])/2**20:.1f}MiB")
+    for name in WRITERS:
+        print(f"{name}: peak rss +{measure_rss(name, level_id, og_count)/1024:.1f}MiB")
+
+
+if __name__ == "__main__":
+    main()